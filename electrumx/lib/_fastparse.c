@@ -0,0 +1,969 @@
+/*
+ * Copyright (c) 2022, the ElectrumX authors
+ *
+ * All rights reserved.
+ *
+ * See the file "LICENCE" for information about the copyright
+ * and warranty status of this software.
+ *
+ * Optional C implementations of the hot loops of block processing and
+ * flushing.
+ *
+ * These must give byte-identical results to the pure Python code they
+ * replace: Coin.digest_txs(), Script.get_push_input_refs(),
+ * utxo_cache.py_utxo_records(), hash.py_sha256_update(),
+ * hash.py_sha256_finish(), history.py_pack_history() and
+ * history.py_unpack_history().  See tests/lib/test_fastparse.py.
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+
+#define HASHX_LEN 11
+#define OUTPOINT_LEN 36
+#define UTXO_VALUE_LEN (HASHX_LEN + 5 + 8)
+/* Records of the UTXO DB "h" and "u" tables: the key followed by the value */
+#define H_KEY_LEN (1 + 4 + 4 + 5)
+#define H_RECORD_LEN (H_KEY_LEN + HASHX_LEN)
+#define U_KEY_LEN (1 + HASHX_LEN + 4 + 5)
+#define U_RECORD_LEN (U_KEY_LEN + 8)
+#define PUSH_REF_LEN 36
+
+#define OP_PUSHDATA1 0x4c
+#define OP_PUSHDATA2 0x4d
+#define OP_PUSHDATA4 0x4e
+#define OP_RETURN 0x6a
+#define OP_PUSHINPUTREF 0xd0
+#define OP_REQUIREINPUTREF 0xd1
+#define OP_DISALLOWPUSHINPUTREF 0xd2
+#define OP_DISALLOWPUSHINPUTREFSIBLING 0xd3
+#define OP_PUSHINPUTREFSINGLETON 0xd8
+
+
+/* --- SHA-256 (FIPS 180-4) */
+
+typedef struct {
+    uint32_t state[8];
+    uint64_t length;
+    uint8_t block[64];
+    size_t used;
+} sha256_ctx;
+
+static const uint32_t K256[64] = {
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1,
+    0x923f82a4, 0xab1c5ed5, 0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3,
+    0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174, 0xe49b69c1, 0xefbe4786,
+    0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147,
+    0x06ca6351, 0x14292967, 0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13,
+    0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85, 0xa2bfe8a1, 0xa81a664b,
+    0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a,
+    0x5b9cca4f, 0x682e6ff3, 0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208,
+    0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2,
+};
+
+#define ROTR32(x, n) (((x) >> (n)) | ((x) << (32 - (n))))
+
+static void
+sha256_transform(sha256_ctx *ctx, const uint8_t *data)
+{
+    uint32_t w[64], a, b, c, d, e, f, g, h, t1, t2;
+    int i;
+
+    for (i = 0; i < 16; i++)
+        w[i] = ((uint32_t)data[i * 4] << 24) | ((uint32_t)data[i * 4 + 1] << 16)
+            | ((uint32_t)data[i * 4 + 2] << 8) | (uint32_t)data[i * 4 + 3];
+    for (; i < 64; i++) {
+        uint32_t s0 = ROTR32(w[i - 15], 7) ^ ROTR32(w[i - 15], 18) ^ (w[i - 15] >> 3);
+        uint32_t s1 = ROTR32(w[i - 2], 17) ^ ROTR32(w[i - 2], 19) ^ (w[i - 2] >> 10);
+        w[i] = w[i - 16] + s0 + w[i - 7] + s1;
+    }
+
+    a = ctx->state[0]; b = ctx->state[1]; c = ctx->state[2]; d = ctx->state[3];
+    e = ctx->state[4]; f = ctx->state[5]; g = ctx->state[6]; h = ctx->state[7];
+    for (i = 0; i < 64; i++) {
+        t1 = h + (ROTR32(e, 6) ^ ROTR32(e, 11) ^ ROTR32(e, 25))
+            + ((e & f) ^ (~e & g)) + K256[i] + w[i];
+        t2 = (ROTR32(a, 2) ^ ROTR32(a, 13) ^ ROTR32(a, 22))
+            + ((a & b) ^ (a & c) ^ (b & c));
+        h = g; g = f; f = e; e = d + t1;
+        d = c; c = b; b = a; a = t1 + t2;
+    }
+    ctx->state[0] += a; ctx->state[1] += b; ctx->state[2] += c; ctx->state[3] += d;
+    ctx->state[4] += e; ctx->state[5] += f; ctx->state[6] += g; ctx->state[7] += h;
+}
+
+static void
+sha256_init(sha256_ctx *ctx)
+{
+    static const uint32_t initial[8] = {
+        0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a,
+        0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19,
+    };
+    memcpy(ctx->state, initial, sizeof(initial));
+    ctx->length = 0;
+    ctx->used = 0;
+}
+
+static void
+sha256_update(sha256_ctx *ctx, const uint8_t *data, size_t len)
+{
+    ctx->length += len;
+    if (ctx->used) {
+        size_t room = 64 - ctx->used;
+        if (len < room) {
+            memcpy(ctx->block + ctx->used, data, len);
+            ctx->used += len;
+            return;
+        }
+        memcpy(ctx->block + ctx->used, data, room);
+        sha256_transform(ctx, ctx->block);
+        data += room;
+        len -= room;
+        ctx->used = 0;
+    }
+    while (len >= 64) {
+        sha256_transform(ctx, data);
+        data += 64;
+        len -= 64;
+    }
+    memcpy(ctx->block, data, len);
+    ctx->used = len;
+}
+
+static void
+sha256_final(sha256_ctx *ctx, uint8_t *digest)
+{
+    uint64_t bits = ctx->length * 8;
+    int i;
+
+    ctx->block[ctx->used++] = 0x80;
+    if (ctx->used > 56) {
+        memset(ctx->block + ctx->used, 0, 64 - ctx->used);
+        sha256_transform(ctx, ctx->block);
+        ctx->used = 0;
+    }
+    memset(ctx->block + ctx->used, 0, 56 - ctx->used);
+    for (i = 0; i < 8; i++)
+        ctx->block[56 + i] = (uint8_t)(bits >> (56 - i * 8));
+    sha256_transform(ctx, ctx->block);
+    for (i = 0; i < 8; i++) {
+        digest[i * 4] = (uint8_t)(ctx->state[i] >> 24);
+        digest[i * 4 + 1] = (uint8_t)(ctx->state[i] >> 16);
+        digest[i * 4 + 2] = (uint8_t)(ctx->state[i] >> 8);
+        digest[i * 4 + 3] = (uint8_t)ctx->state[i];
+    }
+}
+
+static void
+sha256(const uint8_t *data, size_t len, uint8_t *digest)
+{
+    sha256_ctx ctx;
+    sha256_init(&ctx);
+    sha256_update(&ctx, data, len);
+    sha256_final(&ctx, digest);
+}
+
+static void
+double_sha256(const uint8_t *data, size_t len, uint8_t *digest)
+{
+    uint8_t first[32];
+    sha256(data, len, first);
+    sha256(first, 32, digest);
+}
+
+/* A SHA-256 state serialized as by hash.py_sha256_update(): the state words and
+   the length big-endian, followed by the bytes of the unfinished block */
+#define SHA256_STATE_LEN 40
+
+static int
+sha256_load(sha256_ctx *ctx, const uint8_t *state, Py_ssize_t len)
+{
+    int i;
+
+    if (len < SHA256_STATE_LEN)
+        goto bad;
+    for (i = 0; i < 8; i++)
+        ctx->state[i] = ((uint32_t)state[i * 4] << 24) | ((uint32_t)state[i * 4 + 1] << 16)
+            | ((uint32_t)state[i * 4 + 2] << 8) | (uint32_t)state[i * 4 + 3];
+    ctx->length = 0;
+    for (i = 0; i < 8; i++)
+        ctx->length = (ctx->length << 8) | state[32 + i];
+    ctx->used = (size_t)(ctx->length % 64);
+    if (len != SHA256_STATE_LEN + (Py_ssize_t)ctx->used)
+        goto bad;
+    memcpy(ctx->block, state + SHA256_STATE_LEN, ctx->used);
+    return 0;
+
+bad:
+    PyErr_SetString(PyExc_ValueError, "bad SHA-256 state");
+    return -1;
+}
+
+static PyObject *
+sha256_save(const sha256_ctx *ctx)
+{
+    PyObject *result = PyBytes_FromStringAndSize(NULL, SHA256_STATE_LEN + ctx->used);
+    uint8_t *state;
+    int i;
+
+    if (!result)
+        return NULL;
+    state = (uint8_t *)PyBytes_AS_STRING(result);
+    for (i = 0; i < 8; i++) {
+        state[i * 4] = (uint8_t)(ctx->state[i] >> 24);
+        state[i * 4 + 1] = (uint8_t)(ctx->state[i] >> 16);
+        state[i * 4 + 2] = (uint8_t)(ctx->state[i] >> 8);
+        state[i * 4 + 3] = (uint8_t)ctx->state[i];
+    }
+    for (i = 0; i < 8; i++)
+        state[32 + i] = (uint8_t)(ctx->length >> (56 - i * 8));
+    memcpy(state + SHA256_STATE_LEN, ctx->block, ctx->used);
+    return result;
+}
+
+/* The double SHA-256 of the data fed to ctx */
+static void
+sha256_final_double(sha256_ctx *ctx, uint8_t *digest)
+{
+    uint8_t first[32];
+    sha256_final(ctx, first);
+    sha256(first, 32, digest);
+}
+
+
+/* --- Reading serialized data */
+
+typedef struct {
+    const uint8_t *data;
+    Py_ssize_t len;
+    Py_ssize_t pos;
+} reader;
+
+static uint32_t
+le_uint32(const uint8_t *p)
+{
+    return (uint32_t)p[0] | ((uint32_t)p[1] << 8) | ((uint32_t)p[2] << 16)
+        | ((uint32_t)p[3] << 24);
+}
+
+static uint64_t
+le_uint64(const uint8_t *p)
+{
+    return (uint64_t)le_uint32(p) | ((uint64_t)le_uint32(p + 4) << 32);
+}
+
+static void
+pack_le_uint32(uint8_t *p, uint32_t n)
+{
+    p[0] = (uint8_t)n;
+    p[1] = (uint8_t)(n >> 8);
+    p[2] = (uint8_t)(n >> 16);
+    p[3] = (uint8_t)(n >> 24);
+}
+
+/* Return a pointer to the next n bytes, or NULL if truncated */
+static const uint8_t *
+read_nbytes(reader *r, uint64_t n)
+{
+    const uint8_t *result;
+
+    if (n > (uint64_t)(r->len - r->pos))
+        return NULL;
+    result = r->data + r->pos;
+    r->pos += (Py_ssize_t)n;
+    return result;
+}
+
+static int
+read_varint(reader *r, uint64_t *n)
+{
+    const uint8_t *p = read_nbytes(r, 1);
+
+    if (!p)
+        return 0;
+    if (*p < 253) {
+        *n = *p;
+        return 1;
+    }
+    if (*p == 253) {
+        if (!(p = read_nbytes(r, 2)))
+            return 0;
+        *n = (uint64_t)p[0] | ((uint64_t)p[1] << 8);
+    }
+    else if (*p == 254) {
+        if (!(p = read_nbytes(r, 4)))
+            return 0;
+        *n = le_uint32(p);
+    }
+    else {
+        if (!(p = read_nbytes(r, 8)))
+            return 0;
+        *n = le_uint64(p);
+    }
+    return 1;
+}
+
+static int
+read_varbytes(reader *r, const uint8_t **bytes, uint64_t *len)
+{
+    return read_varint(r, len) && (*bytes = read_nbytes(r, *len)) != NULL;
+}
+
+
+/* --- Push input refs */
+
+/* Scan a script for the refs pushed by OP_PUSHINPUTREF and
+   OP_PUSHINPUTREFSINGLETON.  If refs is not NULL it must have room for
+   len / PUSH_REF_LEN pointers to them.  Returns the number of refs, or
+   -1 if the script is truncated. */
+static Py_ssize_t
+scan_push_refs(const uint8_t *script, Py_ssize_t len, const uint8_t **refs)
+{
+    Py_ssize_t n = 0, count = 0;
+    uint64_t dlen;
+
+    while (n < len) {
+        uint8_t op = script[n++];
+
+        if (op <= OP_PUSHDATA4) {
+            if (op < OP_PUSHDATA1)
+                dlen = op;
+            else if (op == OP_PUSHDATA1) {
+                if (n + 1 > len)
+                    return -1;
+                dlen = script[n];
+                n += 1;
+            }
+            else if (op == OP_PUSHDATA2) {
+                if (n + 2 > len)
+                    return -1;
+                dlen = (uint64_t)script[n] | ((uint64_t)script[n + 1] << 8);
+                n += 2;
+            }
+            else {
+                if (n + 4 > len)
+                    return -1;
+                dlen = le_uint32(script + n);
+                n += 4;
+            }
+            if (dlen > (uint64_t)(len - n))
+                return -1;
+            n += (Py_ssize_t)dlen;
+        }
+        else if (op == OP_PUSHINPUTREF || op == OP_REQUIREINPUTREF
+                 || op == OP_DISALLOWPUSHINPUTREF
+                 || op == OP_DISALLOWPUSHINPUTREFSIBLING
+                 || op == OP_PUSHINPUTREFSINGLETON) {
+            if (PUSH_REF_LEN > len - n)
+                return -1;
+            if (op == OP_PUSHINPUTREF || op == OP_PUSHINPUTREFSINGLETON) {
+                if (refs)
+                    refs[count] = script + n;
+                count++;
+            }
+            n += PUSH_REF_LEN;
+        }
+    }
+    return count;
+}
+
+static int
+compare_refs(const void *a, const void *b)
+{
+    return memcmp(*(const uint8_t * const *)a, *(const uint8_t * const *)b,
+                  PUSH_REF_LEN);
+}
+
+/* Write the 36-byte push refs count and hash of a v3 txid output.  Returns
+   0 on success, or -1 with a Python exception set. */
+static int
+push_refs_summary(const uint8_t *script, Py_ssize_t len, uint8_t *summary)
+{
+    const uint8_t **refs;
+    Py_ssize_t count, i;
+    sha256_ctx ctx;
+
+    memset(summary, 0, 36);
+    /* Only these opcodes push refs; see tx.push_refs_summary() */
+    if (!memchr(script, OP_PUSHINPUTREF, len)
+            && !memchr(script, OP_PUSHINPUTREFSINGLETON, len))
+        return 0;
+
+    refs = PyMem_Malloc(sizeof(*refs) * (len / PUSH_REF_LEN + 1));
+    if (!refs) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    count = scan_push_refs(script, len, refs);
+    if (count < 0) {
+        PyMem_Free(refs);
+        PyErr_SetString(PyExc_ValueError, "truncated script");
+        return -1;
+    }
+    if (count) {
+        qsort(refs, count, sizeof(*refs), compare_refs);
+        sha256_init(&ctx);
+        for (i = 0; i < count; i++)
+            sha256_update(&ctx, refs[i], PUSH_REF_LEN);
+        pack_le_uint32(summary, (uint32_t)count);
+        sha256_final_double(&ctx, summary + 4);
+    }
+    PyMem_Free(refs);
+    return 0;
+}
+
+
+/* --- Transactions */
+
+static const uint8_t ZERO_HASH[32];
+
+static int
+is_unspendable(const uint8_t *script, uint64_t len, int legacy)
+{
+    /* OP_FALSE OP_RETURN, or before genesis activation also OP_RETURN */
+    if (len >= 2 && script[0] == 0 && script[1] == OP_RETURN)
+        return 1;
+    return legacy && len && script[0] == OP_RETURN;
+}
+
+static PyObject *
+truncated(void)
+{
+    PyErr_SetString(PyExc_ValueError, "truncated transaction");
+    return NULL;
+}
+
+/* Append a new reference to item to list */
+static int
+append_new(PyObject *list, PyObject *item)
+{
+    int result;
+
+    if (!item)
+        return -1;
+    result = PyList_Append(list, item);
+    Py_DECREF(item);
+    return result;
+}
+
+/* Read a transaction and return its (tx_hash, prevouts, outputs) digest */
+static PyObject *
+digest_tx(reader *r, int legacy)
+{
+    Py_ssize_t start = r->pos;
+    const uint8_t *p, *script;
+    uint64_t n_inputs, n_outputs, script_len, i;
+    uint8_t tx_hash[32], script_hash[32], summary[36];
+    uint8_t preimage[4 + 4 + 32 + 32 + 4 + 32 + 4];
+    sha256_ctx prev_inputs, sequences, output_hashes;
+    PyObject *prevouts = NULL, *outputs = NULL, *output;
+    int v3;
+
+    if (!(p = read_nbytes(r, 4)))
+        return truncated();
+    v3 = (int32_t)le_uint32(p) == 3;
+    if (v3) {
+        memcpy(preimage, p, 4);
+        sha256_init(&prev_inputs);
+        sha256_init(&sequences);
+        sha256_init(&output_hashes);
+    }
+
+    if (!read_varint(r, &n_inputs) || n_inputs > (uint64_t)(r->len - r->pos))
+        return truncated();
+    if (!(prevouts = PyList_New(0)))
+        return NULL;
+    for (i = 0; i < n_inputs; i++) {
+        const uint8_t *outpoint = read_nbytes(r, OUTPOINT_LEN);
+        if (!outpoint || !read_varbytes(r, &script, &script_len)
+                || !(p = read_nbytes(r, 4))) {
+            truncated();
+            goto error;
+        }
+        if (v3) {
+            double_sha256(script, script_len, script_hash);
+            sha256_update(&prev_inputs, outpoint, OUTPOINT_LEN);
+            sha256_update(&prev_inputs, script_hash, 32);
+            sha256_update(&sequences, p, 4);
+        }
+        /* Drop generation-like inputs */
+        if (le_uint32(outpoint + 32) == 0xffffffff && !memcmp(outpoint, ZERO_HASH, 32))
+            continue;
+        if (append_new(prevouts, PyBytes_FromStringAndSize((const char *)outpoint,
+                                                           OUTPOINT_LEN)))
+            goto error;
+    }
+
+    if (!read_varint(r, &n_outputs) || n_outputs > (uint64_t)(r->len - r->pos)) {
+        truncated();
+        goto error;
+    }
+    if (!(outputs = PyList_New(0)))
+        goto error;
+    for (i = 0; i < n_outputs; i++) {
+        const uint8_t *value = read_nbytes(r, 8);
+        if (!value || !read_varbytes(r, &script, &script_len)) {
+            truncated();
+            goto error;
+        }
+        if (v3) {
+            if (push_refs_summary(script, (Py_ssize_t)script_len, summary))
+                goto error;
+            double_sha256(script, script_len, script_hash);
+            sha256_update(&output_hashes, value, 8);
+            sha256_update(&output_hashes, script_hash, 32);
+            sha256_update(&output_hashes, summary, 36);
+        }
+        if (is_unspendable(script, script_len, legacy))
+            continue;
+        sha256(script, script_len, script_hash);
+        output = Py_BuildValue("(Ky#L)", (unsigned long long)i, script_hash,
+                               (Py_ssize_t)HASHX_LEN, (long long)le_uint64(value));
+        if (append_new(outputs, output))
+            goto error;
+    }
+
+    if (!(p = read_nbytes(r, 4))) {
+        truncated();
+        goto error;
+    }
+
+    if (v3) {
+        pack_le_uint32(preimage + 4, (uint32_t)n_inputs);
+        sha256_final_double(&prev_inputs, preimage + 8);
+        sha256_final_double(&sequences, preimage + 40);
+        pack_le_uint32(preimage + 72, (uint32_t)n_outputs);
+        sha256_final_double(&output_hashes, preimage + 76);
+        memcpy(preimage + 108, p, 4);
+        double_sha256(preimage, sizeof(preimage), tx_hash);
+    }
+    else
+        double_sha256(r->data + start, r->pos - start, tx_hash);
+
+    return Py_BuildValue("(y#NN)", tx_hash, (Py_ssize_t)32, prevouts, outputs);
+
+error:
+    Py_XDECREF(prevouts);
+    Py_XDECREF(outputs);
+    return NULL;
+}
+
+
+/* --- Module functions */
+
+PyDoc_STRVAR(digest_txs_doc,
+"digest_txs(raw_block, start, legacy)\n\
+\n\
+Return a list of (tx_hash, prevouts, outputs) digests of the transactions\n\
+of raw_block that begin at offset start, as Coin.digest_txs().");
+
+static PyObject *
+fastparse_digest_txs(PyObject *self, PyObject *args)
+{
+    Py_buffer buffer;
+    Py_ssize_t start;
+    int legacy;
+    uint64_t count, i;
+    reader r;
+    PyObject *txs = NULL;
+
+    if (!PyArg_ParseTuple(args, "y*np:digest_txs", &buffer, &start, &legacy))
+        return NULL;
+    if (start < 0 || start > buffer.len) {
+        PyErr_SetString(PyExc_ValueError, "start out of range");
+        goto done;
+    }
+    r.data = buffer.buf;
+    r.len = buffer.len;
+    r.pos = start;
+    if (!read_varint(&r, &count) || count > (uint64_t)(r.len - r.pos)) {
+        truncated();
+        goto done;
+    }
+    if (!(txs = PyList_New(0)))
+        goto done;
+    for (i = 0; i < count; i++) {
+        if (append_new(txs, digest_tx(&r, legacy))) {
+            Py_CLEAR(txs);
+            break;
+        }
+    }
+
+done:
+    PyBuffer_Release(&buffer);
+    return txs;
+}
+
+PyDoc_STRVAR(get_push_input_refs_doc,
+"get_push_input_refs(script)\n\
+\n\
+Return the list of refs pushed by a script, in order, as\n\
+Script.get_push_input_refs().  Raises ValueError if the script is truncated.");
+
+static PyObject *
+fastparse_get_push_input_refs(PyObject *self, PyObject *args)
+{
+    Py_buffer buffer;
+    const uint8_t **refs;
+    Py_ssize_t count, i;
+    PyObject *result = NULL;
+
+    if (!PyArg_ParseTuple(args, "y*:get_push_input_refs", &buffer))
+        return NULL;
+    refs = PyMem_Malloc(sizeof(*refs) * (buffer.len / PUSH_REF_LEN + 1));
+    if (!refs) {
+        PyErr_NoMemory();
+        goto done;
+    }
+    count = scan_push_refs(buffer.buf, buffer.len, refs);
+    if (count < 0) {
+        PyErr_SetString(PyExc_ValueError, "truncated script");
+        goto done;
+    }
+    if (!(result = PyList_New(count)))
+        goto done;
+    for (i = 0; i < count; i++) {
+        PyObject *ref = PyBytes_FromStringAndSize((const char *)refs[i], PUSH_REF_LEN);
+        if (!ref) {
+            Py_CLEAR(result);
+            goto done;
+        }
+        PyList_SET_ITEM(result, i, ref);
+    }
+
+done:
+    PyMem_Free(refs);
+    PyBuffer_Release(&buffer);
+    return result;
+}
+
+
+/* --- UTXO DB records */
+
+/* Write the "h" and "u" table records of a UTXO cache entry.
+
+     h record: b'h' + tx_hash[:4] + tx_idx + tx_num, hashX
+     u record: b'u' + hashX + tx_idx + tx_num, value
+*/
+static void
+write_utxo_records(const uint8_t *key, const uint8_t *value, uint8_t *h, uint8_t *u)
+{
+    const uint8_t *hashX = value, *tx_num = value + HASHX_LEN;
+    const uint8_t *tx_idx = key + 32;
+
+    h[0] = 'h';
+    memcpy(h + 1, key, 4);
+    memcpy(h + 5, tx_idx, 4);
+    memcpy(h + 9, tx_num, 5);
+    memcpy(h + H_KEY_LEN, hashX, HASHX_LEN);
+
+    u[0] = 'u';
+    memcpy(u + 1, hashX, HASHX_LEN);
+    memcpy(u + 1 + HASHX_LEN, tx_idx, 4);
+    memcpy(u + 5 + HASHX_LEN, tx_num, 5);
+    memcpy(u + U_KEY_LEN, value + HASHX_LEN + 5, 8);
+}
+
+/* Keys are unique so comparing whole records orders them by key */
+static int
+compare_h_records(const void *a, const void *b)
+{
+    return memcmp(a, b, H_RECORD_LEN);
+}
+
+static int
+compare_u_records(const void *a, const void *b)
+{
+    return memcmp(a, b, U_RECORD_LEN);
+}
+
+/* Sort the records written to h_records and u_records and return them as a
+   pair.  Steals both references. */
+static PyObject *
+sorted_utxo_records(PyObject *h_records, PyObject *u_records, Py_ssize_t count)
+{
+    char *h = PyBytes_AS_STRING(h_records), *u = PyBytes_AS_STRING(u_records);
+
+    Py_BEGIN_ALLOW_THREADS
+    qsort(h, count, H_RECORD_LEN, compare_h_records);
+    qsort(u, count, U_RECORD_LEN, compare_u_records);
+    Py_END_ALLOW_THREADS
+    return Py_BuildValue("(NN)", h_records, u_records);
+}
+
+static PyObject *
+new_utxo_records(Py_ssize_t count, PyObject **u_records)
+{
+    PyObject *h_records = PyBytes_FromStringAndSize(NULL, count * H_RECORD_LEN);
+
+    if (!h_records)
+        return NULL;
+    *u_records = PyBytes_FromStringAndSize(NULL, count * U_RECORD_LEN);
+    if (!*u_records)
+        Py_CLEAR(h_records);
+    return h_records;
+}
+
+PyDoc_STRVAR(utxo_records_doc,
+"utxo_records(adds)\n\
+\n\
+Return the \"h\" and \"u\" table records of the UTXOs in the dictionary adds\n\
+as a pair of byte strings, as utxo_cache.py_utxo_records().");
+
+static PyObject *
+fastparse_utxo_records(PyObject *self, PyObject *args)
+{
+    PyObject *adds, *key, *value, *h_records, *u_records;
+    Py_ssize_t pos = 0, n = 0, count;
+
+    if (!PyArg_ParseTuple(args, "O!:utxo_records", &PyDict_Type, &adds))
+        return NULL;
+    count = PyDict_Size(adds);
+    if (!(h_records = new_utxo_records(count, &u_records)))
+        return NULL;
+    while (PyDict_Next(adds, &pos, &key, &value)) {
+        if (!PyBytes_Check(key) || PyBytes_GET_SIZE(key) != OUTPOINT_LEN
+                || !PyBytes_Check(value) || PyBytes_GET_SIZE(value) != UTXO_VALUE_LEN) {
+            PyErr_SetString(PyExc_ValueError, "bad UTXO cache entry");
+            Py_DECREF(h_records);
+            Py_DECREF(u_records);
+            return NULL;
+        }
+        write_utxo_records((const uint8_t *)PyBytes_AS_STRING(key),
+                           (const uint8_t *)PyBytes_AS_STRING(value),
+                           (uint8_t *)PyBytes_AS_STRING(h_records) + n * H_RECORD_LEN,
+                           (uint8_t *)PyBytes_AS_STRING(u_records) + n * U_RECORD_LEN);
+        n++;
+    }
+    return sorted_utxo_records(h_records, u_records, n);
+}
+
+PyDoc_STRVAR(utxo_table_records_doc,
+"utxo_table_records(tags, keys, values)\n\
+\n\
+Return the \"h\" and \"u\" table records of the occupied slots of a\n\
+CompactUTXOCache's tables as a pair of byte strings, as\n\
+utxo_cache.py_utxo_records().  Slots with a tag below 2 are unoccupied.");
+
+static PyObject *
+fastparse_utxo_table_records(PyObject *self, PyObject *args)
+{
+    Py_buffer tags, keys, values;
+    PyObject *h_records = NULL, *u_records = NULL, *result = NULL;
+    const uint8_t *tag;
+    Py_ssize_t slot, n = 0, count = 0;
+
+    if (!PyArg_ParseTuple(args, "y*y*y*:utxo_table_records", &tags, &keys, &values))
+        return NULL;
+    if (keys.len != tags.len * OUTPOINT_LEN || values.len != tags.len * UTXO_VALUE_LEN) {
+        PyErr_SetString(PyExc_ValueError, "table sizes do not match");
+        goto done;
+    }
+    tag = tags.buf;
+    for (slot = 0; slot < tags.len; slot++)
+        count += tag[slot] > 1;
+    if (!(h_records = new_utxo_records(count, &u_records)))
+        goto done;
+    for (slot = 0; slot < tags.len; slot++) {
+        if (tag[slot] > 1) {
+            write_utxo_records((const uint8_t *)keys.buf + slot * OUTPOINT_LEN,
+                               (const uint8_t *)values.buf + slot * UTXO_VALUE_LEN,
+                               (uint8_t *)PyBytes_AS_STRING(h_records) + n * H_RECORD_LEN,
+                               (uint8_t *)PyBytes_AS_STRING(u_records) + n * U_RECORD_LEN);
+            n++;
+        }
+    }
+    result = sorted_utxo_records(h_records, u_records, count);
+
+done:
+    PyBuffer_Release(&tags);
+    PyBuffer_Release(&keys);
+    PyBuffer_Release(&values);
+    return result;
+}
+
+PyDoc_STRVAR(sha256_update_doc,
+"sha256_update(state, data)\n\
+\n\
+Return the SHA-256 state after hashing data, as hash.py_sha256_update().");
+
+static PyObject *
+fastparse_sha256_update(PyObject *self, PyObject *args)
+{
+    Py_buffer state, data;
+    PyObject *result = NULL;
+    sha256_ctx ctx;
+
+    if (!PyArg_ParseTuple(args, "y*y*:sha256_update", &state, &data))
+        return NULL;
+    if (sha256_load(&ctx, state.buf, state.len) == 0) {
+        sha256_update(&ctx, data.buf, (size_t)data.len);
+        result = sha256_save(&ctx);
+    }
+    PyBuffer_Release(&state);
+    PyBuffer_Release(&data);
+    return result;
+}
+
+PyDoc_STRVAR(sha256_finish_doc,
+"sha256_finish(state, data)\n\
+\n\
+Return the SHA-256 digest of the data hashed into state followed by data,\n\
+as hash.py_sha256_finish().");
+
+static PyObject *
+fastparse_sha256_finish(PyObject *self, PyObject *args)
+{
+    Py_buffer state, data;
+    PyObject *result = NULL;
+    sha256_ctx ctx;
+    uint8_t digest[32];
+
+    if (!PyArg_ParseTuple(args, "y*y*:sha256_finish", &state, &data))
+        return NULL;
+    if (sha256_load(&ctx, state.buf, state.len) == 0) {
+        sha256_update(&ctx, data.buf, (size_t)data.len);
+        sha256_final(&ctx, digest);
+        result = PyBytes_FromStringAndSize((const char *)digest, 32);
+    }
+    PyBuffer_Release(&state);
+    PyBuffer_Release(&data);
+    return result;
+}
+
+
+/* --- History rows */
+
+PyDoc_STRVAR(pack_history_doc,
+"pack_history(tx_nums)\n\
+\n\
+Return the history row of tx_nums, a buffer of unsigned 64-bit integers in\n\
+ascending order such as an array('Q'), as history.py_pack_history().");
+
+static PyObject *
+fastparse_pack_history(PyObject *self, PyObject *args)
+{
+    Py_buffer tx_nums;
+    PyObject *result = NULL;
+    const uint64_t *tx_num;
+    uint64_t prior = 0, delta;
+    Py_ssize_t count, n;
+    uint8_t *out, *p;
+
+    if (!PyArg_ParseTuple(args, "y*:pack_history", &tx_nums))
+        return NULL;
+    if (tx_nums.itemsize != 8 || tx_nums.len % 8) {
+        PyErr_SetString(PyExc_ValueError, "tx_nums must be 64-bit integers");
+        goto done;
+    }
+    count = tx_nums.len / 8;
+    tx_num = tx_nums.buf;
+    /* A varint is at most 10 bytes */
+    if (!(out = PyMem_Malloc(count * 10 + 1))) {
+        PyErr_NoMemory();
+        goto done;
+    }
+    p = out;
+    for (n = 0; n < count; n++) {
+        if (tx_num[n] < prior) {
+            PyErr_SetString(PyExc_ValueError, "tx_nums are not in order");
+            PyMem_Free(out);
+            goto done;
+        }
+        delta = tx_num[n] - prior;
+        prior = tx_num[n];
+        while (delta > 0x7f) {
+            *p++ = (uint8_t)(delta | 0x80);
+            delta >>= 7;
+        }
+        *p++ = (uint8_t)delta;
+    }
+    result = PyBytes_FromStringAndSize((const char *)out, p - out);
+    PyMem_Free(out);
+
+done:
+    PyBuffer_Release(&tx_nums);
+    return result;
+}
+
+PyDoc_STRVAR(unpack_history_doc,
+"unpack_history(row)\n\
+\n\
+Return the tx_nums of a history row as a byte string of native unsigned\n\
+64-bit integers, for array('Q').frombytes(), as history.py_unpack_history().");
+
+static PyObject *
+fastparse_unpack_history(PyObject *self, PyObject *args)
+{
+    Py_buffer row;
+    PyObject *result = NULL;
+    const uint8_t *p, *end;
+    uint64_t tx_num = 0, delta, *out;
+    Py_ssize_t count = 0, n;
+    int shift;
+
+    if (!PyArg_ParseTuple(args, "y*:unpack_history", &row))
+        return NULL;
+    p = row.buf;
+    end = p + row.len;
+    /* Each varint ends with a byte below 0x80 */
+    for (n = 0; n < row.len; n++)
+        count += p[n] < 0x80;
+    if (!(result = PyBytes_FromStringAndSize(NULL, count * 8)))
+        goto done;
+    out = (uint64_t *)PyBytes_AS_STRING(result);
+    while (p < end) {
+        delta = 0;
+        shift = 0;
+        for (;;) {
+            if (p == end || shift > 63) {
+                PyErr_SetString(PyExc_ValueError, "bad history row");
+                Py_CLEAR(result);
+                goto done;
+            }
+            delta |= (uint64_t)(*p & 0x7f) << shift;
+            shift += 7;
+            if (*p++ < 0x80)
+                break;
+        }
+        tx_num += delta;
+        *out++ = tx_num;
+    }
+
+done:
+    PyBuffer_Release(&row);
+    return result;
+}
+
+static PyMethodDef fastparse_methods[] = {
+    {"digest_txs", fastparse_digest_txs, METH_VARARGS, digest_txs_doc},
+    {"get_push_input_refs", fastparse_get_push_input_refs, METH_VARARGS,
+     get_push_input_refs_doc},
+    {"utxo_records", fastparse_utxo_records, METH_VARARGS, utxo_records_doc},
+    {"utxo_table_records", fastparse_utxo_table_records, METH_VARARGS,
+     utxo_table_records_doc},
+    {"sha256_update", fastparse_sha256_update, METH_VARARGS, sha256_update_doc},
+    {"sha256_finish", fastparse_sha256_finish, METH_VARARGS, sha256_finish_doc},
+    {"pack_history", fastparse_pack_history, METH_VARARGS, pack_history_doc},
+    {"unpack_history", fastparse_unpack_history, METH_VARARGS, unpack_history_doc},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef fastparse_module = {
+    PyModuleDef_HEAD_INIT,
+    "_fastparse",
+    "Optional C implementations of block parsing, hashing and flushing.",
+    -1,
+    fastparse_methods
+};
+
+PyMODINIT_FUNC
+PyInit__fastparse(void)
+{
+    return PyModule_Create(&fastparse_module);
+}
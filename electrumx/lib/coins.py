@@ -38,14 +38,24 @@ from hashlib import sha256
 from electrumx.lib import util
 from electrumx.lib.hash import Base58, double_sha256, double_sha512_256, hash_to_hex_str
 from electrumx.lib.hash import HASHX_LEN
-from electrumx.lib.script import ScriptPubKey
+from electrumx.lib.script import ScriptPubKey, is_unspendable_genesis, is_unspendable_legacy
 import electrumx.lib.tx as lib_tx
 import electrumx.server.block_processor as block_proc
 from electrumx.server import daemon
 from electrumx.server.session import ElectrumX
 
+try:
+    from electrumx.lib import _fastparse
+except ImportError:
+    _fastparse = None
+
 
 Block = namedtuple("Block", "raw header transactions")
+# A block reduced to what the block processor needs to update UTXO and history state.
+# txs is a list of (tx_hash, prevouts, outputs) triples; prevouts are the 36-byte
+# prev_hash + prev_idx keys of the non-generation inputs, and outputs is a list of
+# (tx_idx, hashX, value) triples of the spendable outputs.
+DigestedBlock = namedtuple("DigestedBlock", "header txs")
 
 
 class CoinError(Exception):
@@ -64,6 +74,11 @@ class Coin:
     SESSIONCLS = ElectrumX
     DEFAULT_MAX_SEND = 10000000
     DESERIALIZER = lib_tx.Deserializer
+    # Used where only parts of transactions are kept, to avoid copying the rest
+    VIEW_DESERIALIZER = lib_tx.DeserializerView
+    # If the optional C extension is built, use it to digest blocks.  Coins that
+    # override VIEW_DESERIALIZER or hashX_from_script must set this False.
+    FAST_DIGEST = True
     DAEMON = daemon.Daemon
     BLOCK_PROCESSOR = block_proc.BlockProcessor
     P2PKH_VERBYTE = bytes.fromhex("00")
@@ -108,12 +123,6 @@ class Coin:
             url = 'http://' + url
         return url + '/'
 
-    @classmethod
-    def max_fetch_blocks(cls, height):
-        if height < 130000:
-            return 1000
-        return 100
-
     @classmethod
     def genesis_block(cls, block):
         '''Check the Genesis block is the right one for this coin.
@@ -184,6 +193,41 @@ class Coin:
         txs = cls.DESERIALIZER(raw_block, start=len(header)).read_tx_block()
         return Block(raw_block, header, txs)
 
+    @classmethod
+    def digest_block(cls, raw_block, height):
+        '''Return a DigestedBlock given a raw block and its height.
+
+        This is run in worker processes during sync, so it must be a pure function of
+        its arguments and return compact, picklable data.
+        '''
+        header = raw_block[:80]
+        legacy = height < cls.GENESIS_ACTIVATION
+        if cls.FAST_DIGEST and _fastparse:
+            txs = _fastparse.digest_txs(raw_block, len(header), legacy)
+        else:
+            txs = cls.digest_txs(raw_block, len(header), legacy)
+        return DigestedBlock(header, txs)
+
+    @classmethod
+    def digest_txs(cls, raw_block, start, legacy):
+        '''Return the DigestedBlock txs of the transactions of raw_block beginning at
+        offset start.  If legacy, pre-genesis rules determine unspendable outputs.'''
+        transactions = cls.VIEW_DESERIALIZER(raw_block, start=start).read_tx_block()
+        is_unspendable = is_unspendable_legacy if legacy else is_unspendable_genesis
+        hashX_from_script = cls.hashX_from_script
+        to_le_uint32 = util.pack_le_uint32
+        join = b''.join
+        txs = []
+        for tx, tx_hash in transactions:
+            # Copy the 36-byte outpoint keys; scripts are only hashed
+            prevouts = [join((txin.prev_hash, to_le_uint32(txin.prev_idx)))
+                        for txin in tx.inputs if not txin.is_generation()]
+            outputs = [(idx, hashX_from_script(txout.pk_script), txout.value)
+                       for idx, txout in enumerate(tx.outputs)
+                       if not is_unspendable(txout.pk_script)]
+            txs.append((tx_hash, prevouts, outputs))
+        return txs
+
     @classmethod
     def decimal_value(cls, value):
         '''Return the number of standard coin units as a Decimal given a
@@ -251,11 +295,6 @@ class RadiantScalingTestnet(RadiantTestnet):
     GENESIS_ACTIVATION = 0
     RPC_PORT = 37332 
 
-    @classmethod
-    def max_fetch_blocks(cls, height):
-        if height <= 10:
-            return 100
-        return 3
 
 class RadiantRegtest(RadiantTestnet):
     NET = "regtest"
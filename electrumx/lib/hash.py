@@ -80,9 +80,15 @@
 
 import hashlib
 import hmac
+from struct import Struct
 
 from electrumx.lib.util import bytes_to_int, int_to_bytes, hex_to_bytes
 from Crypto.Hash import SHA512
+
+try:
+    from electrumx.lib import _fastparse
+except ImportError:
+    _fastparse = None
 _sha256 = hashlib.sha256
 _new_hash = hashlib.new
 _new_hmac = hmac.new
@@ -105,14 +111,98 @@ def double_sha256(x):
     '''SHA-256 of SHA-256, as used extensively in bitcoin.'''
     return sha256(sha256(x))
 
-def double_sha512_256(x):
-    '''SHA-512/256 of SHA-512/256, as used extensively in radiant.'''
+def py_double_sha512_256(x):
+    '''SHA-512/256 of SHA-512/256 using PyCryptodome.'''
     h = SHA512.new(truncate="256")
     h.update(x)
     dh = SHA512.new(truncate="256")
     dh.update(h.digest())
     return dh.digest()
 
+
+# hashlib has SHA-512/256 if built with OpenSSL 1.1.1 or later, and is much faster
+if 'sha512_256' in hashlib.algorithms_available:
+    def double_sha512_256(x):
+        '''SHA-512/256 of SHA-512/256, as used extensively in radiant.'''
+        return _new_hash('sha512_256', _new_hash('sha512_256', x).digest()).digest()
+else:
+    double_sha512_256 = py_double_sha512_256
+
+# Resumable SHA-256.  hashlib cannot save its state, so a state that can be stored
+# and resumed later is kept as bytes: the eight state words and the length hashed,
+# big-endian, followed by the bytes of the unfinished block.
+_struct_sha256_state = Struct('>8IQ')
+_struct_sha256_block = Struct('>16I')
+_SHA256_K = (
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1,
+    0x923f82a4, 0xab1c5ed5, 0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3,
+    0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174, 0xe49b69c1, 0xefbe4786,
+    0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147,
+    0x06ca6351, 0x14292967, 0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13,
+    0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85, 0xa2bfe8a1, 0xa81a664b,
+    0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a,
+    0x5b9cca4f, 0x682e6ff3, 0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208,
+    0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2,
+)
+SHA256_INITIAL_STATE = _struct_sha256_state.pack(
+    0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a,
+    0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19, 0)
+
+
+def _sha256_compress(words, block):
+    '''Return the SHA-256 state words after compressing the 64-byte block.'''
+    w = list(_struct_sha256_block.unpack(block))
+    for i in range(16, 64):
+        x, y = w[i - 15], w[i - 2]
+        s0 = ((x >> 7 | x << 25) ^ (x >> 18 | x << 14) ^ (x >> 3)) & 0xffffffff
+        s1 = ((y >> 17 | y << 15) ^ (y >> 19 | y << 13) ^ (y >> 10)) & 0xffffffff
+        w.append((w[i - 16] + s0 + w[i - 7] + s1) & 0xffffffff)
+    a, b, c, d, e, f, g, h = words
+    for k, wi in zip(_SHA256_K, w):
+        s1 = (e >> 6 | e << 26) ^ (e >> 11 | e << 21) ^ (e >> 25 | e << 7)
+        t1 = h + (s1 & 0xffffffff) + ((e & f) ^ (~e & g)) + k + wi
+        s0 = (a >> 2 | a << 30) ^ (a >> 13 | a << 19) ^ (a >> 22 | a << 10)
+        t2 = (s0 & 0xffffffff) + ((a & b) ^ (a & c) ^ (b & c))
+        h, g, f, e = g, f, e, (d + t1) & 0xffffffff
+        d, c, b, a = c, b, a, (t1 + t2) & 0xffffffff
+    return [(x + y) & 0xffffffff for x, y in zip(words, (a, b, c, d, e, f, g, h))]
+
+
+def py_sha256_update(state, data):
+    '''Return the SHA-256 state after hashing data.  Start with
+    SHA256_INITIAL_STATE.'''
+    *words, length = _struct_sha256_state.unpack_from(state)
+    pending = state[_struct_sha256_state.size:] + data
+    end = len(pending) - len(pending) % 64
+    for start in range(0, end, 64):
+        words = _sha256_compress(words, pending[start: start + 64])
+    return _struct_sha256_state.pack(*words, length + len(data)) + pending[end:]
+
+
+def py_sha256_finish(state, data=b''):
+    '''Return the SHA-256 digest of what state has hashed followed by data.'''
+    length = _struct_sha256_state.unpack_from(state)[8] + len(data)
+    padding = b'\x80' + bytes((55 - length) % 64) + (length * 8).to_bytes(8, 'big')
+    state = py_sha256_update(state, data + padding)
+    return state[:32]
+
+
+if _fastparse:
+    def sha256_update(state, data):
+        '''Return the SHA-256 state after hashing data.  Start with
+        SHA256_INITIAL_STATE.'''
+        return _fastparse.sha256_update(state, data)
+
+    def sha256_finish(state, data=b''):
+        '''Return the SHA-256 digest of what state has hashed followed by data.'''
+        return _fastparse.sha256_finish(state, data)
+else:
+    sha256_update = py_sha256_update
+    sha256_finish = py_sha256_finish
+
+
 def hash_to_hex_str(x):
     '''Convert a big-endian binary hash to displayed hex string.
 
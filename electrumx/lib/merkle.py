@@ -224,6 +224,19 @@ class MerkleCache(object):
         self.level = self._level(await self.source_func(0, length))
         self.initialized.set()
 
+    async def initialize_from_level(self, length, level_length, depth_higher, level):
+        '''Call to initialize the cache to a source of given length from the
+        depth_higher and level of a cache of its first level_length hashes, for
+        example one saved earlier.  Only hashes not covered by the level are
+        read from the source.'''
+        self.length = level_length
+        self.depth_higher = depth_higher
+        self.level = list(level)
+        if length < level_length:
+            self.truncate(length)
+        await self._extend_to(length)
+        self.initialized.set()
+
     def truncate(self, length):
         '''Truncate the cache so it covers no more than length underlying
         hashes.'''
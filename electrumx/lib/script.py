@@ -33,6 +33,11 @@ from electrumx.lib.enum import Enumeration
 from electrumx.lib.util import unpack_le_uint16_from, unpack_le_uint32_from, \
     pack_le_uint16, pack_le_uint32
 
+try:
+    from electrumx.lib import _fastparse
+except ImportError:
+    _fastparse = None
+
 class ScriptError(Exception):
     '''Exception used for script errors.'''
 
@@ -249,6 +254,16 @@ class Script(object):
     # Saves the push input refs of a script in the order they were encountered
     @classmethod
     def get_push_input_refs(cls, script):
+        if _fastparse:
+            try:
+                return _fastparse.get_push_input_refs(script)
+            except ValueError:
+                raise ScriptError('get_push_input_refs script') from None
+        return cls.py_get_push_input_refs(script)
+
+    @classmethod
+    def py_get_push_input_refs(cls, script):
+        '''The pure Python implementation of get_push_input_refs.'''
         push_input_refs = []
 
         # The unpacks or script[n] below throw on truncated scripts
@@ -280,7 +295,7 @@ class Script(object):
                     dlen = 36 # Grab 36 bytes
                 
                     if op == OpCodes.OP_PUSHINPUTREF or op == OpCodes.OP_PUSHINPUTREFSINGLETON:
-                        push_input_refs.append(script[n:n + dlen]) 
+                        push_input_refs.append(bytes(script[n:n + dlen]))
 
                     if n + dlen > len(script):
                         raise IndexError
@@ -76,6 +76,7 @@
 
 '''Transaction-related classes and functions.'''
 
+import hashlib
 from collections import namedtuple
 
 from electrumx.lib.hash import double_sha256, hash_to_hex_str, sha256
@@ -83,11 +84,23 @@ from electrumx.lib.util import (
     unpack_le_int32_from, unpack_le_int64_from, unpack_le_uint16_from,
     unpack_be_uint16_from,
     unpack_le_uint32_from, unpack_le_uint64_from, pack_le_int32, pack_varint,
-    pack_le_uint32, pack_le_int64, pack_varbytes, pack_le_uint64
+    pack_le_uint32, pack_le_int64, pack_varbytes
 )
 from electrumx.lib.script import Script
 ZERO = bytes(32)
 MINUS_1 = 4294967295
+_sha256 = hashlib.sha256
+_NO_PUSH_REFS = pack_le_uint32(0) + ZERO
+
+
+def push_refs_summary(pk_script):
+    '''Return the count and hash of the push refs of an output script, as committed to
+    by a version 3 txid.'''
+    push_input_refs = Script.get_push_input_refs(pk_script)
+    if not push_input_refs:
+        return _NO_PUSH_REFS
+    return b''.join((pack_le_uint32(len(push_input_refs)),
+                     double_sha256(b''.join(sorted(push_input_refs)))))
 
 
 class Tx(namedtuple("Tx", "version inputs outputs locktime")):
@@ -166,81 +179,58 @@ class Deserializer(object):
         we process it in the natural serialized order.
         '''
         start = self.cursor
-        the_tx = self.read_tx()
         # If the transaction is version 3, then we use the alternative txid generation scheme
-        if the_tx.version == 3:
-            return the_tx, self.get_transaction_hash_preimage_v3(the_tx)
-        else:
-            return the_tx, double_sha256(self.binary[start:self.cursor])
-
-    # Get the double_sha256 of the transaction preimage used for generating the new txid
-    # The benefits of using version 3 is we can do compressed induction proofs
-    def get_transaction_hash_preimage_v3(self, tx):
-        hashPrevInputs = self.get_hash_prev_inputs(tx)
-        hashSequence = self.get_hash_sequence(tx)
-        hashOutputHashes = self.get_hash_output_hashes(tx)
+        if unpack_le_int32_from(self.binary, start)[0] == 3:
+            return self._read_tx_and_hash_v3()
+        return self.read_tx(), double_sha256(self.binary[start:self.cursor])
+
+    def _read_tx_and_hash_v3(self):
+        '''Return a (deserialized TX, tx_hash) pair for a version 3 transaction.
+
+        The txid is the double SHA-256 of a preimage committing to the outpoints and
+        script hashes of the inputs, their sequence numbers, and for each output its
+        value, script hash and push refs.  The benefit is compressed induction proofs.
+        The hashes of those lists are fed as the transaction is read.
+        '''
+        binary = self.binary
+        read_input = self._read_input
+        read_output = self._read_output
+        prev_inputs_hash = _sha256()
+        sequence_hash = _sha256()
+        output_hashes_hash = _sha256()
+
+        version = self._read_le_int32()
+        inputs = []
+        for _ in range(self._read_varint()):
+            start = self.cursor
+            txin = read_input()
+            # prev_hash + prev_idx
+            prev_inputs_hash.update(binary[start:start + 36])
+            prev_inputs_hash.update(double_sha256(txin.script))
+            sequence_hash.update(binary[self.cursor - 4:self.cursor])
+            inputs.append(txin)
+
+        outputs = []
+        for _ in range(self._read_varint()):
+            start = self.cursor
+            txout = read_output()
+            # value
+            output_hashes_hash.update(binary[start:start + 8])
+            output_hashes_hash.update(double_sha256(txout.pk_script))
+            output_hashes_hash.update(push_refs_summary(txout.pk_script))
+            outputs.append(txout)
+
+        locktime = self._read_le_uint32()
         preimage = b''.join((
-            pack_le_uint32(tx.version),
-            pack_le_int32(len(tx.inputs)),
-            hashPrevInputs,
-            hashSequence,
-            pack_le_int32(len(tx.outputs)),
-            hashOutputHashes,
-            pack_le_uint32(tx.locktime)
+            pack_le_uint32(version),
+            pack_le_int32(len(inputs)),
+            sha256(prev_inputs_hash.digest()),
+            sha256(sequence_hash.digest()),
+            pack_le_int32(len(outputs)),
+            sha256(output_hashes_hash.digest()),
+            pack_le_uint32(locktime)
         ))
-        h = double_sha256(preimage)
-        print("v3 txid: {}".format(h.hex()))
-        print("v3 pre: {}".format(preimage.hex()))
-        return h
-
- 
-    def get_hash_prev_inputs(self, tx):
-        inputs = b''
-        for txin in tx.inputs:
-            inputs = b''.join((
-                inputs,
-                txin.prev_hash,
-                pack_le_uint32(txin.prev_idx),
-                double_sha256(txin.script)
-            ))
-        h = double_sha256(inputs)
-        return h
- 
-    def get_hash_sequence(self, tx):
-        inputs = b''
-        for txin in tx.inputs:
-            inputs = b''.join((
-                inputs,
-                pack_le_uint32(txin.sequence)
-            ))
-        h = double_sha256(inputs)
-        return h
-
-    # Generate the hash of the output hashes
-    def calculate_pushrefs_count_and_hash(self, pk_script):
-        outputs = b''
-        zeroRef = b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
-        push_input_refs = Script.get_push_input_refs(pk_script)
-        if len(push_input_refs) > 0:
-            push_input_refs_hash = double_sha256(b''.join(sorted(push_input_refs)))
-        else:
-            push_input_refs_hash = zeroRef
-        
-        result = b''.join((pack_le_uint32(len(push_input_refs) ), push_input_refs_hash))
-        return result
-
-    # Generate the hash of the output hashes
-    def get_hash_output_hashes(self, tx):
-        outputs = b''
-        for txout in tx.outputs:
-            outputs = b''.join((
-                outputs,
-                pack_le_uint64(txout.value),
-                double_sha256(txout.pk_script),
-                self.calculate_pushrefs_count_and_hash(txout.pk_script),
-            ))
-        h = double_sha256(outputs)
-        return h
+        return Tx(version, inputs, outputs, locktime), double_sha256(preimage)
 
     def read_tx_and_vsize(self):
         '''Return a (deserialized TX, vsize) pair.'''
@@ -328,3 +318,18 @@ class Deserializer(object):
         result, = unpack_le_uint64_from(self.binary, self.cursor)
         self.cursor += 8
         return result
+
+
+class DeserializerView(Deserializer):
+    '''A Deserializer that reads a memoryview of the binary data.
+
+    The prev_hash, script and pk_script of the transactions it returns
+    are memoryview slices of the binary data rather than copies, and
+    transactions are hashed in place.  Callers must copy the pieces
+    they keep, and the binary data stays alive as long as any slice
+    does.
+    '''
+
+    def __init__(self, binary, start=0):
+        super().__init__(binary, start)
+        self.binary = memoryview(binary)
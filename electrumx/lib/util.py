@@ -31,7 +31,10 @@ import array
 import inspect
 from ipaddress import ip_address
 import logging
+import mmap
+import os
 import sys
+import threading
 from collections.abc import Container, Mapping
 from struct import Struct
 
@@ -227,6 +230,76 @@ class LogicalFile(object):
         return f
 
 
+class MappedLogicalFile(LogicalFile):
+    '''A LogicalFile read through memory maps of its files.
+
+    Files are mapped when first read and stay mapped, so reads are
+    slices that make no system calls.  Writes go through the file
+    system as for LogicalFile; a file they extend is remapped before
+    write() returns, so writes are immediately visible to readers.
+    '''
+
+    # Beyond this many mapped files the oldest mapping is dropped
+    MAX_MAPS = 256
+
+    def __init__(self, prefix, digits, file_size):
+        super().__init__(prefix, digits, file_size)
+        self.maps = {}
+        self.lock = threading.Lock()
+
+    def map_file(self, file_num):
+        '''Map the file and return the map, or None if the file does not
+        exist or is empty.'''
+        try:
+            with open(self.filename_fmt.format(file_num), 'rb') as f:
+                if not os.fstat(f.fileno()).st_size:
+                    return None
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            maps = self.maps
+            maps.pop(file_num, None)
+            while len(maps) >= self.MAX_MAPS:
+                # Readers still holding a map can use it; it is unmapped when freed
+                maps.pop(next(iter(maps)))
+            maps[file_num] = mapping
+        return mapping
+
+    def read(self, start, size=-1):
+        '''Read up to size bytes from the virtual file, starting at offset
+        start, and return them.
+
+        If size is -1 all bytes are read.'''
+        parts = []
+        file_size = self.file_size
+        while size != 0:
+            file_num, offset = divmod(start, file_size)
+            mapping = self.maps.get(file_num) or self.map_file(file_num)
+            if mapping is None:
+                break
+            part = mapping[offset:] if size < 0 else mapping[offset: offset + size]
+            if not part:
+                break
+            parts.append(part)
+            start += len(part)
+            if size > 0:
+                size -= len(part)
+        return b''.join(parts)
+
+    def write(self, start, b):
+        '''Write the bytes-like object, b, to the underlying virtual file.'''
+        super().write(start, b)
+        end = start + len(b)
+        file_size = self.file_size
+        for file_num in range(start // file_size, (end - 1) // file_size + 1):
+            mapping = self.maps.get(file_num)
+            # Writes within a mapping are already visible through it
+            if mapping is not None and len(mapping) < min(end - file_num * file_size,
+                                                          file_size):
+                self.map_file(file_num)
+
+
 def open_file(filename, create=False):
     '''Open the file name.  Return its handle.'''
     try:
@@ -10,42 +10,95 @@
 
 
 import asyncio
+import multiprocessing
+import sys
 import time
 from asyncio import sleep
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
-from aiorpcx import TaskGroup, CancelledError
+from aiorpcx import TaskGroup, CancelledError, run_in_thread
 
 import electrumx
 from electrumx.server.daemon import DaemonError
 from electrumx.lib.hash import hash_to_hex_str, HASHX_LEN
-from electrumx.lib.script import is_unspendable_legacy, is_unspendable_genesis
 from electrumx.lib.util import (
-    class_logger, pack_le_uint32, pack_le_uint64, unpack_le_uint64
+    class_logger, pack_le_uint32, pack_le_uint64, unpack_le_uint32
 )
 from electrumx.server.db import FlushData
+from electrumx.server.storage import StorageExecutor
+from electrumx.server.utxo_cache import utxo_cache_class
+
+
+# Memory used by the two DB keys of a spent UTXO awaiting deletion in db_deletes
+DB_DELETES_PAIR_SIZE = sys.getsizeof(bytes(14)) + sys.getsizeof(bytes(21)) + 16
+# The number of UTXOs each DB thread looks up at a time when reading spends
+DB_SPENDS_BATCH_SIZE = 2000
+# The most history prefixes compacted in each step of background compaction
+HISTORY_COMPACTION_PREFIXES = 16
+
+
+class StageStats:
+    '''Cumulative throughput of one stage of block processing.'''
+
+    def __init__(self):
+        self.count = 0
+        self.size = 0
+        self.elapsed = 0.0
+
+    def add(self, count, size, elapsed):
+        self.count += count
+        self.size += size
+        self.elapsed += elapsed
+
+    def rate(self):
+        '''Return the throughput in MB/s.'''
+        return self.size / 1_000_000 / self.elapsed if self.elapsed else 0.0
+
+    def info(self):
+        return {
+            'blocks': self.count,
+            'MB': round(self.size / 1_000_000, 2),
+            'seconds': round(self.elapsed, 2),
+            'MB/s': round(self.rate(), 2),
+        }
 
 
 class Prefetcher:
-    '''Prefetches blocks (in the forward direction only).'''
+    '''Prefetches blocks (in the forward direction only).
+
+    Several batches of blocks are fetched from the daemon concurrently.  Their blocks are
+    queued for the block processor in height order as each batch arrives, until the queue
+    plus the batches in flight reach the target cache size.
+    '''
 
     def __init__(self, daemon, coin, blocks_event):
         self.logger = class_logger(__name__, self.__class__.__name__)
         self.daemon = daemon
         self.coin = coin
         self.blocks_event = blocks_event
-        self.blocks = []
+        self.blocks = deque()
         self.caught_up = False
-        # Access to fetched_height should be protected by the semaphore
+        # The height of the last block requested from the daemon
         self.fetched_height = None
-        self.semaphore = asyncio.Semaphore()
+        # Incremented on each reset so that stale fetches are discarded
+        self.generation = 0
         self.refill_event = asyncio.Event()
-        # The prefetched block cache size.  The min cache size has
-        # little effect on sync time.
+        # The size of the blocks in the queue, and the target size of the queue plus
+        # the batches in flight.  The cache size has little effect on sync time once
+        # there is enough to keep the daemon busy.
         self.cache_size = 0
-        self.min_cache_size = 10 * 1024 * 1024
+        self.target_cache_size = 16 * 1024 * 1024
+        # Batches are sized by bytes from our recent average block size estimate, but
+        # limited in count to keep each daemon request reasonable
+        self.batch_size = 2 * 1024 * 1024
+        self.max_batch_count = 1000
+        self.max_fetches = 4
+        self.fetches = 0
         # This makes the first fetch be 10 blocks
-        self.ave_size = self.min_cache_size // 10
+        self.ave_size = self.batch_size // 10
         self.polling_delay = 5
+        self.fetch_stats = StageStats()
 
     async def main_loop(self, bp_height):
         '''Loop forever polling for more blocks.'''
@@ -65,25 +118,38 @@ class Prefetcher:
                 self.logger.exception('ignoring unexpected exception')
 
     def get_prefetched_blocks(self):
-        '''Called by block processor when it is processing queued blocks.'''
-        blocks = self.blocks
-        self.blocks = []
+        '''Called by block processor when it is processing queued blocks.
+
+        Returns the blocks queued so far in height order; later blocks continue to
+        arrive in the background.
+        '''
+        blocks = list(self.blocks)
+        self.blocks.clear()
         self.cache_size = 0
         self.refill_event.set()
         return blocks
 
+    def info(self):
+        '''Queue depth and fetch throughput, for getinfo.'''
+        return {
+            'queued blocks': len(self.blocks),
+            'queued MB': round(self.cache_size / 1_000_000, 2),
+            'fetches in flight': self.fetches,
+            'fetch': self.fetch_stats.info(),
+        }
+
     async def reset_height(self, height):
         '''Reset to prefetch blocks from the block processor's height.
 
-        Used in blockchain reorganisations.  This coroutine can be
-        called asynchronously to the _prefetch_blocks coroutine so we
-        must synchronize with a semaphore.
+        Used in blockchain reorganisations.  This coroutine can be called
+        asynchronously to the _prefetch_blocks coroutine, which abandons its fetches
+        in flight when it sees the generation has changed.
         '''
-        async with self.semaphore:
-            self.blocks.clear()
-            self.cache_size = 0
-            self.fetched_height = height
-            self.refill_event.set()
+        self.generation += 1
+        self.blocks.clear()
+        self.cache_size = 0
+        self.fetched_height = height
+        self.refill_event.set()
 
         daemon_height = await self.daemon.height()
         behind = daemon_height - height
@@ -95,38 +161,67 @@ class Prefetcher:
             self.logger.info('caught up to daemon height {:,d}'
                              .format(daemon_height))
 
+    async def _fetch_batch(self, first, count):
+        '''Fetch and return count blocks starting at height first.'''
+        daemon = self.daemon
+        hex_hashes = await daemon.block_hex_hashes(first, count)
+        if self.caught_up:
+            self.logger.info('new block height {:,d} hash {}'
+                             .format(first + count-1, hex_hashes[-1]))
+        blocks = await daemon.raw_blocks(hex_hashes)
+
+        assert count == len(blocks)
+
+        # Special handling for genesis block
+        if first == 0:
+            blocks[0] = self.coin.genesis_block(blocks[0])
+            self.logger.info('verified genesis block with hash {}'
+                             .format(hex_hashes[0]))
+        return blocks
+
     async def _prefetch_blocks(self):
         '''Prefetch some blocks and put them on the queue.
 
-        Repeats until the queue is full or caught up.
+        Repeats until the queue is full or caught up.  Returns False if caught up.
         '''
-        daemon = self.daemon
-        daemon_height = await daemon.height()
-        async with self.semaphore:
-            while self.cache_size < self.min_cache_size:
-                first = self.fetched_height + 1
-                # Try and catch up all blocks but limit to room in cache.
-                cache_room = max(self.min_cache_size // self.ave_size, 1)
-                count = min(daemon_height - self.fetched_height, cache_room)
-                # Don't make too large a request
-                count = min(self.coin.max_fetch_blocks(first), max(count, 0))
-                if not count:
-                    self.caught_up = True
-                    return False
-
-                hex_hashes = await daemon.block_hex_hashes(first, count)
-                if self.caught_up:
-                    self.logger.info('new block height {:,d} hash {}'
-                                     .format(first + count-1, hex_hashes[-1]))
-                blocks = await daemon.raw_blocks(hex_hashes)
-
-                assert count == len(blocks)
-
-                # Special handling for genesis block
-                if first == 0:
-                    blocks[0] = self.coin.genesis_block(blocks[0])
-                    self.logger.info('verified genesis block with hash {}'
-                                     .format(hex_hashes[0]))
+        daemon_height = await self.daemon.height()
+        generation = self.generation
+        # The height of the last block put on the queue
+        queued_height = self.fetched_height
+        fetches = deque()
+        in_flight_size = 0
+        start = time.monotonic()
+        try:
+            while True:
+                # Keep up to max_fetches batches in flight while there is room
+                while len(fetches) < self.max_fetches:
+                    room = self.target_cache_size - self.cache_size - in_flight_size
+                    # Try and catch up all blocks but limit to room in cache
+                    count = min(daemon_height - self.fetched_height,
+                                max(min(room, self.batch_size) // self.ave_size, 1),
+                                self.max_batch_count)
+                    if room <= 0 or count <= 0:
+                        break
+                    first = self.fetched_height + 1
+                    fetch = asyncio.ensure_future(self._fetch_batch(first, count))
+                    fetches.append((count, count * self.ave_size, fetch))
+                    in_flight_size += count * self.ave_size
+                    self.fetched_height += count
+                self.fetches = len(fetches)
+
+                if not fetches:
+                    if self.fetched_height >= daemon_height:
+                        self.caught_up = True
+                        return False
+                    self.refill_event.clear()
+                    return True
+
+                count, estimated_size, fetch = fetches[0]
+                blocks = await fetch
+                fetches.popleft()
+                in_flight_size -= estimated_size
+                if generation != self.generation:
+                    return True
 
                 # Update our recent average block size estimate
                 size = sum(len(block) for block in blocks)
@@ -134,14 +229,26 @@ class Prefetcher:
                     self.ave_size = size // count
                 else:
                     self.ave_size = (size + (10 - count) * self.ave_size) // 10
+                self.ave_size = max(self.ave_size, 1)
+
+                now = time.monotonic()
+                self.fetch_stats.add(count, size, now - start)
+                start = now
 
                 self.blocks.extend(blocks)
+                queued_height += count
                 self.cache_size += size
-                self.fetched_height += count
                 self.blocks_event.set()
-
-        self.refill_event.clear()
-        return True
+        finally:
+            # Only relevant if we stopped early on a reset or error
+            for _count, _size, fetch in fetches:
+                if not fetch.cancel() and not fetch.cancelled():
+                    # Mark any error as retrieved
+                    fetch.exception()
+            # Fetch the dropped batches again unless the height was reset
+            if fetches and generation == self.generation:
+                self.fetched_height = queued_height
+            self.fetches = 0
 
 
 class ChainError(Exception):
@@ -175,6 +282,13 @@ class BlockProcessor:
         self.coin = env.coin
         self.prefetcher = Prefetcher(daemon, env.coin, self.blocks_event)
         self.logger = class_logger(__name__, self.__class__.__name__)
+        # Worker processes that parse blocks and hash their transactions; None if
+        # blocks are digested in this process
+        self.executor = None
+
+        # Throughput of digesting blocks, and of applying them to the caches
+        self.parse_stats = StageStats()
+        self.process_stats = StageStats()
 
         # Meta
         self.next_cache_check = 0
@@ -190,9 +304,18 @@ class BlockProcessor:
         self.tx_hashes = []
         self.undo_infos = []
 
-        # UTXO cache
-        self.utxo_cache = {}
+        # UTXO cache.  UTXOs are flushed once they use 80% of the cache memory.
+        self.max_utxo_size = env.cache_MB * 1000 * 1000 * 4 // 5
+        self.utxo_cache_class = utxo_cache_class(env.utxo_cache)
+        self.utxo_cache = self.utxo_cache_class(self.max_utxo_size)
         self.db_deletes = []
+        # UTXOs the block being processed spends from the DB, looked up in advance
+        self.db_spends = {}
+
+        # The flush being written in the background, if any, and the UTXO cache it
+        # is writing.  That cache is released once written.
+        self.flush_task = None
+        self.flushing_utxos = None
 
     async def run_with_lock(self, coro):
         # Shielded so that cancellations from shutdown don't lose work.  Cancellation will
@@ -302,25 +425,67 @@ class BlockProcessor:
         return (tail_count * coin.TX_PER_BLOCK +
                 max(coin.TX_COUNT - self.tx_count, 0)) * realism
 
+    def sync_info(self):
+        '''Prefetch queue depth and the throughput of each stage, for getinfo.'''
+        info = self.prefetcher.info()
+        info['parse'] = self.parse_stats.info()
+        info['process'] = self.process_stats.info()
+        return info
+
     # - Flushing
     def flush_data(self):
         '''The data for a flush.  The lock must be taken.'''
         assert self.state_lock.locked()
         return FlushData(self.height, self.tx_count, self.headers,
                          self.tx_hashes, self.undo_infos, self.utxo_cache,
-                         self.db_deletes, self.tip)
+                         self.db_deletes, self.tip, self.db.history.unflushed)
 
     async def flush(self, flush_utxos):
-        self.db.flush_dbs(self.flush_data(), flush_utxos, self.estimate_txs_remaining)
+        '''Flush and wait for the writes to complete.'''
+        await self.start_flush(flush_utxos)
+        await self.wait_for_flush()
+
+    async def start_flush(self, flush_utxos):
+        '''Start writing a flush in a thread.  The lock must be taken.
+
+        The caches are handed to the flush and replaced with empty ones, so block
+        processing can continue whilst they are written.  Flushes are written one
+        at a time and in order, so first wait for any prior flush.
+        '''
+        await self.wait_for_flush()
+        flush_data = self.flush_data()
+        self.headers = []
+        self.tx_hashes = []
+        self.db.history.take_unflushed()
+        if flush_utxos:
+            self.undo_infos = []
+            self.utxo_cache = self.utxo_cache_class(self.max_utxo_size)
+            self.db_deletes = []
+            # Until they are committed the flushed UTXOs can only be spent from here
+            self.flushing_utxos = flush_data.adds
+        self.flush_task = asyncio.ensure_future(run_in_thread(
+            self.db.flush_dbs, flush_data, flush_utxos, self.estimate_txs_remaining))
         self.next_cache_check = time.monotonic() + 30
 
+    async def wait_for_flush(self):
+        '''Wait for any flush being written to complete.'''
+        if self.flush_task:
+            # Shielded as the write continues in its thread regardless
+            await asyncio.shield(self.flush_task)
+            self.flush_task = None
+            self.flushing_utxos = None
+
     def check_cache_size(self):
         '''Flush a cache if it gets too big.'''
-        # Good average estimates based on traversal of subobjects and
-        # requesting size from Python (see deep_getsizeof).
         one_MB = 1000*1000
-        utxo_cache_size = len(self.utxo_cache) * 205
-        db_deletes_size = len(self.db_deletes) * 57
+        # The compact cache allocates its table up front, so flush on the size of
+        # its entries but report what is allocated, including any cache being flushed
+        utxo_cache_size = self.utxo_cache.entries_size()
+        utxo_alloc_MB = self.utxo_cache.memsize() // one_MB
+        if self.flushing_utxos is not None:
+            utxo_alloc_MB += self.flushing_utxos.memsize() // one_MB
+        db_deletes_size = (sys.getsizeof(self.db_deletes)
+                           + len(self.db_deletes) // 2 * DB_DELETES_PAIR_SIZE)
         hist_cache_size = self.db.history.unflushed_memsize()
         # Roughly ntxs * 32 + nblocks * 42
         tx_hash_size = ((self.tx_count - self.db.fs_tx_count) * 32
@@ -329,9 +494,15 @@ class BlockProcessor:
         hist_MB = (hist_cache_size + tx_hash_size) // one_MB
 
         self.logger.info('our height: {:,d} daemon: {:,d} '
-                         'UTXOs {:,d}MB hist {:,d}MB'
+                         'UTXOs {:,d}MB ({:,d}MB allocated) hist {:,d}MB'
                          .format(self.height, self.daemon.cached_height(),
-                                 utxo_MB, hist_MB))
+                                 utxo_MB, utxo_alloc_MB, hist_MB))
+        prefetcher = self.prefetcher
+        self.logger.info(f'queued {len(prefetcher.blocks):,d} blocks '
+                         f'{prefetcher.cache_size / one_MB:.1f}MB; MB/s '
+                         f'fetch {prefetcher.fetch_stats.rate():.2f} '
+                         f'parse {self.parse_stats.rate():.2f} '
+                         f'process {self.process_stats.rate():.2f}')
 
         # Flush history if it takes up over 20% of cache memory.
         # Flush UTXOs once they take up 80% of cache memory.
@@ -340,15 +511,47 @@ class BlockProcessor:
             return utxo_MB >= cache_MB * 4 // 5
         return None
 
+    async def _digested_blocks(self, raw_blocks):
+        '''Yield (raw_block, digested_block) pairs in the order of raw_blocks.
+
+        With worker processes all blocks are submitted at once and digested in parallel
+        with the processing of earlier blocks.  Otherwise each block is digested here,
+        just before it is processed.
+        '''
+        digest_block = self.coin.digest_block
+        first = self.height + 1
+        if self.executor is None:
+            for height, raw_block in enumerate(raw_blocks, start=first):
+                yield raw_block, digest_block(raw_block, height)
+            return
+
+        loop = asyncio.get_running_loop()
+        futures = [loop.run_in_executor(self.executor, digest_block, raw_block, height)
+                   for height, raw_block in enumerate(raw_blocks, start=first)]
+        try:
+            for raw_block, future in zip(raw_blocks, futures):
+                yield raw_block, await future
+        finally:
+            # Only relevant if we stopped early, e.g. on a reorg
+            for future in futures:
+                future.cancel()
+
     async def _advance_blocks(self, raw_blocks):
         '''Process the list of raw blocks passed.  Detects and handles reorgs.'''
-        start = time.monotonic()
-        for raw_block in raw_blocks:
-            block = self.coin.block(raw_block)
-            if self.coin.header_prevhash(block.header) != self.tip:
-                self.schedule_reorg(-1)
-                return
-            await self._advance_block(block)
+        start = parse_start = time.monotonic()
+        digested_blocks = self._digested_blocks(raw_blocks)
+        try:
+            async for raw_block, block in digested_blocks:
+                process_start = time.monotonic()
+                self.parse_stats.add(1, len(raw_block), process_start - parse_start)
+                if self.coin.header_prevhash(block.header) != self.tip:
+                    self.schedule_reorg(-1)
+                    return
+                await self._advance_block(raw_block, block)
+                parse_start = time.monotonic()
+                self.process_stats.add(1, len(raw_block), parse_start - process_start)
+        finally:
+            await digested_blocks.aclose()
         end = time.monotonic()
 
         if not self.db.first_sync:
@@ -365,24 +568,24 @@ class BlockProcessor:
         elif end > self.next_cache_check:
             flush_arg = self.check_cache_size()
             if flush_arg is not None:
-                await self.flush(flush_arg)
+                await self.start_flush(flush_arg)
 
         if self._caught_up_event.is_set():
             await self.notifications.on_block(self.touched, self.height)
 
         self.touched = set()
 
-    async def _advance_block(self, block):
+    async def _advance_block(self, raw_block, block):
         '''Advance once block.  It is already verified they correctly connect onto our tip.'''
         min_height = self.db.min_undo_height(self.daemon.cached_height())
         height = self.height + 1
 
-        is_unspendable = (is_unspendable_genesis if height >= self.coin.GENESIS_ACTIVATION
-                          else is_unspendable_legacy)
-        undo_info = self.advance_txs(block.transactions, is_unspendable)
+        await self._lookup_db_spends(block.txs)
+        undo_info = self.advance_txs(block.txs)
+        self.db_spends.clear()
         if height >= min_height:
             self.undo_infos.append((undo_info, height))
-            self.db.write_raw_block(block.raw, height)
+            self.db.write_raw_block(raw_block, height)
 
         self.height = height
         self.headers.append(block.header)
@@ -390,13 +593,58 @@ class BlockProcessor:
 
         await sleep(0)
 
-    def advance_txs(self, txs, is_unspendable):
-        self.tx_hashes.append(b''.join(tx_hash for tx, tx_hash in txs))
+    async def _lookup_db_spends(self, txs):
+        '''Look up the UTXOs the digested transactions spend that are not in the cache.
+
+        These must be on disk.  Reading them one at a time as the inputs are spent is
+        random I/O, so instead read them all with batched lookups in the DB threads and
+        stage them in db_spends for spend_utxo.
+
+        UTXOs being written by a background flush are on disk once it completes, so
+        they are staged to be deleted from the DB in the next flush.  They are staged
+        now as the flush empties its cache once it commits.
+        '''
+        utxo_cache = self.utxo_cache
+        flushing_get = self.flushing_utxos.get if self.flushing_utxos else None
+        db_spends = self.db_spends
+        created = {tx_hash for tx_hash, _prevouts, _outputs in txs}
+        misses = []
+        for _tx_hash, prevouts, _outputs in txs:
+            for prevout in prevouts:
+                if prevout[:32] in created or prevout in utxo_cache:
+                    continue
+                cache_value = flushing_get(prevout) if flushing_get else None
+                if cache_value:
+                    suffix = prevout[-4:] + cache_value[-13:-8]
+                    db_spends[prevout] = (b'h' + prevout[:4] + suffix,
+                                          b'u' + cache_value[:-13] + suffix, cache_value)
+                else:
+                    misses.append(prevout)
+        await self._read_db_spends(misses)
+
+    async def _read_db_spends(self, prevouts):
+        '''Read the UTXOs of prevouts from the DB into db_spends.  Batches of them are
+        looked up concurrently.'''
+        if not prevouts:
+            return
+        # Sort by the key of the "h" table prefix so each batch reads a narrow key range
+        prevouts.sort(key=lambda prevout: prevout[:4] + prevout[32:])
+        lookup_spends = self.db.lookup_spends
+        calls = [(lookup_spends, prevouts[start: start + DB_SPENDS_BATCH_SIZE])
+                 for start in range(0, len(prevouts), DB_SPENDS_BATCH_SIZE)]
+        for spends in await self.db.executor.run_batch(StorageExecutor.SYNC, calls):
+            self.db_spends.update(spends)
+
+    def advance_txs(self, txs):
+        '''Apply the digested transactions of a block to the UTXO cache and history.
+
+        Returns the undo information for the block.
+        '''
+        self.tx_hashes.append(b''.join(tx_hash for tx_hash, _prevouts, _outputs in txs))
 
         # Use local vars for speed in the loops
         undo_info = []
         tx_num = self.tx_count
-        script_hashX = self.coin.hashX_from_script
         put_utxo = self.utxo_cache.__setitem__
         spend_utxo = self.spend_utxo
         undo_info_append = undo_info.append
@@ -406,30 +654,22 @@ class BlockProcessor:
         to_le_uint32 = pack_le_uint32
         to_le_uint64 = pack_le_uint64
 
-        for tx, tx_hash in txs:
+        for tx_hash, prevouts, outputs in txs:
             hashXs = []
             append_hashX = hashXs.append
             tx_numb = to_le_uint64(tx_num)[:5]
 
             # Spend the inputs
-            for txin in tx.inputs:
-                if txin.is_generation():
-                    continue
-                cache_value = spend_utxo(txin.prev_hash, txin.prev_idx)
+            for prevout in prevouts:
+                cache_value = spend_utxo(prevout)
                 undo_info_append(cache_value)
                 append_hashX(cache_value[:-13])
 
-            # Add the new UTXOs
-            for idx, txout in enumerate(tx.outputs):
-                # Ignore unspendable outputs
-                if is_unspendable(txout.pk_script):
-                    continue
-
-                # Get the hashX
-                hashX = script_hashX(txout.pk_script)
+            # Add the new UTXOs; unspendable outputs were already dropped
+            for idx, hashX, value in outputs:
                 append_hashX(hashX)
                 put_utxo(tx_hash + to_le_uint32(idx),
-                         hashX + tx_numb + to_le_uint64(txout.value))
+                         hashX + tx_numb + to_le_uint64(value))
 
             append_hashXs(hashXs)
             update_touched(hashXs)
@@ -450,12 +690,11 @@ class BlockProcessor:
         '''
         self.db.assert_flushed(self.flush_data())
         assert self.height > 0
-        genesis_activation = self.coin.GENESIS_ACTIVATION
 
         coin = self.coin
 
         # Check and update self.tip
-        block = coin.block(raw_block)
+        block = coin.digest_block(raw_block, self.height)
         header_hash = coin.header_hash(block.header)
         if header_hash != self.tip:
             raise ChainError('backup block {} not tip {} at height {:,d}'
@@ -463,18 +702,31 @@ class BlockProcessor:
                                      hash_to_hex_str(self.tip),
                                      self.height))
         self.tip = coin.header_prevhash(block.header)
-        is_unspendable = (is_unspendable_genesis if self.height >= genesis_activation
-                          else is_unspendable_legacy)
-        self._backup_txs(block.transactions, is_unspendable)
+        undo_info = await self.db.executor.run(StorageExecutor.SYNC,
+                                               self.db.read_undo_info, self.height)
+        await self._lookup_db_backup_spends(block.txs)
+        self._backup_txs(block.txs, undo_info)
+        self.db_spends.clear()
         self.height -= 1
         self.db.tx_counts.pop()
 
         await sleep(0)
 
-    def _backup_txs(self, txs, is_unspendable):
+    async def _lookup_db_backup_spends(self, txs):
+        '''Look up the UTXOs created by the transactions being backed up that are
+        not in the cache, as _lookup_db_spends() does for those being spent.'''
+        utxo_cache = self.utxo_cache
+        # Outputs spent in the block are restored to the cache before they are spent
+        spent = {prevout for _tx_hash, prevouts, _outputs in txs for prevout in prevouts}
+        misses = [prevout for prevout in (tx_hash + pack_le_uint32(idx)
+                                          for tx_hash, _prevouts, outputs in txs
+                                          for idx, _hashX, _value in outputs)
+                  if prevout not in spent and prevout not in utxo_cache]
+        await self._read_db_spends(misses)
+
+    def _backup_txs(self, txs, undo_info):
         # Prevout values, in order down the block (coinbase first if present)
         # undo_info is in reverse block order
-        undo_info = self.db.read_undo_info(self.height)
         if undo_info is None:
             raise ChainError('no undo information found for height {:,d}'
                              .format(self.height))
@@ -486,23 +738,18 @@ class BlockProcessor:
         touched = self.touched
         undo_entry_len = 13 + HASHX_LEN
 
-        for tx, tx_hash in reversed(txs):
-            for idx, txout in enumerate(tx.outputs):
-                # Spend the TX outputs.  Be careful with unspendable
-                # outputs - we didn't save those in the first place.
-                if is_unspendable(txout.pk_script):
-                    continue
-
-                cache_value = spend_utxo(tx_hash, idx)
+        for tx_hash, prevouts, outputs in reversed(txs):
+            # Spend the TX outputs.  Unspendable outputs were never saved and are not
+            # in the digest.
+            for idx, _hashX, _value in outputs:
+                cache_value = spend_utxo(tx_hash + pack_le_uint32(idx))
                 touched.add(cache_value[:-13])
 
             # Restore the inputs
-            for txin in reversed(tx.inputs):
-                if txin.is_generation():
-                    continue
+            for prevout in reversed(prevouts):
                 n -= undo_entry_len
                 undo_item = undo_info[n:n + undo_entry_len]
-                put_utxo(txin.prev_hash + pack_le_uint32(txin.prev_idx), undo_item)
+                put_utxo(prevout, undo_item)
                 touched.add(undo_item[:-13])
 
         assert n == 0
@@ -515,17 +762,18 @@ class BlockProcessor:
     performance during initial sync, because then it is possible to
     spend UTXOs without ever going to the database (other than as an
     entry in the address history, and there is only one such entry per
-    TX not per UTXO).  So store them in a Python dictionary with
-    binary keys and values.
+    TX not per UTXO).  So store them in a mapping with binary keys and
+    values.
 
       Key:    TX_HASH + TX_IDX           (32 + 4 = 36 bytes)
       Value:  HASHX + TX_NUM + VALUE     (11 + 5 + 8 = 24 bytes)
 
-    That's 60 bytes of raw data in-memory.  Python dictionary overhead
-    means each entry actually uses about 205 bytes of memory.  So
-    almost 5 million UTXOs can fit in 1GB of RAM.  There are
-    approximately 42 million UTXOs on bitcoin mainnet at height
-    433,000.
+    That's 60 bytes of raw data in-memory.  With the default "dict"
+    engine Python dictionary overhead means each entry actually uses
+    about 170 bytes of memory.  The "compact" engine stores entries in
+    a preallocated hash table using about 76 bytes each, so fits over
+    twice as many UTXOs in the same memory at some cost in speed.  See
+    utxo_cache.py.
 
     Semantics:
 
@@ -562,49 +810,30 @@ class BlockProcessor:
     collision rate is low (<0.1%).
     '''
 
-    def spend_utxo(self, tx_hash, tx_idx):
-        '''Spend a UTXO and return the 33-byte value.
+    def spend_utxo(self, prevout):
+        '''Spend a UTXO and return the 24-byte value.
 
-        If the UTXO is not in the cache it must be on disk.  We store
-        all UTXOs so not finding one indicates a logic error or DB
-        corruption.
+        prevout is the 36-byte TX_HASH + TX_IDX key.  If the UTXO is not in the
+        cache it must be on disk.  We store all UTXOs so not finding one indicates
+        a logic error or DB corruption.
         '''
         # Fast track is it being in the cache
-        idx_packed = pack_le_uint32(tx_idx)
-        cache_value = self.utxo_cache.pop(tx_hash + idx_packed, None)
+        cache_value = self.utxo_cache.pop(prevout, None)
         if cache_value:
             return cache_value
 
-        # Spend it from the DB.
-
-        # Key: b'h' + compressed_tx_hash + tx_idx + tx_num
-        # Value: hashX
-        prefix = b'h' + tx_hash[:4] + idx_packed
-        candidates = {db_key: hashX for db_key, hashX
-                      in self.db.utxo_db.iterator(prefix=prefix)}
-
-        for hdb_key, hashX in candidates.items():
-            tx_num_packed = hdb_key[-5:]
-
-            if len(candidates) > 1:
-                tx_num, = unpack_le_uint64(tx_num_packed + bytes(3))
-                fs_hash, _height = self.db.fs_tx_hash(tx_num)
-                if fs_hash != tx_hash:
-                    assert fs_hash is not None  # Should always be found
-                    continue
-
-            # Key: b'u' + address_hashX + tx_idx + tx_num
-            # Value: the UTXO value as a 64-bit unsigned integer
-            udb_key = b'u' + hashX + hdb_key[-9:]
-            utxo_value_packed = self.db.utxo_db.get(udb_key)
-            if utxo_value_packed:
-                # Remove both entries for this UTXO
-                self.db_deletes.append(hdb_key)
-                self.db_deletes.append(udb_key)
-                return hashX + tx_num_packed + utxo_value_packed
+        # Otherwise it was looked up in advance, from the DB or the UTXOs being
+        # flushed.  Remove both its DB entries.
+        db_spend = self.db_spends.pop(prevout, None)
+        if db_spend:
+            hdb_key, udb_key, cache_value = db_spend
+            self.db_deletes.append(hdb_key)
+            self.db_deletes.append(udb_key)
+            return cache_value
 
+        tx_idx, = unpack_le_uint32(prevout[32:])
         raise ChainError('UTXO {} / {:,d} not found in "h" table'
-                         .format(hash_to_hex_str(tx_hash), tx_idx))
+                         .format(hash_to_hex_str(prevout[:32]), tx_idx))
 
     async def _process_blocks(self):
         '''Loop forever processing blocks as they arrive.'''
@@ -639,6 +868,24 @@ class BlockProcessor:
             # Reopen for serving
             await self.db.open_for_serving()
 
+    async def _compact_history(self):
+        '''Compact the history DB in steps whilst serving, rate-limited to the I/O
+        budget.  Each step holds the lock so it is not interleaved with a flush.'''
+        rate = self.env.history_compaction_MB * 1_000_000
+        if not rate:
+            return
+
+        async def compact_step():
+            await self.wait_for_flush()
+            return await self.db.executor.run(
+                StorageExecutor.SYNC, self.db.compact_history,
+                HISTORY_COMPACTION_PREFIXES, rate)
+
+        await self._caught_up_event.wait()
+        while True:
+            io_size = await self.run_with_lock(compact_step())
+            await sleep(60 if io_size is None else io_size / rate)
+
     async def _first_open_dbs(self):
         await self.db.open_for_sync()
         self.height = self.db.db_height
@@ -661,10 +908,21 @@ class BlockProcessor:
         '''
         self._caught_up_event = caught_up_event
         await self._first_open_dbs()
+        if self.env.block_workers:
+            self.logger.info(f'digesting blocks with {self.env.block_workers:,d} '
+                             f'worker processes')
+            # The DB threads are running, so forking could copy a lock another thread
+            # holds into the workers, e.g. a logging lock.  Start them afresh instead.
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context(
+                'forkserver' if 'forkserver' in methods else 'spawn')
+            self.executor = ProcessPoolExecutor(max_workers=self.env.block_workers,
+                                                mp_context=context)
         try:
             async with TaskGroup() as group:
                 await group.spawn(self.prefetcher.main_loop(self.height))
                 await group.spawn(self._process_blocks())
+                await group.spawn(self._compact_history())
 
                 async for task in group:
                     if not task.cancelled():
@@ -675,6 +933,10 @@ class BlockProcessor:
             self.logger.info('flushing to DB for a clean shutdown...')
             await self.run_with_lock(self.flush(True))
             self.logger.info('flushed cleanly')
+        finally:
+            if self.executor:
+                self.executor.shutdown(wait=False)
+                self.executor = None
 
     def force_chain_reorg(self, count):
         '''Force a reorg of the given number of blocks.
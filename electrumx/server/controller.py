@@ -101,7 +101,7 @@ class Controller(ServerBase):
         Daemon = env.coin.DAEMON
         BlockProcessor = env.coin.BLOCK_PROCESSOR
 
-        async with Daemon(env.coin, env.daemon_url) as daemon:
+        async with Daemon(env.coin, env.daemon_url, rest_blocks=env.daemon_rest) as daemon:
             db = DB(env)
             bp = BlockProcessor(env, db, daemon, notifications)
 
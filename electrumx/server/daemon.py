@@ -38,7 +38,8 @@ class Daemon(object):
     WARMING_UP = -28
     id_counter = itertools.count()
 
-    def __init__(self, coin, url, *, max_workqueue=10, init_retry=0.25, max_retry=4.0):
+    def __init__(self, coin, url, *, max_workqueue=10, init_retry=0.25, max_retry=4.0,
+                 rest_blocks=False):
         self.coin = coin
         self.logger = class_logger(__name__, self.__class__.__name__)
         self.url_index = None
@@ -46,11 +47,16 @@ class Daemon(object):
         self.set_url(url)
         # Limit concurrent RPC calls to this number.
         # See DEFAULT_HTTP_WORKQUEUE in bitcoind, which is typically 16
+        self.max_workqueue = max_workqueue
         self.workqueue_semaphore = asyncio.Semaphore(value=max_workqueue)
         self.init_retry = init_retry
         self.max_retry = max_retry
         self._height = None
         self.available_rpcs = {}
+        # If enabled, raw blocks are fetched in binary from the daemon's REST interface.
+        # rest_available is None until it is known whether the current daemon has it.
+        self.rest_blocks = rest_blocks
+        self.rest_available = None
         self.session = None
 
     async def __aenter__(self):
@@ -62,7 +68,8 @@ class Daemon(object):
         self.session = None
 
     def connector(self):
-        return None
+        # Pool and keep alive as many connections as requests we send concurrently
+        return aiohttp.TCPConnector(limit=self.max_workqueue)
 
     def set_url(self, url):
         '''Set the URLS to the given list, and switch to the first one.'''
@@ -84,6 +91,12 @@ class Daemon(object):
         url = url or self.current_url()
         return url[url.rindex('@') + 1:]
 
+    def rest_url(self, path):
+        '''The URL of path on the current daemon's REST interface, which is
+        unauthenticated.'''
+        url = self.current_url()
+        return f'{url[:url.index("://") + 3]}{self.logged_url(url)}rest/{path}'
+
     def failover(self):
         '''Call to fail-over to the next daemon URL.
 
@@ -91,6 +104,7 @@ class Daemon(object):
         '''
         if len(self.urls) > 1:
             self.url_index = (self.url_index + 1) % len(self.urls)
+            self.rest_available = None
             self.logger.info(f'failing over to {self.logged_url()}')
             return True
         return False
@@ -207,6 +221,46 @@ class Daemon(object):
             self.available_rpcs[method] = available
         return available
 
+    async def _is_rest_available(self):
+        '''Return whether raw blocks can be fetched from the daemon's REST interface.
+
+        The result is cached until failover to another daemon.'''
+        if not self.rest_blocks:
+            return False
+        if self.rest_available is None:
+            try:
+                async with self.session.get(self.rest_url('chaininfo.json')) as resp:
+                    status = resp.status
+            except aiohttp.ClientError as e:
+                self.logger.warning(f'cannot reach daemon REST interface: {e}')
+                return False
+            self.rest_available = status == 200
+            if self.rest_available:
+                self.logger.info('fetching raw blocks from the daemon REST interface')
+            else:
+                self.logger.warning(f'daemon REST interface unavailable (HTTP status '
+                                    f'{status}); fetching blocks over JSON RPC.  Is '
+                                    f'the daemon running with -rest?')
+        return self.rest_available
+
+    async def _rest_block(self, hex_hash):
+        async with self.workqueue_semaphore:
+            async with self.session.get(self.rest_url(f'block/{hex_hash}.bin')) as resp:
+                if resp.status == 200:
+                    return await resp.read()
+                text = await resp.text()
+                raise ServiceRefusedError(text.strip() or resp.reason)
+
+    async def _rest_blocks(self, hex_hashes):
+        tasks = [asyncio.ensure_future(self._rest_block(hex_hash))
+                 for hex_hash in hex_hashes]
+        try:
+            return await asyncio.gather(*tasks)
+        finally:
+            # Only relevant if one failed
+            for task in tasks:
+                task.cancel()
+
     async def block_hex_hashes(self, first, count):
         '''Return the hex hashes of count block starting at height first.'''
         params_iterable = ((h, ) for h in range(first, first + count))
@@ -217,7 +271,15 @@ class Daemon(object):
         return await self._send_single('getblock', (hex_hash, True))
 
     async def raw_blocks(self, hex_hashes):
-        '''Return the raw binary blocks with the given hex hashes.'''
+        '''Return the raw binary blocks with the given hex hashes.
+
+        They are fetched from the REST interface if enabled and available, which avoids
+        hex-encoding them, otherwise or on failure as hex over JSON RPC.'''
+        if await self._is_rest_available():
+            try:
+                return await self._rest_blocks(hex_hashes)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ServiceRefusedError) as e:
+                self.logger.warning(f'REST block fetch failed ({e}); using JSON RPC')
         params_iterable = ((h, False) for h in hex_hashes)
         blocks = await self._send_vector('getblock', params_iterable)
         # Convert hex string to bytes
@@ -12,27 +12,43 @@
 import array
 import ast
 import os
+import threading
 import time
 from bisect import bisect_right
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from functools import partial
 from glob import glob
 
 import attr
-from aiorpcx import run_in_thread, sleep
 
 from electrumx.lib import util
-from electrumx.lib.hash import hash_to_hex_str
+from electrumx.lib.hash import (
+    hash_to_hex_str, sha256_update, HASHX_LEN, SHA256_INITIAL_STATE,
+)
 from electrumx.lib.merkle import Merkle, MerkleCache
 from electrumx.lib.util import (
     formatted_time, pack_be_uint16, pack_be_uint32, pack_le_uint32,
     unpack_le_uint32, unpack_be_uint32, unpack_le_uint64
 )
-from electrumx.server.storage import db_class
-from electrumx.server.history import History
+from electrumx.server.storage import db_class, Storage, StorageExecutor
+from electrumx.server.history import History, HistorySummary
+from electrumx.server.utxo_cache import (
+    H_KEY_LEN, H_RECORD_LEN, U_KEY_LEN, U_RECORD_LEN,
+)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 UTXO = namedtuple("UTXO", "tx_num tx_pos tx_hash height value")
 
+# The tables of the UTXO DB, and the length of the key prefixes each is searched
+# by.  "h" lookups search b'h' + TX_HASH[:4] + TX_IDX, or shorter prefixes when
+# upgrading.  "u" and "U" keys are read whole, or with short prefixes when scanning.
+UTXO_TABLES = {b'h': 5, b'u': 0, b'U': 0}
+
 
 @attr.s(slots=True)
 class FlushData(object):
@@ -45,6 +61,102 @@ class FlushData(object):
     adds = attr.ib()
     deletes = attr.ib()
     tip = attr.ib()
+    # Unflushed history: a map from hashX to packed tx_nums
+    history = attr.ib()
+
+
+@attr.s(slots=True)
+class DBSnapshot(object):
+    '''Read snapshots of the UTXO and history DBs taken together after a
+    flush, and the chain height and tx count they are as of.'''
+    height = attr.ib()
+    tx_count = attr.ib()
+    utxo_db = attr.ib()
+    hist_db = attr.ib()
+    # The UTXOReadCache generation of the snapshots
+    generation = attr.ib()
+
+
+class UTXOReadCache(object):
+    '''A size-bounded LRU cache of prefix scans of the UTXO DB.
+
+    Entries are the rows of "u" table scans by hashX, and of "h" table scans by
+    compressed TX_HASH and TX_IDX.  A flush drops the entries its keys fall in,
+    and bumps the generation so that scans of earlier snapshots that finish
+    after it are not cached.
+    '''
+
+    # Estimated memory cost of an entry and of each of its rows, in bytes
+    ROW_SIZE = 150
+    # The prefix length of cached scans in each table
+    PREFIX_LENS = {b'h': 9, b'u': 1 + HASHX_LEN}
+
+    def __init__(self, size_MB):
+        self.max_rows = size_MB * 1000 * 1000 // self.ROW_SIZE
+        self.entries = OrderedDict()
+        self.rows = 0
+        self.generation = 0
+        self.lookups = 0
+        self.hits = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, prefix):
+        '''Return the cached rows of a prefix scan, or None.'''
+        with self.lock:
+            self.lookups += 1
+            rows = self.entries.get(prefix)
+            if rows is not None:
+                self.hits += 1
+                self.entries.move_to_end(prefix)
+            return rows
+
+    def put(self, generation, prefix, rows):
+        '''Cache the rows of a prefix scan of a snapshot of the given generation.'''
+        # Don't let one large address flush the cache
+        cost = len(rows) + 1
+        if cost > self.max_rows // 8:
+            return
+        with self.lock:
+            if generation != self.generation or prefix in self.entries:
+                return
+            self.entries[prefix] = rows
+            self.rows += cost
+            while self.rows > self.max_rows:
+                _prefix, old_rows = self.entries.popitem(last=False)
+                self.rows -= len(old_rows) + 1
+
+    def invalidate(self, keys):
+        '''Drop the entries of scans that would return any of the DB keys.'''
+        with self.lock:
+            self.generation += 1
+            entries = self.entries
+            if not entries:
+                return
+            prefix_lens = self.PREFIX_LENS
+            for key in keys:
+                prefix_len = prefix_lens.get(key[:1])
+                if prefix_len:
+                    rows = entries.pop(key[:prefix_len], None)
+                    if rows is not None:
+                        self.rows -= len(rows) + 1
+
+    def multi_prefix_scan(self, snapshot, prefixes):
+        '''Return multi_prefix_scan() of the snapshot's UTXO DB, reading the
+        prefixes not in the cache and caching them.'''
+        results = [self.get(prefix) for prefix in prefixes]
+        misses = list(dict.fromkeys(prefix for prefix, rows in zip(prefixes, results)
+                                    if rows is None))
+        if misses:
+            scanned = {prefix: tuple(rows) for prefix, rows
+                       in zip(misses, snapshot.utxo_db.multi_prefix_scan(misses))}
+            for prefix, rows in scanned.items():
+                self.put(snapshot.generation, prefix, rows)
+            results = [scanned[prefix] if rows is None else rows
+                       for prefix, rows in zip(prefixes, results)]
+        return results
 
 
 class DB(object):
@@ -55,6 +167,8 @@ class DB(object):
     '''
 
     DB_VERSIONS = [6, 7, 8]
+    # Fewer tx numbers than this are looked up one by one in fs_tx_hashes()
+    MIN_VECTORIZED_LOOKUPS = 100
 
     class DBError(Exception):
         '''Raised on general DB errors generally indicating corruption.'''
@@ -67,9 +181,20 @@ class DB(object):
         self.logger.info(f'switching current directory to {env.db_dir}')
         os.chdir(env.db_dir)
 
-        self.db_class = db_class(self.env.db_engine)
+        self.db_class = partial(db_class(self.env.db_engine), cache_MB=env.db_cache_MB)
+        # DB reads of clients and of the block processor
+        self.executor = StorageExecutor(env.db_workers)
         self.history = History()
         self.utxo_db = None
+        self.snapshot = None
+        self.utxo_read_cache = UTXOReadCache(env.utxo_read_cache_MB)
+        # Readers store history summaries only if no backup started since they took
+        # their snapshot, so those computed during a backup are discarded.  A backup
+        # deletes the summaries of the hashXs it touches that were stored before.
+        # backup_count is odd whilst backing up and only changes under summary_lock.
+        # Summaries are stored in memory under it and written by the next flush.
+        self.summary_lock = threading.Lock()
+        self.backup_count = 0
         self.utxo_flush_count = 0
         self.fs_height = -1
         self.fs_tx_count = 0
@@ -89,9 +214,11 @@ class DB(object):
         self.merkle = Merkle()
         self.header_mc = MerkleCache(self.merkle, self.fs_block_hashes)
 
-        self.headers_file = util.LogicalFile('meta/headers', 2, 16000000)
-        self.tx_counts_file = util.LogicalFile('meta/txcounts', 2, 2000000)
-        self.hashes_file = util.LogicalFile('meta/hashes', 4, 16000000)
+        self.headers_file = util.MappedLogicalFile('meta/headers', 2, 16000000)
+        # The hashes of the headers, so they need not be hashed again on each start
+        self.block_hashes_file = util.MappedLogicalFile('meta/block_hashes', 2, 16000000)
+        self.tx_counts_file = util.MappedLogicalFile('meta/txcounts', 2, 2000000)
+        self.hashes_file = util.MappedLogicalFile('meta/hashes', 4, 16000000)
 
     async def _read_tx_counts(self):
         if self.tx_counts is not None:
@@ -111,7 +238,7 @@ class DB(object):
         assert self.utxo_db is None
 
         # First UTXO DB
-        self.utxo_db = self.db_class('utxo', for_sync)
+        self.utxo_db = self.db_class('utxo', for_sync, tables=UTXO_TABLES)
         if self.utxo_db.is_new:
             self.logger.info('created new database')
             self.logger.info('creating metadata directory')
@@ -123,14 +250,47 @@ class DB(object):
             self.logger.info(f'opened UTXO DB (for sync: {for_sync})')
         self.read_utxo_state()
 
-        # Then history DB
+        # Then history DB.  A running server continues an interrupted compaction
+        # if it compacts history itself.
+        resume_compaction = compacting or self.env.history_compaction_MB > 0
         self.utxo_flush_count = self.history.open_db(self.db_class, for_sync,
                                                      self.utxo_flush_count,
-                                                     compacting)
+                                                     self.db_tx_count,
+                                                     resume_compaction)
         self.clear_excess_undo_info()
 
+        # A crash during the first sync costs no more than re-syncing from the last
+        # flush, because clear_excess() removes history written after it.  So write
+        # batches are not synced then, and each flush ends with a barrier.
+        fast = for_sync and self.first_sync and not compacting
+        durability = Storage.FAST if fast else Storage.SYNCED
+        self.utxo_db.set_durability(durability)
+        self.history.db.set_durability(durability)
+
+        # Check the block hashes on the first open only, as there must be no await
+        # between re-opening for serving and taking the snapshot
+        if self.tx_counts is None:
+            await self.executor.run(StorageExecutor.SYNC, self._check_block_hashes)
         # Read TX counts (requires meta directory)
         await self._read_tx_counts()
+        self.take_snapshot()
+
+    def _check_block_hashes(self):
+        '''Rebuild the block hashes file from the headers if it does not reach the tip,
+        for example if it was created by an earlier version.'''
+        if (self.db_height < 0
+                or self.block_hashes_file.read(self.db_height * 32, 32) == self.db_tip):
+            return
+        self.logger.info('hashing headers to rebuild the block hashes file...')
+        header_hash = self.coin.header_hash
+        chunk = 100000
+        for start in range(0, self.db_height + 1, chunk):
+            count = min(chunk, self.db_height + 1 - start)
+            headers = self.headers_file.read(start * 80, count * 80)
+            self.block_hashes_file.write(start * 32, b''.join(
+                header_hash(headers[pos: pos + 80]) for pos in range(0, len(headers), 80)))
+        if self.block_hashes_file.read(self.db_height * 32, 32) != self.db_tip:
+            raise self.DBError('the headers file does not match the DB tip')
 
     async def open_for_compacting(self):
         await self._open_dbs(True, True)
@@ -150,6 +310,7 @@ class DB(object):
         '''
         if self.utxo_db:
             self.logger.info('closing DBs to re-open for serving')
+            self.snapshot = None
             self.utxo_db.close()
             self.history.close_db()
             self.utxo_db = None
@@ -161,10 +322,47 @@ class DB(object):
         self.logger.info('populating header merkle cache...')
         length = max(1, self.db_height - self.env.reorg_limit)
         start = time.monotonic()
-        await self.header_mc.initialize(length)
+        saved = self.read_header_merkle_level()
+        if saved:
+            await self.header_mc.initialize_from_level(length, *saved)
+        else:
+            await self.header_mc.initialize(length)
+        self.write_header_merkle_level()
         elapsed = time.monotonic() - start
         self.logger.info(f'header merkle cache populated in {elapsed:.1f}s')
 
+    def read_header_merkle_level(self):
+        '''Return a (length, depth_higher, level) triple of the header merkle cache
+        level saved by write_header_merkle_level(), or None if there is none or it
+        is not of the current chain.'''
+        try:
+            with util.open_file('meta/header_merkle') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        if len(data) < 37:
+            return None
+        length, = unpack_le_uint32(data[:4])
+        depth_higher = data[4]
+        # The hash of the last header commits to those before it
+        last_hash = data[5:37]
+        level = [data[pos: pos + 32] for pos in range(37, len(data), 32)]
+        if (not 0 < length <= self.db_height + 1
+                or len(level) != -(-length >> depth_higher)
+                or self.block_hashes_file.read((length - 1) * 32, 32) != last_hash):
+            return None
+        return length, depth_higher, level
+
+    def write_header_merkle_level(self):
+        '''Save the level of the header merkle cache.'''
+        header_mc = self.header_mc
+        last_hash = self.block_hashes_file.read((header_mc.length - 1) * 32, 32)
+        data = b''.join((pack_le_uint32(header_mc.length), bytes([header_mc.depth_higher]),
+                         last_hash, *header_mc.level))
+        with util.open_truncate('meta/header_merkle.tmp') as f:
+            f.write(data)
+        os.replace('meta/header_merkle.tmp', 'meta/header_merkle')
+
     async def header_branch_and_root(self, length, height):
         return await self.header_mc.branch_and_root(length, height)
 
@@ -179,11 +377,20 @@ class DB(object):
         assert not flush_data.adds
         assert not flush_data.deletes
         assert not flush_data.undo_infos
-        self.history.assert_flushed()
+        assert not flush_data.history
 
     def flush_dbs(self, flush_data, flush_utxos, estimate_txs_remaining):
         '''Flush out cached state.  History is always flushed; UTXOs are
-        flushed if flush_utxos.'''
+        flushed if flush_utxos.
+
+        The block processor runs this in a thread and carries on processing blocks
+        into fresh caches, so it must only touch the caches in flush_data, and not
+        change the set of UTXOs visible to readers before the UTXO batch commits.
+        The writes are ordered: the filesystem, then history (bumping flush_count),
+        then the UTXO batch recording utxo_flush_count, with a barrier after each
+        batch.  A crash part-way through leaves excess history that is removed on
+        restart.
+        '''
         if flush_data.height == self.db_height:
             self.assert_flushed(flush_data)
             return
@@ -195,14 +402,22 @@ class DB(object):
         # Flush to file system
         self.flush_fs(flush_data)
 
-        # Then history
-        self.flush_history()
+        # Then history, keeping the journals needed to back up to the reorg limit
+        min_height = self.min_undo_height(flush_data.height)
+        undo_tx_count = self.tx_counts[min_height - 1] if min_height > 0 else 0
+        self.flush_history(flush_data.history, undo_tx_count)
+        self.history.db.barrier()
 
         # Flush state last as it reads the wall time.
         with self.utxo_db.write_batch() as batch:
             if flush_utxos:
                 self.flush_utxo_db(batch, flush_data)
             self.flush_state(batch)
+        self.utxo_db.barrier()
+        # Only now are the UTXOs readable from the DB
+        if flush_utxos:
+            flush_data.adds.clear()
+            self.take_snapshot()
 
         # Update and put the wall time again - otherwise we drop the
         # time it took to commit the batch
@@ -235,9 +450,9 @@ class DB(object):
                           if self.fs_height >= 0 else 0)
         assert len(flush_data.block_tx_hashes) == len(flush_data.headers)
         assert flush_data.height == self.fs_height + len(flush_data.headers)
-        assert flush_data.tx_count == (self.tx_counts[-1] if self.tx_counts
-                                       else 0)
-        assert len(self.tx_counts) == flush_data.height + 1
+        # The block processor may have appended to tx_counts since
+        assert flush_data.tx_count == (self.tx_counts[flush_data.height]
+                                       if flush_data.height >= 0 else 0)
         hashes = b''.join(flush_data.block_tx_hashes)
         flush_data.block_tx_hashes.clear()
         assert len(hashes) % 32 == 0
@@ -248,11 +463,14 @@ class DB(object):
         height_start = self.fs_height + 1
         offset = height_start * 80
         self.headers_file.write(offset, b''.join(flush_data.headers))
+        header_hash = self.coin.header_hash
+        self.block_hashes_file.write(height_start * 32, b''.join(
+            header_hash(header) for header in flush_data.headers))
         flush_data.headers.clear()
 
         offset = height_start * self.tx_counts.itemsize
-        self.tx_counts_file.write(offset,
-                                  self.tx_counts[height_start:].tobytes())
+        tx_counts = self.tx_counts[height_start:flush_data.height + 1]
+        self.tx_counts_file.write(offset, tx_counts.tobytes())
         offset = prior_tx_count * 32
         self.hashes_file.write(offset, hashes)
 
@@ -263,8 +481,10 @@ class DB(object):
             elapsed = time.monotonic() - start_time
             self.logger.info(f'flushed filesystem data in {elapsed:.2f}s')
 
-    def flush_history(self):
-        self.history.flush()
+    def flush_history(self, unflushed, undo_tx_count):
+        with self.summary_lock:
+            summaries = self.history.take_unflushed_summaries()
+        self.history.flush(unflushed, undo_tx_count, summaries)
 
     def flush_utxo_db(self, batch, flush_data):
         '''Flush the cached DB writes and UTXO set to the batch.'''
@@ -274,6 +494,7 @@ class DB(object):
         start_time = time.monotonic()
         add_count = len(flush_data.adds)
         spend_count = len(flush_data.deletes) // 2
+        self.utxo_read_cache.invalidate(self.flushed_utxo_keys(flush_data))
 
         # Spends
         batch_delete = batch.delete
@@ -281,15 +502,16 @@ class DB(object):
             batch_delete(key)
         flush_data.deletes.clear()
 
-        # New UTXOs
+        # New UTXOs.  These are written in key order, which is cheaper for the
+        # DB engines to ingest and compact.
         batch_put = batch.put
-        for key, value in flush_data.adds.items():
-            # suffix = tx_idx + tx_num
-            hashX = value[:-13]
-            suffix = key[-4:] + value[-13:-8]
-            batch_put(b'h' + key[:4] + suffix, hashX)
-            batch_put(b'u' + hashX + suffix, value[-8:])
-        flush_data.adds.clear()
+        h_records, u_records = flush_data.adds.db_records()
+        for start in range(0, len(h_records), H_RECORD_LEN):
+            batch_put(h_records[start: start + H_KEY_LEN],
+                      h_records[start + H_KEY_LEN: start + H_RECORD_LEN])
+        for start in range(0, len(u_records), U_RECORD_LEN):
+            batch_put(u_records[start: start + U_KEY_LEN],
+                      u_records[start + U_KEY_LEN: start + U_RECORD_LEN])
 
         # New undo information
         self.flush_undo_infos(batch_put, flush_data.undo_infos)
@@ -309,6 +531,24 @@ class DB(object):
         self.db_tx_count = flush_data.tx_count
         self.db_tip = flush_data.tip
 
+    @staticmethod
+    def flushed_utxo_keys(flush_data):
+        '''Yield the keys, or key prefixes, the flush writes to the UTXO DB.'''
+        yield from flush_data.deletes
+        for prevout, cache_value in flush_data.adds.items():
+            yield b'h' + prevout[:4] + prevout[32:]
+            yield b'u' + cache_value[:-13]
+
+    def take_snapshot(self):
+        '''Take read snapshots of the DBs as of the last flush of UTXOs.
+
+        Queries read from the snapshot current when they start, so they see a
+        consistent state no matter what flushes happen meanwhile.
+        '''
+        self.snapshot = DBSnapshot(self.db_height, self.db_tx_count,
+                                   self.utxo_db.snapshot(), self.history.db.snapshot(),
+                                   self.utxo_read_cache.generation)
+
     def flush_state(self, batch):
         '''Flush chain state to the batch.'''
         now = time.time()
@@ -328,11 +568,19 @@ class DB(object):
         tx_delta = flush_data.tx_count - self.last_flush_tx_count
 
         self.backup_fs(flush_data.height, flush_data.tx_count)
+        with self.summary_lock:
+            self.backup_count += 1
         self.history.backup(touched, flush_data.tx_count)
+        self.history.db.barrier()
         with self.utxo_db.write_batch() as batch:
             self.flush_utxo_db(batch, flush_data)
             # Flush state last as it reads the wall time.
             self.flush_state(batch)
+        self.utxo_db.barrier()
+        flush_data.adds.clear()
+        self.take_snapshot()
+        with self.summary_lock:
+            self.backup_count += 1
 
         elapsed = self.last_flush - start_time
         self.logger.info(f'backup flush #{self.history.flush_count:,d} took '
@@ -375,7 +623,7 @@ class DB(object):
                 return self.headers_file.read(offset, size), disk_count
             return b'', 0
 
-        return await run_in_thread(read_headers)
+        return await self.executor.run(StorageExecutor.CLIENT, read_headers)
 
     def fs_tx_hash(self, tx_num):
         '''Return a pair (tx_hash, tx_height) for the given tx number.
@@ -388,6 +636,46 @@ class DB(object):
             tx_hash = self.hashes_file.read(tx_num * 32, 32)
         return tx_hash, tx_height
 
+    def fs_tx_hashes(self, tx_nums, db_height=None):
+        '''Return a list of (tx_hash, tx_height) pairs for the given tx numbers,
+        as fs_tx_hash() does for each.  Hashes above db_height, by default the
+        height of the DB, are None.
+
+        The heights of large batches are found with a single vectorized search if
+        NumPy is installed, and runs of consecutive tx numbers are read with one read.
+        '''
+        tx_counts = self.tx_counts
+        # The search needs a copy of tx_counts, which only pays for itself when
+        # there are many tx numbers to look up
+        if numpy and len(tx_nums) >= max(self.MIN_VECTORIZED_LOOKUPS,
+                                         len(tx_counts) // 256):
+            # A copy, as exporting its buffer would stop tx_counts being resized
+            heights = numpy.searchsorted(
+                numpy.frombuffer(tx_counts[:], dtype=numpy.uint64),
+                numpy.array(tx_nums, dtype=numpy.uint64), side='right').tolist()
+        else:
+            heights = [bisect_right(tx_counts, tx_num) for tx_num in tx_nums]
+
+        if db_height is None:
+            db_height = self.db_height
+        read = self.hashes_file.read
+        tx_hashes = [None] * len(tx_nums)
+        count = len(tx_nums)
+        n = 0
+        while n < count:
+            if heights[n] > db_height:
+                n += 1
+                continue
+            first = tx_nums[n]
+            end = n + 1
+            while (end < count and tx_nums[end] == first + end - n
+                   and heights[end] <= db_height):
+                end += 1
+            hashes = read(first * 32, (end - n) * 32)
+            tx_hashes[n:end] = [hashes[pos: pos + 32] for pos in range(0, len(hashes), 32)]
+            n = end
+        return list(zip(tx_hashes, heights))
+
     def fs_tx_hashes_at_blockheight(self, block_height):
         '''Return a list of tx_hashes at given block height,
         in the same order as in the block.
@@ -405,21 +693,16 @@ class DB(object):
         return [tx_hashes[idx * 32: (idx+1) * 32] for idx in range(num_txs_in_block)]
 
     async def tx_hashes_at_blockheight(self, block_height):
-        return await run_in_thread(self.fs_tx_hashes_at_blockheight, block_height)
+        return await self.executor.run(StorageExecutor.CLIENT,
+                                       self.fs_tx_hashes_at_blockheight, block_height)
 
     async def fs_block_hashes(self, height, count):
-        headers_concat, headers_count = await self.read_headers(height, count)
-        if headers_count != count:
+        headers_count = max(0, min(count, self.db_height + 1 - height))
+        if height < 0 or headers_count != count:
             raise self.DBError('only got {:,d} headers starting at {:,d}, not '
                                '{:,d}'.format(headers_count, height, count))
-        offset = 0
-        hlen = 80
-        headers = []
-        for _ in range(count):
-            headers.append(headers_concat[offset:offset + hlen])
-            offset += hlen
-
-        return [self.coin.header_hash(header) for header in headers]
+        hashes = self.block_hashes_file.read(height * 32, count * 32)
+        return [hashes[pos: pos + 32] for pos in range(0, len(hashes), 32)]
 
     async def limited_history(self, hashX, *, limit=1000):
         '''Return an unpruned, sorted list of (tx_hash, height) tuples of
@@ -429,16 +712,69 @@ class DB(object):
         limit to None to get them all.
         '''
         def read_history():
-            tx_nums = list(self.history.get_txnums(hashX, limit))
-            fs_tx_hash = self.fs_tx_hash
-            return [fs_tx_hash(tx_num) for tx_num in tx_nums]
+            snapshot = self.snapshot
+            tx_nums = list(self.history.get_txnums(hashX, limit, snapshot.hist_db))
+            return self.fs_tx_hashes(tx_nums, snapshot.height)
 
-        while True:
-            history = await run_in_thread(read_history)
-            if all(hash is not None for hash, height in history):
-                return history
-            self.logger.warning('limited_history: tx hash not found (reorg?), retrying...')
-            await sleep(0.25)
+        return await self.executor.run(StorageExecutor.CLIENT, read_history)
+
+    async def history_status(self, hashX, limit):
+        '''Return a pair (count, state).  count is the number of confirmed
+        transactions that touched the address, and state the resumable SHA-256
+        state of the address status text of them.  If count reaches limit it is
+        not counted further and state is None.
+
+        The summary of the history stored in the history DB is brought up to
+        date, so only transactions since it was last brought up to date are read.
+        '''
+        def read_status():
+            backup_count = self.backup_count
+            snapshot = self.snapshot
+            summary = self.history.get_summary(hashX)
+            if summary is None or summary.last_tx_num >= snapshot.tx_count:
+                summary = HistorySummary(0, -1, SHA256_INITIAL_STATE)
+            if summary.count >= limit:
+                return summary.count, None
+            tx_nums = list(self.history.get_txnums_from(
+                hashX, summary.last_tx_num + 1, limit - summary.count, snapshot.hist_db))
+            count = summary.count + len(tx_nums)
+            if count >= limit:
+                return count, None
+            if tx_nums:
+                status = ''.join(f'{hash_to_hex_str(tx_hash)}:{height:d}:'
+                                 for tx_hash, height in self.fs_tx_hashes(tx_nums,
+                                                                          snapshot.height))
+                summary = HistorySummary(count, tx_nums[-1],
+                                         sha256_update(summary.state, status.encode()))
+                with self.summary_lock:
+                    if backup_count == self.backup_count and not backup_count % 2:
+                        self.history.put_summary(hashX, summary)
+            return count, summary.state
+
+        return await self.executor.run(StorageExecutor.CLIENT, read_status)
+
+    def first_tx_num(self, height):
+        '''The tx_num of the first transaction of the block at height, or the tx
+        count if it is above the DB height.'''
+        if height <= 0:
+            return 0
+        tx_counts = self.tx_counts
+        return tx_counts[min(height, len(tx_counts)) - 1]
+
+    async def history_page(self, hashX, start_tx_num, limit):
+        '''Return a pair (history, next_tx_num).  history is a sorted list of
+        (tx_hash, height) tuples of up to limit confirmed transactions that
+        touched the address, from tx number start_tx_num on.  next_tx_num is
+        where the next page starts, or None if there are no more.
+        '''
+        def read_page():
+            snapshot = self.snapshot
+            tx_nums = list(self.history.get_txnums_from(hashX, start_tx_num, limit + 1,
+                                                        snapshot.hist_db))
+            next_tx_num = tx_nums.pop() if len(tx_nums) > limit else None
+            return self.fs_tx_hashes(tx_nums, snapshot.height), next_tx_num
+
+        return await self.executor.run(StorageExecutor.CLIENT, read_page)
 
     # -- Undo information
 
@@ -668,6 +1004,19 @@ class DB(object):
         }
         batch.put(b'state', repr(state).encode())
 
+    def compact_history(self, prefix_count, limit):
+        '''Run a step of history compaction; see History.compact_prefixes().
+        No flush must be in progress.  Returns None if there was nothing to do.'''
+        history = self.history
+        # A crash must not leave compacted history the UTXO DB does not have
+        if history.flush_count != self.utxo_flush_count:
+            return None
+        io_size = history.compact_prefixes(prefix_count, limit)
+        if history.flush_count != self.utxo_flush_count:
+            # A completed compaction resets the flush count
+            self.set_flush_count(history.flush_count)
+        return io_size
+
     def set_flush_count(self, count):
         self.utxo_flush_count = count
         with self.utxo_db.write_batch() as batch:
@@ -676,71 +1025,122 @@ class DB(object):
     async def all_utxos(self, hashX):
         '''Return all UTXOs for an address sorted in no particular order.'''
         def read_utxos():
-            utxos = []
-            utxos_append = utxos.append
+            snapshot = self.snapshot
+            entries = []
+            entries_append = entries.append
             # Key: b'u' + address_hashX + tx_idx + tx_num
             # Value: the UTXO value as a 64-bit unsigned integer
             prefix = b'u' + hashX
-            for db_key, db_value in self.utxo_db.iterator(prefix=prefix):
+            rows, = self.utxo_read_cache.multi_prefix_scan(snapshot, [prefix])
+            for db_key, db_value in rows:
                 tx_pos, = unpack_le_uint32(db_key[-9:-5])
                 tx_num, = unpack_le_uint64(db_key[-5:] + bytes(3))
                 value, = unpack_le_uint64(db_value)
-                tx_hash, height = self.fs_tx_hash(tx_num)
-                utxos_append(UTXO(tx_num, tx_pos, tx_hash, height, value))
-            return utxos
-
-        while True:
-            utxos = await run_in_thread(read_utxos)
-            if all(utxo.tx_hash is not None for utxo in utxos):
-                return utxos
-            self.logger.warning('all_utxos: tx hash not found (reorg?), retrying...')
-            await sleep(0.25)
+                entries_append((tx_num, tx_pos, value))
+            tx_hashes = self.fs_tx_hashes([tx_num for tx_num, _, _ in entries],
+                                          snapshot.height)
+            return [UTXO(tx_num, tx_pos, tx_hash, height, value)
+                    for (tx_num, tx_pos, value), (tx_hash, height)
+                    in zip(entries, tx_hashes)]
+
+        return await self.executor.run(StorageExecutor.CLIENT, read_utxos)
+
+    def lookup_spends(self, prevouts):
+        '''Look up UTXOs about to be spent.
+
+        prevouts is a list of 36-byte TX_HASH + TX_IDX keys.  Both tables are read
+        with batched lookups in key order.  Returns a dictionary mapping each prevout
+        found to an (hdb_key, udb_key, cache_value) triple, where cache_value is
+        HASHX + TX_NUM + VALUE as held in the UTXO cache.
+        '''
+        utxo_db = self.utxo_db
+        # Key: b'h' + compressed_tx_hash + tx_idx + tx_num
+        # Value: hashX
+        prefixes = [b'h' + prevout[:4] + prevout[32:] for prevout in prevouts]
+        found = []
+        for prevout, candidates in zip(prevouts, utxo_db.multi_prefix_scan(prefixes)):
+            tx_hash = prevout[:32]
+            for hdb_key, hashX in candidates:
+                if len(candidates) > 1:
+                    tx_num, = unpack_le_uint64(hdb_key[-5:] + bytes(3))
+                    fs_hash, _height = self.fs_tx_hash(tx_num)
+                    if fs_hash != tx_hash:
+                        continue
+                # Key: b'u' + address_hashX + tx_idx + tx_num
+                # Value: the UTXO value as a 64-bit unsigned integer
+                # Every matching candidate is read as one might have no "u" entry
+                found.append((b'u' + hashX + hdb_key[-9:], hdb_key, prevout))
+
+        found.sort()
+        values = utxo_db.multi_get([udb_key for udb_key, _hdb_key, _prevout in found])
+        spends = {}
+        for (udb_key, hdb_key, prevout), utxo_value_packed in zip(found, values):
+            if utxo_value_packed and prevout not in spends:
+                spends[prevout] = (hdb_key, udb_key,
+                                   udb_key[1:1 + HASHX_LEN] + hdb_key[-5:] + utxo_value_packed)
+        return spends
 
     async def lookup_utxos(self, prevouts):
         '''For each prevout, lookup it up in the DB and return a (hashX,
         value) pair or None if not found.
 
-        Used by the mempool code.
+        Used by the mempool code.  Both passes read the same snapshot.
         '''
+        snapshot = self.snapshot
+        read_cache = self.utxo_read_cache
+
         def lookup_hashXs():
             '''Return (hashX, suffix) pairs, or None if not found,
             for each prevout.
             '''
-            def lookup_hashX(tx_hash, tx_idx):
-                idx_packed = pack_le_uint32(tx_idx)
-
-                # Key: b'h' + compressed_tx_hash + tx_idx + tx_num
-                # Value: hashX
-                prefix = b'h' + tx_hash[:4] + idx_packed
-
+            def lookup_hashX(tx_hash, idx_packed, candidates):
                 # Find which entry, if any, the TX_HASH matches.
-                for db_key, hashX in self.utxo_db.iterator(prefix=prefix):
+                for db_key, hashX in candidates:
                     tx_num_packed = db_key[-5:]
                     tx_num, = unpack_le_uint64(tx_num_packed + bytes(3))
                     fs_hash, _height = self.fs_tx_hash(tx_num)
                     if fs_hash == tx_hash:
                         return hashX, idx_packed + tx_num_packed
                 return None, None
-            return [lookup_hashX(*prevout) for prevout in prevouts]
+
+            # Key: b'h' + compressed_tx_hash + tx_idx + tx_num
+            # Value: hashX
+            keys = [(tx_hash, pack_le_uint32(tx_idx)) for tx_hash, tx_idx in prevouts]
+            prefixes = [b'h' + tx_hash[:4] + idx_packed for tx_hash, idx_packed in keys]
+            return [lookup_hashX(tx_hash, idx_packed, candidates)
+                    for (tx_hash, idx_packed), candidates
+                    in zip(keys, read_cache.multi_prefix_scan(snapshot, prefixes))]
 
         def lookup_utxos(hashX_pairs):
-            def lookup_utxo(hashX, suffix):
+            def lookup_utxo(hashX, db_value):
                 if not hashX:
                     # This can happen when the daemon is a block ahead
                     # of us and has mempool txs spending outputs from
                     # that new block
                     return None
-                # Key: b'u' + address_hashX + tx_idx + tx_num
-                # Value: the UTXO value as a 64-bit unsigned integer
-                key = b'u' + hashX + suffix
-                db_value = self.utxo_db.get(key)
                 if not db_value:
                     # This can happen if the DB was updated between
                     # getting the hashXs and getting the UTXOs
                     return None
                 value, = unpack_le_uint64(db_value)
                 return hashX, value
-            return [lookup_utxo(*hashX_pair) for hashX_pair in hashX_pairs]
 
-        hashX_pairs = await run_in_thread(lookup_hashXs)
-        return await run_in_thread(lookup_utxos, hashX_pairs)
+            # Key: b'u' + address_hashX + tx_idx + tx_num
+            # Value: the UTXO value as a 64-bit unsigned integer
+            # Those of hashXs with cached UTXO scans are found there
+            values = {}
+            cached = {}
+            for hashX, _suffix in hashX_pairs:
+                if hashX and hashX not in cached:
+                    rows = read_cache.get(b'u' + hashX)
+                    cached[hashX] = rows is not None
+                    if rows is not None:
+                        values.update(rows)
+            misses = [b'u' + hashX + suffix for hashX, suffix in hashX_pairs
+                      if hashX and not cached[hashX]]
+            values.update(zip(misses, snapshot.utxo_db.multi_get(misses)))
+            return [lookup_utxo(hashX, values.get(b'u' + hashX + suffix) if hashX else None)
+                    for hashX, suffix in hashX_pairs]
+
+        hashX_pairs = await self.executor.run(StorageExecutor.CLIENT, lookup_hashXs)
+        return await self.executor.run(StorageExecutor.CLIENT, lookup_utxos, hashX_pairs)
@@ -42,6 +42,7 @@ class Env(EnvBase):
 
         self.db_dir = self.required('DB_DIRECTORY')
         self.daemon_url = self.required('DAEMON_URL')
+        self.daemon_rest = self.boolean('DAEMON_REST', False)
         if coin is not None:
             assert issubclass(coin, Coin)
             self.coin = coin
@@ -61,6 +62,10 @@ class Env(EnvBase):
         # Misc
 
         self.db_engine = self.default('DB_ENGINE', 'leveldb')
+        self.db_cache_MB = self.integer('DB_CACHE_MB', 0)
+        self.utxo_read_cache_MB = self.integer('UTXO_READ_CACHE_MB', 20)
+        self.db_workers = self.integer('DB_WORKERS', 4)
+        self.history_compaction_MB = self.integer('HISTORY_COMPACTION_MB', 4)
         self.banner_file = self.default('BANNER_FILE', None)
         self.tor_banner_file = self.default('TOR_BANNER_FILE',
                                             self.banner_file)
@@ -70,7 +75,9 @@ class Env(EnvBase):
         self.donation_address = self.default('DONATION_ADDRESS', '')
         self.drop_client = self.custom("DROP_CLIENT", None, re.compile)
         self.cache_MB = self.integer('CACHE_MB', 1200)
+        self.utxo_cache = self.default('UTXO_CACHE', 'dict')
         self.reorg_limit = self.integer('REORG_LIMIT', self.coin.REORG_LIMIT)
+        self.block_workers = self.integer('BLOCK_WORKERS', 0)
 
         # Server limits to help prevent DoS
 
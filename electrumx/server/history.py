@@ -12,36 +12,151 @@ import array
 import ast
 import bisect
 import time
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from functools import partial
 
 from electrumx.lib import util
 from electrumx.lib.util import (
-    pack_be_uint16, pack_le_uint64, unpack_be_uint16_from, unpack_le_uint64,
+    pack_be_uint16, pack_le_uint64, unpack_le_uint64,
 )
 from electrumx.lib.hash import hash_to_hex_str, HASHX_LEN
 
+try:
+    from electrumx.lib import _fastparse
+except ImportError:
+    _fastparse = None
+
+
+# History rows are keyed HASHX + FLUSH_ID.  A row holds ascending tx_nums, each
+# stored as a varint of its difference from the previous one (the first from
+# zero).  See py_pack_history().  Each row has an index entry keyed HASHX +
+# INDEX_MARK + FLUSH_ID holding the row's first TX_NUM, so a reader can go straight
+# to the row holding a tx_num.  Index entries sort after the rows of their hashX.
+ROW_KEY_LEN = HASHX_LEN + 2
+INDEX_MARK = b'\xff\xff'
+
+
+# The summary of a hashX's history, if it has one, is keyed HASHX + SUMMARY_MARK
+SUMMARY_MARK = INDEX_MARK + b'\xff'
+
+# count is the number of entries and last_tx_num the last of them.  state is the
+# resumable SHA-256 state of the address status text of the entries.
+HistorySummary = namedtuple('HistorySummary', 'count last_tx_num state')
+
+
+# Each flush writes a journal of the keys of the rows it wrote, keyed JOURNAL_PREFIX +
+# the flush's first TX_NUM as 5 big-endian bytes, so a backup can delete or
+# truncate just those rows.  Compaction rewrites the journals listing rows it moves.
+JOURNAL_PREFIX = b'journal'
+JOURNAL_KEY_LEN = len(JOURNAL_PREFIX) + 5
+
+
+def index_key(key):
+    '''The index key of the history row with the given key.'''
+    return key[:-2] + INDEX_MARK + key[-2:]
+
+
+def journal_key(tx_num):
+    '''The key of the journal of the flush whose first tx_num is given.'''
+    return JOURNAL_PREFIX + tx_num.to_bytes(5, 'big')
+
+
+def py_pack_history(tx_nums):
+    '''Return the history row of tx_nums, which must be in ascending order.
+
+    Each tx_num is stored as the LEB128 varint of its difference from the
+    previous one, so most take a byte or two rather than 5.
+    '''
+    row = bytearray()
+    prior = 0
+    for tx_num in tx_nums:
+        delta = tx_num - prior
+        if delta < 0:
+            raise ValueError('tx_nums are not in order')
+        prior = tx_num
+        while delta > 0x7f:
+            row.append((delta & 0x7f) | 0x80)
+            delta >>= 7
+        row.append(delta)
+    return bytes(row)
+
+
+def py_iter_history(row):
+    '''Yield the tx_nums of a history row.'''
+    tx_num = delta = shift = 0
+    for byte in row:
+        delta |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            tx_num += delta
+            yield tx_num
+            delta = shift = 0
+    if shift:
+        raise ValueError('bad history row')
+
+
+def py_unpack_history(row):
+    '''Return the tx_nums of a history row as an array('Q').'''
+    return array.array('Q', py_iter_history(row))
+
+
+if _fastparse:
+    pack_history = _fastparse.pack_history
+
+    def unpack_history(row):
+        '''Return the tx_nums of a history row as an array('Q').'''
+        tx_nums = array.array('Q')
+        tx_nums.frombytes(_fastparse.unpack_history(row))
+        return tx_nums
+else:
+    pack_history = py_pack_history
+    unpack_history = py_unpack_history
+
+
+def pack_summary(summary):
+    '''The DB value of a HistorySummary.'''
+    return b''.join((pack_le_uint64(summary.count),
+                     pack_le_uint64(summary.last_tx_num)[:5], summary.state))
+
+
+def first_tx_num(row):
+    '''The first tx_num of a history row, packed as its index entry value.'''
+    return pack_le_uint64(next(py_iter_history(row)))[:5]
+
 
 class History(object):
 
-    DB_VERSIONS = [0, 1]
+    DB_VERSIONS = [0, 1, 2, 3]
+    # A running server starts a compaction pass once this many flushes are in use
+    COMPACTION_FLUSH_COUNT = 1000
 
     def __init__(self):
         self.logger = util.class_logger(__name__, self.__class__.__name__)
         # For history compaction
         self.max_hist_row_entries = 12500
-        self.unflushed = defaultdict(bytearray)
+        self.unflushed = defaultdict(partial(array.array, 'Q'))
         self.unflushed_count = 0
+        # Summaries stored by readers, written to the DB by the next flush
+        self.unflushed_summaries = {}
         self.flush_count = 0
         self.comp_flush_count = -1
         self.comp_cursor = -1
         self.db_version = max(self.DB_VERSIONS)
         self.upgrade_cursor = -1
+        # Journals record every row holding a tx_num >= journal_tx_count, or
+        # -1 if they are incomplete.  journals holds their first tx_nums in order.
+        self.journal_tx_count = -1
+        self.journals = []
         self.db = None
 
-    def open_db(self, db_class, for_sync, utxo_flush_count, compacting):
+    def open_db(self, db_class, for_sync, utxo_flush_count, tx_count, compacting):
         self.db = db_class('hist', for_sync)
         self.read_state()
-        self.clear_excess(utxo_flush_count)
+        self.journals = [int.from_bytes(key[len(JOURNAL_PREFIX):], 'big')
+                         for key, _value in self.db.iterator(prefix=JOURNAL_PREFIX)
+                         if len(key) == JOURNAL_KEY_LEN]
+        self.clear_excess(utxo_flush_count, tx_count)
         # An incomplete compaction needs to be cancelled otherwise
         # restarting it will corrupt the history
         if not compacting:
@@ -64,12 +179,14 @@ class History(object):
             self.comp_cursor = state.get('comp_cursor', -1)
             self.db_version = state.get('db_version', 0)
             self.upgrade_cursor = state.get('upgrade_cursor', -1)
+            self.journal_tx_count = state.get('journal_tx_count', -1)
         else:
             self.flush_count = 0
             self.comp_flush_count = -1
             self.comp_cursor = -1
             self.db_version = max(self.DB_VERSIONS)
             self.upgrade_cursor = -1
+            self.journal_tx_count = -1
 
         if self.db_version not in self.DB_VERSIONS:
             msg = (f'your history DB version is {self.db_version} but '
@@ -81,7 +198,7 @@ class History(object):
         self.logger.info(f'history DB version: {self.db_version}')
         self.logger.info(f'flush count: {self.flush_count:,d}')
 
-    def clear_excess(self, utxo_flush_count):
+    def clear_excess(self, utxo_flush_count, tx_count):
         # < might happen at end of compaction as both DBs cannot be
         # updated atomically
         if self.flush_count <= utxo_flush_count:
@@ -90,11 +207,24 @@ class History(object):
         self.logger.info('DB shut down uncleanly.  Scanning for '
                          'excess history flushes...')
 
+        # Flush IDs do not order rows across prefixes during a compaction, so
+        # remove the entries of transactions the UTXO DB does not have
         keys = []
-        for key, _hist in self.db.iterator(prefix=b''):
-            flush_id, = unpack_be_uint16_from(key[-2:])
-            if flush_id > utxo_flush_count:
+        puts = {}
+        for key, hist in self.db.iterator(prefix=b''):
+            # Ignore non-history entries
+            if len(key) != ROW_KEY_LEN:
+                continue
+            a = unpack_history(hist)
+            if a[-1] < tx_count:
+                continue
+            idx = bisect.bisect_left(a, tx_count)
+            if idx:
+                puts[key] = pack_history(a[:idx])
+            else:
                 keys.append(key)
+                keys.append(index_key(key))
+            keys.append(key[:HASHX_LEN] + SUMMARY_MARK)
 
         self.logger.info(f'deleting {len(keys):,d} history entries')
 
@@ -102,6 +232,9 @@ class History(object):
         with self.db.write_batch() as batch:
             for key in keys:
                 batch.delete(key)
+            for key, value in puts.items():
+                batch.put(key, value)
+            self.clear_journals(batch)
             self.write_state(batch)
 
         self.logger.info('deleted excess history entries')
@@ -114,6 +247,7 @@ class History(object):
             'comp_cursor': self.comp_cursor,
             'db_version': self.db_version,
             'upgrade_cursor': self.upgrade_cursor,
+            'journal_tx_count': self.journal_tx_count,
         }
         # History entries are not prefixed; the suffix \0\0 ensures we
         # look similar to other entries and aren't interfered with
@@ -123,85 +257,242 @@ class History(object):
         unflushed = self.unflushed
         count = 0
         for tx_num, hashXs in enumerate(hashXs_by_tx, start=first_tx_num):
-            tx_numb = pack_le_uint64(tx_num)[:5]
             hashXs = set(hashXs)
             for hashX in hashXs:
-                unflushed[hashX].extend(tx_numb)
+                unflushed[hashX].append(tx_num)
             count += len(hashXs)
         self.unflushed_count += count
 
     def unflushed_memsize(self):
-        return len(self.unflushed) * 180 + self.unflushed_count * 5
+        return (len(self.unflushed) * 180 + self.unflushed_count * 8
+                + len(self.unflushed_summaries) * 250)
 
     def assert_flushed(self):
         assert not self.unflushed
 
-    def flush(self):
+    def take_unflushed(self):
+        '''Return the unflushed history and start afresh.  The caller is
+        responsible for passing it to flush().'''
+        unflushed = self.unflushed
+        self.unflushed = defaultdict(partial(array.array, 'Q'))
+        self.unflushed_count = 0
+        return unflushed
+
+    def take_unflushed_summaries(self):
+        '''Return the unflushed summaries and start afresh.  The caller is
+        responsible for passing them to flush().'''
+        summaries = self.unflushed_summaries
+        self.unflushed_summaries = {}
+        return summaries
+
+    def flush(self, unflushed=None, undo_tx_count=0, summaries=None):
+        '''Flush unflushed history and summaries, by default those accumulated by
+        add_unflushed() and put_summary().  This can run in a thread other than
+        the one calling add_unflushed() if the history was taken with
+        take_unflushed().
+
+        Journals no longer needed to back up to undo_tx_count are pruned.'''
         start_time = time.monotonic()
+        if unflushed is None:
+            unflushed = self.take_unflushed()
+        if summaries is None:
+            summaries = self.take_unflushed_summaries()
         self.flush_count += 1
         flush_id = pack_be_uint16(self.flush_count)
-        unflushed = self.unflushed
+        # During a compaction compacted prefixes have their own flush IDs
+        comp_prefix = b''
+        if self.comp_cursor != -1:
+            self.comp_flush_count += 1
+            comp_flush_id = pack_be_uint16(self.comp_flush_count)
+            comp_prefix = pack_be_uint16(self.comp_cursor)
 
         with self.db.write_batch() as batch:
+            keys = []
             for hashX in sorted(unflushed):
-                key = hashX + flush_id
-                batch.put(key, bytes(unflushed[hashX]))
+                key = hashX + (comp_flush_id if hashX < comp_prefix else flush_id)
+                tx_nums = unflushed[hashX]
+                batch.put(key, pack_history(tx_nums))
+                batch.put(index_key(key), pack_le_uint64(tx_nums[0])[:5])
+                keys.append(key)
+            if keys:
+                first = min(tx_nums[0] for tx_nums in unflushed.values())
+                batch.put(journal_key(first), b''.join(keys))
+                self.journals.append(first)
+                if self.journal_tx_count == -1:
+                    self.journal_tx_count = first
+            self.prune_journals(batch, undo_tx_count)
+            for hashX, summary in summaries.items():
+                batch.put(hashX + SUMMARY_MARK, pack_summary(summary))
             self.write_state(batch)
 
         count = len(unflushed)
-        unflushed.clear()
-        self.unflushed_count = 0
 
         if self.db.for_sync:
             elapsed = time.monotonic() - start_time
             self.logger.info(f'flushed history in {elapsed:.1f}s '
                              f'for {count:,d} addrs')
 
+    def prune_journals(self, batch, tx_count):
+        '''Delete the journals not needed to back up to tx_count.'''
+        # The last journal starting at or before tx_count is needed
+        idx = bisect.bisect_right(self.journals, tx_count) - 1
+        if idx > 0:
+            for first in self.journals[:idx]:
+                batch.delete(journal_key(first))
+            del self.journals[:idx]
+            self.journal_tx_count = self.journals[0]
+
+    def clear_journals(self, batch):
+        '''Delete the journals, for example once rows were removed without them.'''
+        for first in self.journals:
+            batch.delete(journal_key(first))
+        self.journals.clear()
+        self.journal_tx_count = -1
+
     def backup(self, hashXs, tx_count):
+        '''Remove the history entries >= tx_count.  hashXs are those touched by
+        the transactions being removed.  If the journals cover the backup only
+        the rows they list are read, otherwise those of each hashX.'''
         # Not certain this is needed, but it doesn't hurt
         self.flush_count += 1
-        nremoves = 0
-        bisect_left = bisect.bisect_left
-        chunks = util.chunks
+        # They might summarize removed history
+        self.unflushed_summaries.clear()
 
         with self.db.write_batch() as batch:
-            for hashX in sorted(hashXs):
-                deletes = []
-                puts = {}
-                for key, hist in self.db.iterator(prefix=hashX, reverse=True):
-                    a = array.array('Q')
-                    a.frombytes(b''.join(item + bytes(3) for item in chunks(hist, 5)))
-                    # Remove all history entries >= tx_count
-                    idx = bisect_left(a, tx_count)
-                    nremoves += len(a) - idx
-                    if idx > 0:
-                        puts[key] = hist[:5 * idx]
-                        break
-                    deletes.append(key)
-
-                for key in deletes:
-                    batch.delete(key)
-                for key, value in puts.items():
-                    batch.put(key, value)
+            if self.journal_tx_count != -1 and tx_count >= self.journal_tx_count:
+                hashXs = self._backup_journals(batch, tx_count)
+            else:
+                self._backup_hashXs(batch, sorted(hashXs), tx_count)
+                # Start afresh as the journals might list removed flushes
+                self.clear_journals(batch)
+            # Summaries are recomputed when next needed
+            for hashX in hashXs:
+                batch.delete(hashX + SUMMARY_MARK)
             self.write_state(batch)
 
+    def _backup_journals(self, batch, tx_count):
+        '''Truncate the rows listed by the journals of the flushes since tx_count
+        and of the flush before.  Return the set of hashXs whose history changed.'''
+        hashXs = set()
+        deletes = truncates = 0
+        idx = bisect.bisect_left(self.journals, tx_count)
+        # The prior flush might have entries >= tx_count.  A row compacted since
+        # can be listed by several journals and hold earlier entries too.
+        row_keys = set()
+        for journal in self.db.multi_get([journal_key(first)
+                                          for first in self.journals[max(idx - 1, 0):]]):
+            row_keys.update(util.chunks(journal, ROW_KEY_LEN))
+        # Flushes with no entries below tx_count are removed
+        for first in self.journals[idx:]:
+            batch.delete(journal_key(first))
+        del self.journals[idx:]
+
+        row_keys = sorted(row_keys)
+        for row_key, hist in zip(row_keys, self.db.multi_get(row_keys)):
+            # Its row might have been removed by an earlier backup
+            if hist is None:
+                continue
+            a = unpack_history(hist)
+            if a[-1] < tx_count:
+                continue
+            pos = bisect.bisect_left(a, tx_count)
+            if pos:
+                batch.put(row_key, pack_history(a[:pos]))
+                truncates += 1
+            else:
+                batch.delete(row_key)
+                batch.delete(index_key(row_key))
+                deletes += 1
+            hashXs.add(row_key[:-2])
+
+        self.logger.info(f'backing up deleted {deletes:,d} and truncated '
+                         f'{truncates:,d} history rows')
+        return hashXs
+
+    def _backup_hashXs(self, batch, hashXs, tx_count):
+        '''Remove the history entries >= tx_count of hashXs by reading their rows
+        from the last.'''
+        nremoves = 0
+        bisect_left = bisect.bisect_left
+
+        for rows in self.db.multi_prefix_scan(hashXs):
+            deletes = []
+            puts = {}
+            rows = [row for row in rows if len(row[0]) == ROW_KEY_LEN]
+            for key, hist in reversed(rows):
+                a = unpack_history(hist)
+                # Remove all history entries >= tx_count
+                idx = bisect_left(a, tx_count)
+                nremoves += len(a) - idx
+                if idx > 0:
+                    puts[key] = pack_history(a[:idx])
+                    break
+                deletes.append(key)
+                deletes.append(index_key(key))
+
+            for key in deletes:
+                batch.delete(key)
+            for key, value in puts.items():
+                batch.put(key, value)
+
         self.logger.info(f'backing up removed {nremoves:,d} history entries')
 
-    def get_txnums(self, hashX, limit=1000):
+    def get_txnums(self, hashX, limit=1000, snapshot=None):
         '''Generator that returns an unpruned, sorted list of tx_nums in the
         history of a hashX.  Includes both spending and receiving
         transactions.  By default yields at most 1000 entries.  Set
-        limit to None to get them all.  '''
+        limit to None to get them all.  Reads from snapshot if given.'''
         limit = util.resolve_limit(limit)
-        chunks = util.chunks
-        for _key, hist in self.db.iterator(prefix=hashX):
-            for tx_numb in chunks(hist, 5):
+        db = self.db if snapshot is None else snapshot
+        for key, hist in db.iterator(prefix=hashX):
+            # The index entries follow the rows
+            if len(key) != ROW_KEY_LEN:
+                return
+            for tx_num in unpack_history(hist):
                 if limit == 0:
                     return
-                tx_num, = unpack_le_uint64(tx_numb + bytes(3))
                 yield tx_num
                 limit -= 1
 
+    def get_txnums_from(self, hashX, start_tx_num, limit=1000, snapshot=None):
+        '''As for get_txnums() but yields only tx_nums >= start_tx_num.  Rows
+        before the one holding start_tx_num are found from the index and not
+        read.'''
+        limit = util.resolve_limit(limit)
+        chunks = util.chunks
+        db = self.db if snapshot is None else snapshot
+        index = [(unpack_le_uint64(first + bytes(3))[0], key)
+                 for key, first in db.iterator(prefix=hashX + INDEX_MARK)
+                 if len(key) == ROW_KEY_LEN + 2]
+        pos = max(bisect.bisect_right(index, (start_tx_num, b'')) - 1, 0)
+        # Rows are read a few at a time
+        for keys in chunks([hashX + key[-2:] for _first, key in index[pos:]], 16):
+            for hist in db.multi_get(keys):
+                for tx_num in unpack_history(hist or b''):
+                    if tx_num < start_tx_num:
+                        continue
+                    if limit == 0:
+                        return
+                    yield tx_num
+                    limit -= 1
+
+    def get_summary(self, hashX):
+        '''Return the HistorySummary of hashX, or None if it has none.'''
+        summary = self.unflushed_summaries.get(hashX)
+        if summary is not None:
+            return summary
+        value = self.db.get(hashX + SUMMARY_MARK)
+        if value is None:
+            return None
+        count, = unpack_le_uint64(value[:8])
+        last_tx_num, = unpack_le_uint64(value[8:13] + bytes(3))
+        return HistorySummary(count, last_tx_num, value[13:])
+
+    def put_summary(self, hashX, summary):
+        '''Store the HistorySummary of hashX.  It is written to the DB by the next
+        flush, so readers never wait on a flush's write.'''
+        self.unflushed_summaries[hashX] = summary
+
     #
     # History compaction
     #
@@ -231,31 +522,69 @@ class History(object):
         else:
             self.comp_cursor = cursor
 
-        # History DB.  Flush compacted history and updated state
+        # History DB.  Flush compacted history, its index, the journals listing
+        # the rows now holding recent entries, and updated state.
         with self.db.write_batch() as batch:
+            if write_items or keys_to_delete:
+                self._rewrite_journals(batch, write_items, keys_to_delete)
             # Important: delete first!  The keyspace may overlap.
             for key in keys_to_delete:
                 batch.delete(key)
+                batch.delete(index_key(key))
             for key, value in write_items:
                 batch.put(key, value)
+                batch.put(index_key(key), first_tx_num(value))
             self.write_state(batch)
 
+    def _rewrite_journals(self, batch, write_items, keys_to_delete):
+        '''Rewrite the journals listing rows deleted or rewritten by a compaction
+        step.  Each lists instead the rewritten rows of the hashX that hold
+        entries of its flush or later.'''
+        moved = keys_to_delete.union(key for key, _value in write_items)
+        journals = {}
+        for first, journal in zip(self.journals, self.db.multi_get(
+                [journal_key(first) for first in self.journals])):
+            row_keys = list(util.chunks(journal, ROW_KEY_LEN))
+            if any(row_key in moved for row_key in row_keys):
+                journals[first] = row_keys
+        if not journals:
+            return
+
+        hashXs = {row_key[:-2] for row_keys in journals.values()
+                  for row_key in row_keys if row_key in moved}
+        # hashX -> list of (key, last tx_num) of its rewritten rows
+        rows = defaultdict(list)
+        for key, value in write_items:
+            if key[:-2] in hashXs:
+                rows[key[:-2]].append((key, unpack_history(value)[-1]))
+        for first, row_keys in journals.items():
+            new_keys = []
+            for row_key in row_keys:
+                if row_key in moved:
+                    new_keys.extend(key for key, last_tx_num in rows[row_key[:-2]]
+                                    if last_tx_num >= first)
+                else:
+                    new_keys.append(row_key)
+            batch.put(journal_key(first), b''.join(new_keys))
+
     def _compact_hashX(self, hashX, hist_map, hist_list,
                        write_items, keys_to_delete):
         '''Compres history for a hashX.  hist_list is an ordered list of
         the histories to be compressed.'''
-        # History entries (tx numbers) are 4 bytes each.  Distribute
-        # over rows of up to 50KB in size.  A fixed row size means
+        # Distribute history entries (tx numbers) over rows of
+        # max_hist_row_entries entries.  A fixed row length means
         # future compactions will not need to update the first N - 1
         # rows.
-        max_row_size = self.max_hist_row_entries * 5
-        full_hist = b''.join(hist_list)
-        nrows = (len(full_hist) + max_row_size - 1) // max_row_size
+        max_row_entries = self.max_hist_row_entries
+        full_hist = array.array('Q')
+        for hist in hist_list:
+            full_hist.extend(unpack_history(hist))
+        nrows = (len(full_hist) + max_row_entries - 1) // max_row_entries
         if nrows > 4:
             self.logger.info('hashX {} is large: {:,d} entries across '
                              '{:,d} rows'
                              .format(hash_to_hex_str(hashX),
-                                     len(full_hist) // 5, nrows))
+                                     len(full_hist), nrows))
 
         # Find what history needs to be written, and what keys need to
         # be deleted.  Start by assuming all keys are to be deleted,
@@ -264,7 +593,8 @@ class History(object):
         write_size = 0
         keys_to_delete.update(hist_map)
         n = 0   # In case of no loops
-        for n, chunk in enumerate(util.chunks(full_hist, max_row_size)):
+        for n, tx_nums in enumerate(util.chunks(full_hist, max_row_entries)):
+            chunk = pack_history(tx_nums)
             key = hashX + pack_be_uint16(n)
             if hist_map.get(key) == chunk:
                 keys_to_delete.remove(key)
@@ -279,17 +609,18 @@ class History(object):
 
     def _compact_prefix(self, prefix, write_items, keys_to_delete):
         '''Compact all history entries for hashXs beginning with the
-        given prefix.  Update keys_to_delete and write.'''
+        given prefix.  Update keys_to_delete and write.  Return a
+        (read_size, write_size) pair.'''
         prior_hashX = None
         hist_map = {}
         hist_list = []
 
-        key_len = HASHX_LEN + 2
-        write_size = 0
+        read_size = write_size = 0
         for key, hist in self.db.iterator(prefix=prefix):
             # Ignore non-history entries
-            if len(key) != key_len:
+            if len(key) != ROW_KEY_LEN:
                 continue
+            read_size += ROW_KEY_LEN + len(hist)
             hashX = key[:-2]
             if hashX != prior_hashX and prior_hashX:
                 write_size += self._compact_hashX(prior_hashX, hist_map,
@@ -304,7 +635,7 @@ class History(object):
         if prior_hashX:
             write_size += self._compact_hashX(prior_hashX, hist_map, hist_list,
                                               write_items, keys_to_delete)
-        return write_size
+        return read_size, write_size
 
     def _compact_history(self, limit):
         '''Inner loop of history compaction.  Loops until limit bytes have
@@ -319,7 +650,7 @@ class History(object):
         while write_size < limit and cursor < 65536:
             prefix = pack_be_uint16(cursor)
             write_size += self._compact_prefix(prefix, write_items,
-                                               keys_to_delete)
+                                               keys_to_delete)[1]
             cursor += 1
 
         max_rows = self.comp_flush_count + 1
@@ -332,9 +663,52 @@ class History(object):
                                  100 * cursor / 65536))
         return write_size
 
+    def compact_prefixes(self, prefix_count, limit):
+        '''A step of compaction in a running server.  Compact up to prefix_count
+        prefixes, stopping early once limit bytes have been written.  Starts a
+        pass if none is in progress and COMPACTION_FLUSH_COUNT is reached.
+
+        Flushes can be interleaved with steps; the caller must ensure none is
+        in progress.  Returns the number of bytes read and written, or None if
+        no pass is in progress.
+        '''
+        if self.comp_cursor == -1:
+            if self.flush_count < self.COMPACTION_FLUSH_COUNT:
+                return None
+            self.logger.info(f'starting history compaction at flush count '
+                             f'{self.flush_count:,d}')
+            self.comp_cursor = 0
+            self.comp_flush_count = max(self.comp_flush_count, 1)
+
+        keys_to_delete = set()
+        write_items = []   # A list of (key, value) pairs
+        read_size = write_size = 0
+
+        cursor = self.comp_cursor
+        end = min(cursor + prefix_count, 65536)
+        while write_size < limit and cursor < end:
+            prefix = pack_be_uint16(cursor)
+            sizes = self._compact_prefix(prefix, write_items, keys_to_delete)
+            read_size += sizes[0]
+            write_size += sizes[1]
+            cursor += 1
+
+        # Log progress every 1/16th of the way
+        if cursor >> 12 != self.comp_cursor >> 12:
+            max_rows = self.comp_flush_count + 1
+            self.logger.info(f'history compaction: largest: {max_rows:,d} rows, '
+                             f'{100 * cursor / 65536:.1f}% complete')
+        self._flush_compaction(cursor, write_items, keys_to_delete)
+        if cursor == 65536:
+            self.logger.info(f'history compaction complete, flush count '
+                             f'{self.flush_count:,d}')
+        return read_size + write_size
+
     def _cancel_compaction(self):
         if self.comp_cursor != -1:
             self.logger.warning('cancelling in-progress history compaction')
+            # Compacted rows may use flush IDs up to comp_flush_count
+            self.flush_count = max(self.flush_count, self.comp_flush_count)
             self.comp_flush_count = -1
             self.comp_cursor = -1
 
@@ -349,17 +723,23 @@ class History(object):
         def upgrade_cursor(cursor):
             count = 0
             prefix = pack_be_uint16(cursor)
-            key_len = HASHX_LEN + 2
             chunks = util.chunks
             with self.db.write_batch() as batch:
                 batch_put = batch.put
                 for key, hist in self.db.iterator(prefix=prefix):
                     # Ignore non-history entries
-                    if len(key) != key_len:
+                    if len(key) != ROW_KEY_LEN:
                         continue
                     count += 1
-                    hist = b''.join(item + b'\0' for item in chunks(hist, 4))
-                    batch_put(key, hist)
+                    # Version 1 has 5-byte tx_nums, version 2 the row index and
+                    # version 3 packed rows
+                    size = 4 if self.db_version == 0 else 5
+                    tx_nums = array.array('Q')
+                    tx_nums.frombytes(b''.join(item + bytes(8 - size)
+                                               for item in chunks(hist, size)))
+                    batch_put(key, pack_history(tx_nums))
+                    if self.db_version < 2:
+                        batch_put(index_key(key), pack_le_uint64(tx_nums[0])[:5])
                 self.upgrade_cursor = cursor
                 self.write_state(batch)
             return count
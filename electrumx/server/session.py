@@ -33,8 +33,8 @@ import electrumx
 from electrumx.lib.merkle import MerkleCache
 from electrumx.lib.text import sessions_lines
 from electrumx.lib import util
-from electrumx.lib.hash import (sha256, hash_to_hex_str, hex_str_to_hash, HASHX_LEN, Base58Error,
-                                double_sha256)
+from electrumx.lib.hash import (sha256_finish, SHA256_INITIAL_STATE, hash_to_hex_str,
+                                hex_str_to_hash, HASHX_LEN, Base58Error, double_sha256)
 from electrumx.server.daemon import DaemonError
 from electrumx.server.peers import PeerManager
 
@@ -299,10 +299,12 @@ class SessionManager:
         cache_fmt = '{:,d} lookups {:,d} hits {:,d} entries'
         sessions = self.sessions
         return {
+            'block processing': self.bp.sync_info(),
             'coin': self.env.coin.__name__,
             'daemon': self.daemon.logged_url(),
             'daemon height': self.daemon.cached_height(),
             'db height': self.db.db_height,
+            'db workers': self.db.executor.stats(),
             'db_flush_count': self.db.history.flush_count,
             'groups': len(self.session_groups),
             'history cache': cache_fmt.format(
@@ -323,6 +325,9 @@ class SessionManager:
             },
             'tx hashes cache': cache_fmt.format(
                 self._tx_hashes_lookups, self._tx_hashes_hits, len(self._tx_hashes_cache)),
+            'utxo read cache': cache_fmt.format(
+                self.db.utxo_read_cache.lookups, self.db.utxo_read_cache.hits,
+                len(self.db.utxo_read_cache)),
             'txs sent': self.txs_sent,
             'uptime': util.formatted_time(time.time() - self.start_time),
             'version': electrumx.version,
@@ -842,6 +847,26 @@ class SessionManager:
             raise result
         return result, cost
 
+    async def history_status(self, hashX):
+        '''Returns a pair (state, cost).  state is the SHA-256 state of the status
+        text of the confirmed history, or None if there is none.'''
+        # The same DoS limit as limited_history()
+        limit = self.env.max_send // 99
+        count, state = await self.db.history_status(hashX, limit)
+        cost = 0.2
+        if count >= limit:
+            raise RPCError(BAD_REQUEST, 'history too large', cost=cost + limit * 0.001)
+        return (state if count else None), cost
+
+    async def history_page(self, hashX, start_tx_num):
+        '''Returns a triple (history, next_tx_num, cost) of a page of history.
+        See DB.history_page().'''
+        # Pages are as large as the DoS limit of limited_history() allows
+        limit = self.env.max_send // 99
+        history, next_tx_num = await self.db.history_page(hashX, start_tx_num, limit)
+        cost = 0.2 + len(history) * 0.001
+        return history, next_tx_num, cost
+
     async def _notify_sessions(self, height, touched):
         '''Notify sessions about height changes and touched addresses.'''
         height_changed = height != self.notified_height
@@ -1134,21 +1159,19 @@ class ElectrumX(SessionBase):
         '''
         # Note history is ordered and mempool unordered in electrum-server
         # For mempool, height is -1 if it has unconfirmed inputs, otherwise 0
-        db_history, cost = await self.session_mgr.limited_history(hashX)
+        # The hashing of the confirmed history is resumed from the DB's summary.
+        db_state, cost = await self.session_mgr.history_status(hashX)
         mempool = await self.mempool.transaction_summaries(hashX)
 
-        status = ''.join(f'{hash_to_hex_str(tx_hash)}:'
-                         f'{height:d}:'
-                         for tx_hash, height in db_history)
-        status += ''.join(f'{hash_to_hex_str(tx.hash)}:'
-                          f'{-tx.has_unconfirmed_inputs:d}:'
-                          for tx in mempool)
+        status = ''.join(f'{hash_to_hex_str(tx.hash)}:'
+                         f'{-tx.has_unconfirmed_inputs:d}:'
+                         for tx in mempool)
 
         # Add status hashing cost
         self.bump_cost(cost + 0.1 + len(status) * 0.00002)
 
-        if status:
-            status = sha256(status.encode()).hex()
+        if db_state or status:
+            status = sha256_finish(db_state or SHA256_INITIAL_STATE, status.encode()).hex()
         else:
             status = None
 
@@ -1224,6 +1247,22 @@ class ElectrumX(SessionBase):
         hashX = scripthash_to_hashX(scripthash)
         return await self.confirmed_and_unconfirmed_history(hashX)
 
+    async def scripthash_get_history_page(self, scripthash, from_height=0, cursor=None):
+        '''Return a page of the confirmed history of a scripthash, starting at
+        from_height, or where the page that returned cursor left off.'''
+        hashX = scripthash_to_hashX(scripthash)
+        if cursor is None:
+            start_tx_num = self.db.first_tx_num(non_negative_integer(from_height))
+        else:
+            start_tx_num = non_negative_integer(cursor)
+        history, next_tx_num, cost = await self.session_mgr.history_page(hashX, start_tx_num)
+        self.bump_cost(cost)
+        return {
+            'history': [{'tx_hash': hash_to_hex_str(tx_hash), 'height': height}
+                        for tx_hash, height in history],
+            'cursor': next_tx_num,
+        }
+
     async def scripthash_get_mempool(self, scripthash):
         '''Return the mempool transactions touching a scripthash.'''
         hashX = scripthash_to_hashX(scripthash)
@@ -1519,6 +1558,7 @@ class ElectrumX(SessionBase):
             'blockchain.relayfee': self.relayfee,
             'blockchain.scripthash.get_balance': self.scripthash_get_balance,
             'blockchain.scripthash.get_history': self.scripthash_get_history,
+            'blockchain.scripthash.get_history_page': self.scripthash_get_history_page,
             'blockchain.scripthash.get_mempool': self.scripthash_get_mempool,
             'blockchain.scripthash.listunspent': self.scripthash_listunspent,
             'blockchain.scripthash.subscribe': self.scripthash_subscribe,
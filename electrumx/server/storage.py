@@ -7,7 +7,14 @@
 
 '''Backend database abstraction.'''
 
+import asyncio
+import heapq
 import os
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import nullcontext
 from functools import partial
 
 from electrumx.lib import util
@@ -25,9 +32,21 @@ def db_class(name):
 class Storage(object):
     '''Abstract base class of the DB backend abstraction.'''
 
-    def __init__(self, name, for_sync):
+    # Durability modes.  SYNCED write batches are on disk when they commit.
+    # FAST write batches are not synced, so a crash can lose those since the
+    # last barrier().
+    SYNCED, FAST = 'synced', 'fast'
+
+    def __init__(self, name, for_sync, tables=None, cache_MB=0):
         self.is_new = not os.path.exists(name)
         self.for_sync = for_sync or self.is_new
+        # Keys starting with the same byte form a table.  tables maps the
+        # first bytes of those tables an engine may keep apart to the
+        # length of the key prefixes each is searched by, or 0.
+        self.tables = tables or {}
+        # The size of the engine's cache of DB blocks, 0 for its default
+        self.cache_MB = cache_MB
+        self.durability = self.SYNCED
         self.open(name, create=self.is_new)
 
     @classmethod
@@ -49,6 +68,42 @@ class Storage(object):
     def put(self, key, value):
         raise NotImplementedError
 
+    def multi_get(self, keys):
+        '''Return a list of the values of the keys, None for those that
+        are not present.'''
+        get = self.get
+        return [get(key) for key in keys]
+
+    def multi_prefix_scan(self, prefixes):
+        '''Return a list, for each prefix, of the (key, value) pairs of the
+        keys starting with it, sorted by key.'''
+        iterator = self.iterator
+        return [list(iterator(prefix=prefix)) for prefix in prefixes]
+
+    def set_durability(self, durability):
+        '''Set the durability mode of later write batches.'''
+        if durability not in (self.SYNCED, self.FAST):
+            raise ValueError(f'unknown durability mode "{durability}"')
+        self.durability = durability
+
+    def barrier(self):
+        '''Make all write batches so far durable.'''
+        if self.durability == self.FAST:
+            self.sync()
+
+    def sync(self):
+        '''Sync all writes so far to disk.'''
+        raise NotImplementedError
+
+    def snapshot(self):
+        '''Return a read-only view of the database as it is now, unaffected by
+        later writes.
+
+        It provides `get`, `multi_get`, `iterator` and `multi_prefix_scan`,
+        and is released by `close` or when garbage collected.
+        '''
+        raise NotImplementedError
+
     def write_batch(self):
         '''Return a context manager that provides `put` and `delete`.
 
@@ -80,78 +135,424 @@ class LevelDB(Storage):
 
     def open(self, name, create):
         mof = 512 if self.for_sync else 128
+        kwargs = {}
+        if self.cache_MB:
+            kwargs['lru_cache_size'] = self.cache_MB * 1000 * 1000
         # Use snappy compression (the default)
         self.db = self.module.DB(name, create_if_missing=create,
-                                 max_open_files=mof)
+                                 max_open_files=mof, **kwargs)
         self.close = self.db.close
         self.get = self.db.get
         self.put = self.db.put
         self.iterator = self.db.iterator
-        self.write_batch = partial(self.db.write_batch, transaction=True,
-                                   sync=True)
+
+    def write_batch(self):
+        return self.db.write_batch(transaction=True, sync=self.durability == self.SYNCED)
+
+    def sync(self):
+        # Writes are appended to a log, so syncing an empty batch syncs those before it
+        self.db.write_batch(sync=True).write()
+
+    def snapshot(self):
+        return LevelDBSnapshot(self.db)
+
+    def multi_get(self, keys):
+        # Reading in key order makes best use of the block cache
+        get = self.db.get
+        values = {key: get(key) for key in sorted(keys)}
+        return [values[key] for key in keys]
+
+    def multi_prefix_scan(self, prefixes):
+        # Seek one iterator forwards through the prefixes in order
+        results = {}
+        iterator = self.db.raw_iterator()
+        try:
+            for prefix in sorted(prefixes):
+                items = results[prefix] = []
+                iterator.seek(prefix)
+                while iterator.valid():
+                    key = iterator.key()
+                    if not key.startswith(prefix):
+                        break
+                    items.append((key, iterator.value()))
+                    iterator.next()
+        finally:
+            iterator.close()
+        return [results[prefix] for prefix in prefixes]
 
 
 # pylint:disable=E1101
 
 
 class RocksDB(Storage):
-    '''RocksDB database engine.'''
-
-    def __init__(self, *args):
+    '''RocksDB database engine.
+
+    Each table is a column family.  All have bloom filters of whole keys,
+    so that most lookups of absent keys do not read from disk.  Tables
+    have no prefix extractor: its iterators would only see keys sharing
+    the prefix of the key last sought, and python-rocksdb cannot ask them
+    to seek in total order for scans of shorter prefixes or backwards.
+    Databases created before tables were supported keep all keys in the
+    default column family.
+    '''
+
+    def __init__(self, *args, **kwargs):
         self.db = None
-        super().__init__(*args)
+        self.families = {}
+        super().__init__(*args, **kwargs)
 
     @classmethod
     def import_module(cls):
         import rocksdb    # pylint:disable=E0401
         cls.module = rocksdb
 
+    def family_options(self, options):
+        rocksdb = self.module
+        options.target_file_size_base = 33554432
+        options.table_factory = rocksdb.BlockBasedTableFactory(
+            filter_policy=rocksdb.BloomFilterPolicy(10),
+            block_cache=self.block_cache)
+        return options
+
     def open(self, name, create):
+        rocksdb = self.module
         mof = 512 if self.for_sync else 128
+        self.block_cache = (rocksdb.LRUCache(self.cache_MB * 1000 * 1000)
+                            if self.cache_MB else None)
         # Use snappy compression (the default)
-        options = self.module.Options(create_if_missing=create,
-                                      use_fsync=True,
-                                      target_file_size_base=33554432,
-                                      max_open_files=mof)
-        self.db = self.module.DB(name, options)
-        self.get = self.db.get
-        self.put = self.db.put
+        options = self.family_options(
+            rocksdb.Options(create_if_missing=create, use_fsync=True,
+                            max_open_files=mof))
+        if create:
+            self.db = rocksdb.DB(name, options)
+            for table in self.tables:
+                self.db.create_column_family(
+                    table, self.family_options(rocksdb.ColumnFamilyOptions()))
+            tables = list(self.tables)
+        else:
+            tables = [family for family in rocksdb.list_column_families(name, rocksdb.Options())
+                      if family != b'default']
+            families = {table: self.family_options(rocksdb.ColumnFamilyOptions())
+                        for table in tables}
+            self.db = rocksdb.DB(name, options, column_families=families)
+        self.families = {table: self.db.get_column_family(table) for table in tables}
+        if self.families:
+            self.get = self.family_get
+            self.put = self.family_put
+        else:
+            self.get = self.db.get
+            self.put = self.db.put
 
     def close(self):
         # PyRocksDB doesn't provide a close method; hopefully this is enough
-        self.db = self.get = self.put = None
+        self.families = {}
+        self.db = self.get = self.put = self.block_cache = None
         import gc
         gc.collect()
 
+    def family_key(self, key):
+        '''Return the key to pass to python-rocksdb.'''
+        family = self.families.get(key[:1])
+        return key if family is None else (family, key)
+
+    def family_get(self, key, **read_options):
+        return self.db.get(self.family_key(key), **read_options)
+
+    def family_put(self, key, value):
+        self.db.put(self.family_key(key), value)
+
+    def multi_get(self, keys, **read_options):
+        if self.families:
+            keys = [self.family_key(key) for key in keys]
+        values = self.db.multi_get(keys, **read_options)
+        return [values[key] for key in keys]
+
+    def multi_prefix_scan(self, prefixes, **read_options):
+        # Seek one iterator per column family forwards through the prefixes in order
+        results = {}
+        iterators = {}
+        for prefix in sorted(prefixes):
+            family = self.families.get(prefix[:1])
+            iterator = iterators.get(family)
+            if iterator is None:
+                iterator = iterators[family] = (
+                    self.db.iteritems(family, **read_options) if family
+                    else self.db.iteritems(**read_options))
+            items = results[prefix] = []
+            iterator.seek(prefix)
+            for key, value in iterator:
+                if family:
+                    key = key[1]
+                if not key.startswith(prefix):
+                    break
+                items.append((key, value))
+        return [results[prefix] for prefix in prefixes]
+
+    def sync(self):
+        # Writes are appended to a log, so syncing an empty batch syncs those before it
+        self.db.write(self.module.WriteBatch(), sync=True)
+
+    def snapshot(self):
+        return RocksDBSnapshot(self)
+
     def write_batch(self):
-        return RocksDBWriteBatch(self.db)
+        return RocksDBWriteBatch(self)
+
+    def iterator(self, prefix=b'', reverse=False, **read_options):
+        if prefix or not self.families:
+            return RocksDBIterator(self.db, prefix, reverse,
+                                   self.families.get(prefix[:1]), **read_options)
+        # All keys; merge those of each column family
+        iterators = [RocksDBIterator(self.db, prefix, reverse, family, **read_options)
+                     for family in [None, *self.families.values()]]
+        return heapq.merge(*iterators, reverse=reverse)
+
+
+class LMDB(Storage):
+    '''LMDB database engine.
+
+    Reads are from the memory-mapped database files, each in its own
+    read transaction, so readers in different threads never wait for
+    each other or for a writer.  Each table is a named database; other
+    keys are in the named database "default".
+
+    Commits are not synced by LMDB itself, so that the durability mode
+    can choose to sync after each write batch or only at barriers.
+    '''
+
+    # The size the database files can grow to.  It is only reserved address space.
+    MAP_SIZE = 1 << 40
+
+    def __init__(self, *args, **kwargs):
+        self.env = None
+        super().__init__(*args, **kwargs)
+
+    @classmethod
+    def import_module(cls):
+        import lmdb    # pylint:disable=E0401
+        cls.module = lmdb
+
+    def open(self, name, create):
+        self.env = self.module.open(name, create=create, map_size=self.MAP_SIZE,
+                                    max_dbs=len(self.tables) + 1, max_readers=1024,
+                                    readahead=False, sync=False)
+        self.default_db = self.env.open_db(b'default')
+        self.dbs = {table: self.env.open_db(table) for table in self.tables}
+
+    def close(self):
+        if self.env:
+            self.env.close()
+            self.env = None
+
+    def key_db(self, key):
+        '''Return the named database holding key.'''
+        return self.dbs.get(key[:1], self.default_db)
+
+    def get(self, key):
+        with self.env.begin(db=self.key_db(key)) as txn:
+            return txn.get(key)
+
+    def put(self, key, value):
+        with self.env.begin(db=self.key_db(key), write=True) as txn:
+            txn.put(key, value)
+
+    def reading(self, txn):
+        '''Return a context manager providing txn, or a new read transaction if
+        it is None.'''
+        return self.env.begin() if txn is None else nullcontext(txn)
+
+    def multi_get(self, keys, txn=None):
+        key_db = self.key_db
+        with self.reading(txn) as txn:
+            get = txn.get
+            return [get(key, db=key_db(key)) for key in keys]
+
+    def multi_prefix_scan(self, prefixes, txn=None):
+        results = {}
+        key_db = self.key_db
+        with self.reading(txn) as txn:
+            cursors = {}
+            for prefix in sorted(prefixes):
+                db = key_db(prefix)
+                cursor = cursors.get(db)
+                if cursor is None:
+                    cursor = cursors[db] = txn.cursor(db)
+                items = results[prefix] = []
+                if cursor.set_range(prefix):
+                    for key, value in cursor.iternext():
+                        if not key.startswith(prefix):
+                            break
+                        items.append((key, value))
+        return [results[prefix] for prefix in prefixes]
+
+    def sync(self):
+        self.env.sync(True)
+
+    def snapshot(self):
+        return LMDBSnapshot(self)
+
+    def write_batch(self):
+        return LMDBWriteBatch(self)
+
+    def iterator(self, prefix=b'', reverse=False, txn=None):
+        if prefix or not self.dbs:
+            return self.db_iterator(self.key_db(prefix), prefix, reverse, txn)
+        # All keys; merge those of each named database
+        iterators = [self.db_iterator(db, prefix, reverse, txn)
+                     for db in [self.default_db, *self.dbs.values()]]
+        return heapq.merge(*iterators, reverse=reverse)
+
+    def db_iterator(self, db, prefix, reverse, txn=None):
+        with self.reading(txn) as txn:
+            cursor = txn.cursor(db)
+            if reverse:
+                nxt_prefix = util.increment_byte_string(prefix)
+                if nxt_prefix and cursor.set_range(nxt_prefix):
+                    found = cursor.prev()
+                else:
+                    found = cursor.last()
+                if not found:
+                    return
+                items = cursor.iterprev()
+            else:
+                if not cursor.set_range(prefix):
+                    return
+                items = cursor.iternext()
+            for key, value in items:
+                if not key.startswith(prefix):
+                    break
+                yield key, value
+
+
+class LevelDBSnapshot(object):
+    '''A read snapshot of a LevelDB database.'''
+
+    def __init__(self, db):
+        self.db = db.snapshot()
+        self.get = self.db.get
+        self.iterator = self.db.iterator
+        self.close = self.db.close
+
+    multi_get = LevelDB.multi_get
+    multi_prefix_scan = LevelDB.multi_prefix_scan
+
+
+class RocksDBSnapshot(object):
+    '''A read snapshot of a RocksDB database.'''
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.read_options = {'snapshot': storage.db.snapshot()}
+
+    def get(self, key):
+        return self.storage.get(key, **self.read_options)
+
+    def multi_get(self, keys):
+        return self.storage.multi_get(keys, **self.read_options)
+
+    def multi_prefix_scan(self, prefixes):
+        return self.storage.multi_prefix_scan(prefixes, **self.read_options)
 
     def iterator(self, prefix=b'', reverse=False):
-        return RocksDBIterator(self.db, prefix, reverse)
+        return self.storage.iterator(prefix, reverse, **self.read_options)
+
+    def close(self):
+        # The snapshot is released when python-rocksdb frees it
+        self.read_options = None
+
+
+class LMDBSnapshot(object):
+    '''A read snapshot of an LMDB database: a read transaction.
+
+    A transaction must not be used by two threads at once, so reads are
+    serialized and iterators read their items up front.
+    '''
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.txn = storage.env.begin()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self.txn.get(key, db=self.storage.key_db(key))
+
+    def multi_get(self, keys):
+        with self.lock:
+            return self.storage.multi_get(keys, self.txn)
+
+    def multi_prefix_scan(self, prefixes):
+        with self.lock:
+            return self.storage.multi_prefix_scan(prefixes, self.txn)
+
+    def iterator(self, prefix=b'', reverse=False):
+        with self.lock:
+            return iter(list(self.storage.iterator(prefix, reverse, self.txn)))
+
+    def close(self):
+        with self.lock:
+            self.txn.abort()
+
+
+class LMDBWriteBatch(object):
+    '''A write batch for LMDB: a write transaction.'''
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.txn = None
+
+    def put(self, key, value):
+        self.txn.put(key, value, db=self.storage.key_db(key))
+
+    def delete(self, key):
+        self.txn.delete(key, db=self.storage.key_db(key))
+
+    def __enter__(self):
+        self.txn = self.storage.env.begin(write=True)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_val:
+            self.txn.abort()
+        else:
+            self.txn.commit()
+            storage = self.storage
+            if storage.durability == storage.SYNCED:
+                storage.sync()
 
 
 class RocksDBWriteBatch(object):
     '''A write batch for RocksDB.'''
 
-    def __init__(self, db):
+    def __init__(self, storage):
         self.batch = RocksDB.module.WriteBatch()
-        self.db = db
+        self.storage = storage
+
+    def put(self, key, value):
+        self.batch.put(self.storage.family_key(key), value)
+
+    def delete(self, key):
+        self.batch.delete(self.storage.family_key(key))
 
     def __enter__(self):
-        return self.batch
+        return self if self.storage.families else self.batch
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if not exc_val:
-            self.db.write(self.batch)
+            storage = self.storage
+            storage.db.write(self.batch, sync=storage.durability == storage.SYNCED)
 
 
 class RocksDBIterator(object):
     '''An iterator for RocksDB.'''
 
-    def __init__(self, db, prefix, reverse):
+    def __init__(self, db, prefix, reverse, family=None, **read_options):
         self.prefix = prefix
+        self.family = family
+        iteritems = partial(db.iteritems, family) if family else db.iteritems
+        iteritems = partial(iteritems, **read_options)
         if reverse:
-            self.iterator = reversed(db.iteritems())
+            self.iterator = reversed(iteritems())
             nxt_prefix = util.increment_byte_string(prefix)
             if nxt_prefix:
                 self.iterator.seek(nxt_prefix)
@@ -162,7 +563,7 @@ class RocksDBIterator(object):
             else:
                 self.iterator.seek_to_last()
         else:
-            self.iterator = db.iteritems()
+            self.iterator = iteritems()
             self.iterator.seek(prefix)
 
     def __iter__(self):
@@ -170,6 +571,115 @@ class RocksDBIterator(object):
 
     def __next__(self):
         k, v = next(self.iterator)
+        if self.family:
+            # Column family keys are (family, key) pairs
+            k = k[1]
         if not k.startswith(self.prefix):
             raise StopIteration
         return k, v
+
+
+class StorageExecutor(object):
+    '''Runs DB I/O in a dedicated pool of threads.
+
+    Jobs wait in a queue per priority.  Idle threads take them in a weighted
+    round robin of the priorities, so block processing is served first but
+    client reads still get a share of the threads while it is busy, and
+    neither can starve the other.  The queue depths and the latency of jobs,
+    from being queued to completing, are recorded for stats().
+    '''
+
+    SYNC, CLIENT = 0, 1
+    PRIORITY_NAMES = ('sync', 'client')
+    # The order in which idle threads look for jobs
+    TURNS = (SYNC, CLIENT, SYNC, SYNC)
+    # Upper bounds of the latency histogram buckets, in ms
+    LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self, workers):
+        self.queues = [deque() for _ in self.PRIORITY_NAMES]
+        self.histograms = [[0] * (len(self.LATENCY_BUCKETS) + 1) for _ in self.PRIORITY_NAMES]
+        self.max_depths = [0] * len(self.PRIORITY_NAMES)
+        self.turn = 0
+        self.condition = threading.Condition()
+        self.threads = [threading.Thread(target=self._work, daemon=True,
+                                         name=f'db-worker-{n}')
+                        for n in range(max(1, workers))]
+        for thread in self.threads:
+            thread.start()
+
+    def _next_job(self):
+        '''Return the next job to run.  Call with the condition held.'''
+        turns = self.TURNS
+        while True:
+            for _ in turns:
+                queue = self.queues[turns[self.turn]]
+                self.turn = (self.turn + 1) % len(turns)
+                if queue:
+                    return queue.popleft()
+            self.condition.wait()
+
+    def _work(self):
+        while True:
+            with self.condition:
+                loop, future, priority, queued, func, args = self._next_job()
+            try:
+                result = func(*args)
+            except BaseException as e:    # pylint:disable=broad-except
+                deliver = (self._set_exception, future, e)
+            else:
+                deliver = (self._set_result, future, result)
+            # Count the job before its caller can see it is done
+            elapsed_ms = (time.monotonic() - queued) * 1000
+            with self.condition:
+                histogram = self.histograms[priority]
+                histogram[bisect_left(self.LATENCY_BUCKETS, elapsed_ms)] += 1
+            loop.call_soon_threadsafe(*deliver)
+
+    @staticmethod
+    def _set_result(future, result):
+        if not future.cancelled():
+            future.set_result(result)
+
+    @staticmethod
+    def _set_exception(future, exception):
+        if not future.cancelled():
+            future.set_exception(exception)
+
+    def _submit(self, priority, calls):
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in calls]
+        queued = time.monotonic()
+        with self.condition:
+            queue = self.queues[priority]
+            for future, (func, *args) in zip(futures, calls):
+                queue.append((loop, future, priority, queued, func, args))
+            self.max_depths[priority] = max(self.max_depths[priority], len(queue))
+            self.condition.notify(len(calls))
+        return futures
+
+    async def run(self, priority, func, *args):
+        '''Run func(*args) in the pool and return its result.'''
+        future, = self._submit(priority, [(func, *args)])
+        return await future
+
+    async def run_batch(self, priority, calls):
+        '''Queue a batch of (func, *args) calls at once, so that the pool
+        runs them concurrently, and return a list of their results.'''
+        if not calls:
+            return []
+        return await asyncio.gather(*self._submit(priority, calls))
+
+    def stats(self):
+        '''Return the queue depths and latency histograms by priority.'''
+        bounds = [f'<={bound:d}' for bound in self.LATENCY_BUCKETS]
+        bounds.append(f'>{self.LATENCY_BUCKETS[-1]:d}')
+        result = {'workers': len(self.threads)}
+        with self.condition:
+            for priority, name in enumerate(self.PRIORITY_NAMES):
+                result[name] = {
+                    'queued': len(self.queues[priority]),
+                    'max queued': self.max_depths[priority],
+                    'latency ms': dict(zip(bounds, self.histograms[priority])),
+                }
+        return result
@@ -0,0 +1,245 @@
+# Copyright (c) 2017, the ElectrumX authors
+#
+# All rights reserved.
+#
+# See the file "LICENCE" for information about the copyright
+# and warranty status of this software.
+
+'''In-memory caches of unflushed UTXOs.
+
+Both engines map a 36-byte key, TX_HASH + TX_IDX, to a 24-byte value,
+HASHX + TX_NUM + VALUE, and provide the subset of the dictionary
+interface the block processor and DB flush need, plus memsize(),
+entries_size() and db_records().
+'''
+
+import sys
+
+from electrumx.lib import util
+from electrumx.lib.hash import HASHX_LEN
+
+try:
+    from electrumx.lib import _fastparse
+except ImportError:
+    _fastparse = None
+
+
+KEY_LEN = 36
+VALUE_LEN = 24
+
+# Python object overhead of each key and value held in a dictionary
+_KEY_SIZE = sys.getsizeof(bytes(KEY_LEN))
+_VALUE_SIZE = sys.getsizeof(bytes(VALUE_LEN))
+
+# The UTXO DB records of an entry: the key followed by the value
+H_KEY_LEN = 1 + 4 + 4 + 5
+H_RECORD_LEN = H_KEY_LEN + HASHX_LEN
+U_KEY_LEN = 1 + HASHX_LEN + 4 + 5
+U_RECORD_LEN = U_KEY_LEN + 8
+
+
+def utxo_cache_class(name):
+    '''Returns a UTXO cache class.'''
+    engines = {'dict': DictUTXOCache, 'compact': CompactUTXOCache}
+    try:
+        return engines[name.lower()]
+    except KeyError:
+        raise RuntimeError(f'unrecognised UTXO cache engine "{name}"') from None
+
+
+def py_utxo_records(items):
+    '''Return the UTXO DB records of the (key, value) cache entries in items.
+
+    The records of the "h" and "u" tables are returned as a pair of byte strings.
+    Each holds fixed-size records sorted by key, a record being the DB key
+    followed by the value:
+
+      h:  b'h' + TX_HASH[:4] + TX_IDX + TX_NUM, HASHX
+      u:  b'u' + HASHX + TX_IDX + TX_NUM, VALUE
+    '''
+    h_records = []
+    u_records = []
+    for key, value in items:
+        hashX = value[:-13]
+        # suffix = tx_idx + tx_num
+        suffix = key[-4:] + value[-13:-8]
+        h_records.append(b''.join((b'h', key[:4], suffix, hashX)))
+        u_records.append(b''.join((b'u', hashX, suffix, value[-8:])))
+    # Keys are unique so sorting records sorts by key
+    h_records.sort()
+    u_records.sort()
+    return b''.join(h_records), b''.join(u_records)
+
+
+class DictUTXOCache(dict):
+    '''A UTXO cache that is a Python dictionary.
+
+    Fast, but each 60-byte entry costs around 170 bytes of memory.
+    '''
+
+    def __init__(self, max_size=0):
+        # max_size is a hint for preallocating engines
+        super().__init__()
+
+    def memsize(self):
+        '''The memory used by the cache in bytes.'''
+        return sys.getsizeof(self) + len(self) * (_KEY_SIZE + _VALUE_SIZE)
+
+    def entries_size(self):
+        '''The memory needed by the entries in bytes.  Flushes are triggered by
+        this.'''
+        return self.memsize()
+
+    def db_records(self):
+        '''The sorted UTXO DB records of the entries.  See py_utxo_records().'''
+        if _fastparse:
+            return _fastparse.utxo_records(self)
+        return py_utxo_records(self.items())
+
+
+class CompactUTXOCache(object):
+    '''A UTXO cache that is an open-addressing hash table held in
+    preallocated bytearrays.
+
+    Each slot costs 61 bytes: the key, the value and a one-byte tag.
+    The tag is 0 for an empty slot, 1 for a deleted one, and otherwise
+    a few bits of the key's hash so that most probes of occupied slots
+    do not need to compare keys.  Collisions are resolved by linear
+    probing.
+
+    The table is sized from max_size so that it is MAX_LOAD full when
+    entries_size() reaches max_size; it doubles in size if filled further.
+    memsize() is the size of the table, which is allocated up front.
+    '''
+
+    MAX_LOAD = 0.8
+    SLOT_SIZE = KEY_LEN + VALUE_LEN + 1
+    MIN_CAPACITY = 1 << 12
+    EMPTY, DELETED = 0, 1
+
+    def __init__(self, max_size=0):
+        self.logger = util.class_logger(__name__, self.__class__.__name__)
+        self.capacity = max(max_size // self.SLOT_SIZE, self.MIN_CAPACITY)
+        self._allocate(self.capacity)
+
+    def _allocate(self, capacity):
+        self.capacity = capacity
+        self.count = 0
+        self.deleted = 0
+        self.tags = bytearray(capacity)
+        self.keys = bytearray(capacity * KEY_LEN)
+        self.values = bytearray(capacity * VALUE_LEN)
+        self.max_used = int(capacity * self.MAX_LOAD)
+
+    def _resize(self, capacity):
+        tags, keys, values = self.tags, self.keys, self.values
+        self._allocate(capacity)
+        put = self.__setitem__
+        for slot, tag in enumerate(tags):
+            if tag > self.DELETED:
+                put(bytes(keys[slot * KEY_LEN: (slot + 1) * KEY_LEN]),
+                    values[slot * VALUE_LEN: (slot + 1) * VALUE_LEN])
+
+    def _find(self, key):
+        '''Return a (slot, tag) pair.  slot is that of key, or -1 if not present.'''
+        h = hash(key)
+        tag = 2 + (h >> 32) % 254
+        capacity = self.capacity
+        slot = h % capacity
+        tags = self.tags
+        keys = self.keys
+        while True:
+            slot_tag = tags[slot]
+            if slot_tag == tag:
+                start = slot * KEY_LEN
+                if keys[start: start + KEY_LEN] == key:
+                    return slot, tag
+            elif slot_tag == 0:
+                return -1, tag
+            slot += 1
+            if slot == capacity:
+                slot = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        return self._find(key)[0] != -1
+
+    def __setitem__(self, key, value):
+        assert len(key) == KEY_LEN and len(value) == VALUE_LEN
+        slot, tag = self._find(key)
+        if slot == -1:
+            if self.count + self.deleted >= self.max_used:
+                # Double in size unless it is mostly deleted slots
+                capacity = self.capacity
+                if self.count >= capacity * self.MAX_LOAD / 2:
+                    capacity *= 2
+                    self.logger.info(f'resizing to {capacity:,d} slots')
+                self._resize(capacity)
+            # Re-use the first deleted or empty slot on the probe sequence
+            slot = hash(key) % self.capacity
+            tags = self.tags
+            while tags[slot] > self.DELETED:
+                slot += 1
+                if slot == self.capacity:
+                    slot = 0
+            if tags[slot] == self.DELETED:
+                self.deleted -= 1
+            tags[slot] = tag
+            self.count += 1
+            start = slot * KEY_LEN
+            self.keys[start: start + KEY_LEN] = key
+        start = slot * VALUE_LEN
+        self.values[start: start + VALUE_LEN] = value
+
+    def get(self, key, default=None):
+        slot, _tag = self._find(key)
+        if slot == -1:
+            return default
+        start = slot * VALUE_LEN
+        return bytes(self.values[start: start + VALUE_LEN])
+
+    def pop(self, key, default=None):
+        slot, _tag = self._find(key)
+        if slot == -1:
+            return default
+        self.tags[slot] = self.DELETED
+        self.count -= 1
+        self.deleted += 1
+        start = slot * VALUE_LEN
+        return bytes(self.values[start: start + VALUE_LEN])
+
+    def items(self):
+        '''Yield (key, value) pairs in no particular order.'''
+        keys = memoryview(self.keys)
+        values = memoryview(self.values)
+        DELETED = self.DELETED
+        for slot, tag in enumerate(self.tags):
+            if tag > DELETED:
+                yield (bytes(keys[slot * KEY_LEN: (slot + 1) * KEY_LEN]),
+                       bytes(values[slot * VALUE_LEN: (slot + 1) * VALUE_LEN]))
+
+    def db_records(self):
+        '''The sorted UTXO DB records of the entries.  See py_utxo_records().'''
+        if _fastparse:
+            return _fastparse.utxo_table_records(self.tags, self.keys, self.values)
+        return py_utxo_records(self.items())
+
+    def clear(self):
+        '''Remove all entries.  The allocated table is kept.'''
+        self.tags = bytearray(self.capacity)
+        self.count = 0
+        self.deleted = 0
+
+    def memsize(self):
+        '''The memory allocated to the table in bytes.'''
+        return self.capacity * self.SLOT_SIZE
+
+    def entries_size(self):
+        '''The memory needed by the entries in bytes.
+
+        This is the table size needed to hold the entries at MAX_LOAD,
+        so it reaches max_size just as the preallocated table fills.
+        '''
+        return int(self.count * self.SLOT_SIZE / self.MAX_LOAD)
@@ -13,10 +13,17 @@ setuptools.setup(
     python_requires='>=3.8',
     install_requires=requirements,
     extras_require={
-        'rocksdb': ['python-rocksdb>=0.6.9'],
+        'lmdb': ['lmdb'],
+        'numpy': ['numpy'],
+        'rocksdb': ['python-rocksdb>=0.7.0'],
         'uvloop': ['uvloop>=0.14'],
     },
     packages=setuptools.find_packages(include=('electrumx*',)),
+    # Optional C implementations of block parsing; pure Python is used if not built
+    ext_modules=[
+        setuptools.Extension('electrumx.lib._fastparse', ['electrumx/lib/_fastparse.c'],
+                             optional=True),
+    ],
     description='ElectrumX Server',
     author='Neil Booth',
     author_email='kyuupichan@gmail.com',
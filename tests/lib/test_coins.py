@@ -0,0 +1,48 @@
+import pickle
+
+import electrumx.lib.coins as lib_coins
+import electrumx.lib.tx as lib_tx
+from electrumx.lib.script import is_unspendable_genesis
+from electrumx.lib.util import pack_le_uint32, pack_varint
+
+from tests.lib.test_tx import tests as raw_txs
+
+
+def make_block(raw_txs):
+    txs = [bytes.fromhex(raw_tx) for raw_tx in raw_txs]
+    return bytes(80) + pack_varint(len(txs)) + b''.join(txs)
+
+
+def test_digest_block():
+    coin = lib_coins.Radiant
+    raw_block = make_block(raw_txs)
+    block = coin.block(raw_block)
+    digest = coin.digest_block(raw_block, 100)
+
+    assert digest.header == block.header
+    assert len(digest.txs) == len(block.transactions)
+    for (tx, tx_hash), (d_hash, prevouts, outputs) in zip(block.transactions, digest.txs):
+        assert d_hash == tx_hash
+        assert prevouts == [txin.prev_hash + pack_le_uint32(txin.prev_idx)
+                            for txin in tx.inputs]
+        assert outputs == [(idx, coin.hashX_from_script(txout.pk_script), txout.value)
+                           for idx, txout in enumerate(tx.outputs)
+                           if not is_unspendable_genesis(txout.pk_script)]
+
+    # Digests are sent back from worker processes
+    assert pickle.loads(pickle.dumps(digest)) == digest
+
+
+def test_digest_block_drops_unspendable():
+    coin = lib_coins.Radiant
+    tx = lib_tx.Deserializer(bytes.fromhex(raw_txs[0])).read_tx()
+    op_return = lib_tx.TxOutput(0, bytes([0, 0x6a, 1, 2]))
+    tx = tx._replace(outputs=[op_return] + tx.outputs)
+    raw_block = make_block([tx.serialize().hex()])
+    _tx_hash, _prevouts, outputs = coin.digest_block(raw_block, 0).txs[0]
+    assert [idx for idx, _hashX, _value in outputs] == list(range(1, len(tx.outputs)))
+
+
+def test_digest_block_pickles_by_reference():
+    digest_block = pickle.loads(pickle.dumps(lib_coins.Radiant.digest_block))
+    assert digest_block == lib_coins.Radiant.digest_block
@@ -0,0 +1,204 @@
+# Differential tests of the optional C extension against the pure Python code
+
+import array
+import os
+import random
+
+import pytest
+
+from electrumx.lib import hash as lib_hash
+from electrumx.lib import tx as lib_tx
+from electrumx.lib.coins import Radiant
+from electrumx.lib.script import Script, ScriptError
+from electrumx.server.history import py_pack_history, py_unpack_history
+from electrumx.server.utxo_cache import CompactUTXOCache, py_utxo_records
+
+from tests.lib.test_coins import make_block
+from tests.lib.test_tx import tests as raw_txs, v3_txs
+
+_fastparse = pytest.importorskip('electrumx.lib._fastparse')
+
+
+def random_bytes(rng, n):
+    return rng.getrandbits(n * 8).to_bytes(n, 'little')
+
+
+def random_script(rng, truncate=False):
+    '''A random script, often with push refs.  If truncate, often truncated.'''
+    parts = []
+    for _ in range(rng.randrange(8)):
+        kind = rng.randrange(8)
+        if kind == 0:
+            parts.append(bytes([rng.choice((0xd0, 0xd1, 0xd2, 0xd3, 0xd8))])
+                         + random_bytes(rng, 36))
+        elif kind == 1:
+            # Identical refs sort equal
+            parts.append(b'\xd0' + bytes(36))
+        elif kind == 2:
+            parts.append(Script.push_data(random_bytes(rng, rng.randrange(600))))
+        elif kind == 3:
+            parts.append(Script.push_data(random_bytes(rng, 70000)))
+        else:
+            # Opcodes without operands
+            parts.append(bytes(rng.randrange(0x4f, 0xd0) for _ in range(4)))
+    script = b''.join(parts)
+    if truncate and rng.randrange(4) == 0 and script:
+        script = script[:rng.randrange(len(script))]
+    return script
+
+
+def random_tx(rng):
+    version = rng.choice((1, 2, 3, 3))
+    inputs = [lib_tx.TxInput(random_bytes(rng, 32), rng.randrange(5), random_script(rng),
+                             rng.randrange(1 << 32))
+              for _ in range(rng.randrange(1, 4))]
+    if rng.randrange(4) == 0:
+        inputs[0] = lib_tx.TxInput(bytes(32), 0xffffffff, random_bytes(rng, 10), 0)
+    outputs = [lib_tx.TxOutput(rng.randrange(1 << 62), random_script(rng))
+               for _ in range(rng.randrange(5))]
+    if rng.randrange(2) == 0:
+        data = Script.push_data(random_bytes(rng, 5))
+        outputs.append(lib_tx.TxOutput(0, b'\x6a' + data))
+        outputs.append(lib_tx.TxOutput(0, b'\x00\x6a' + data))
+    return lib_tx.Tx(version, inputs, outputs, rng.randrange(1 << 32))
+
+
+def digest_txs(raw_block, legacy):
+    try:
+        return Radiant.digest_txs(raw_block, 80, legacy)
+    except Exception:
+        return 'error'
+
+
+def c_digest_txs(raw_block, legacy):
+    try:
+        return _fastparse.digest_txs(raw_block, 80, legacy)
+    except ValueError:
+        return 'error'
+
+
+def test_digest_txs_known():
+    txs = [tx.serialize().hex() for tx in v3_txs()] + raw_txs
+    raw_block = make_block(txs)
+    for legacy in (False, True):
+        assert _fastparse.digest_txs(raw_block, 80, legacy) == Radiant.digest_txs(
+            raw_block, 80, legacy)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_digest_txs_random(seed):
+    rng = random.Random(seed)
+    txs = [random_tx(rng) for _ in range(rng.randrange(1, 20))]
+    raw_block = make_block([tx.serialize().hex() for tx in txs])
+    for legacy in (False, True):
+        result = digest_txs(raw_block, legacy)
+        assert result != 'error'
+        assert c_digest_txs(raw_block, legacy) == result
+
+
+def test_digest_txs_truncated_script():
+    rng = random.Random(0)
+    script = random_script(rng) + b'\xd0' + bytes(35)
+    tx = lib_tx.Tx(3, [], [lib_tx.TxOutput(0, script)], 0)
+    raw_block = make_block([tx.serialize().hex()])
+    assert c_digest_txs(raw_block, False) == digest_txs(raw_block, False) == 'error'
+    raw_block = make_block([tx._replace(version=2).serialize().hex()])
+    assert c_digest_txs(raw_block, False) == digest_txs(raw_block, False) != 'error'
+
+
+def test_digest_txs_truncated():
+    raw_block = make_block(raw_txs)
+    assert c_digest_txs(raw_block, False) != 'error'
+    for length in range(81, len(raw_block), 7):
+        assert c_digest_txs(raw_block[:length], False) == 'error'
+        assert digest_txs(raw_block[:length], False) == 'error'
+
+
+def test_digest_block_uses_extension():
+    raw_block = make_block(raw_txs)
+    digest = Radiant.digest_block(raw_block, 5)
+    assert digest.txs == Radiant.digest_txs(raw_block, 80, False)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_get_push_input_refs(seed):
+    rng = random.Random(seed)
+    for _ in range(50):
+        script = random_script(rng, truncate=True)
+        try:
+            expected = Script.py_get_push_input_refs(script)
+        except ScriptError:
+            expected = 'error'
+        try:
+            result = Script.get_push_input_refs(script)
+        except ScriptError:
+            result = 'error'
+        assert result == expected
+        # Also on memoryviews
+        if expected != 'error':
+            assert _fastparse.get_push_input_refs(memoryview(script)) == expected
+
+
+def test_double_sha512_256():
+    for n in (0, 1, 80, 111, 112, 1000):
+        data = os.urandom(n)
+        assert lib_hash.double_sha512_256(data) == lib_hash.py_double_sha512_256(data)
+
+
+def test_sha256_resumable():
+    state = lib_hash.SHA256_INITIAL_STATE
+    py_state = state
+    parts = []
+    for n in (0, 1, 63, 64, 65, 200, 1000):
+        data = os.urandom(n)
+        parts.append(data)
+        state = _fastparse.sha256_update(state, data)
+        py_state = lib_hash.py_sha256_update(py_state, data)
+        assert state == py_state
+        assert (_fastparse.sha256_finish(state, data)
+                == lib_hash.py_sha256_finish(py_state, data)
+                == lib_hash.sha256(b''.join(parts) + data))
+    with pytest.raises(ValueError):
+        _fastparse.sha256_update(state[:-1], b'')
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_utxo_records(seed):
+    rng = random.Random(seed)
+    utxos = {random_bytes(rng, 36): random_bytes(rng, 24)
+             for _ in range(rng.randrange(2000))}
+    # Shared prefixes
+    for _ in range(20):
+        utxos[bytes(32) + random_bytes(rng, 4)] = bytes(11) + random_bytes(rng, 13)
+    expected = py_utxo_records(utxos.items())
+    assert _fastparse.utxo_records(utxos) == expected
+    table = CompactUTXOCache()
+    for k, v in utxos.items():
+        table[k] = v
+    table.pop(next(iter(utxos)))
+    expected = py_utxo_records(table.items())
+    assert _fastparse.utxo_table_records(table.tags, table.keys, table.values) == expected
+    assert _fastparse.utxo_records({}) == (b'', b'')
+    with pytest.raises(ValueError):
+        _fastparse.utxo_records({bytes(36): bytes(23)})
+    with pytest.raises(ValueError):
+        _fastparse.utxo_table_records(bytes(2), bytes(72), bytes(47))
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_pack_history(seed):
+    rng = random.Random(seed)
+    tx_nums = array.array('Q')
+    tx_num = 0
+    for _ in range(rng.randrange(2000)):
+        tx_num += rng.randrange(1 << rng.randrange(64 - tx_num.bit_length()))
+        tx_nums.append(tx_num)
+    row = _fastparse.pack_history(tx_nums)
+    assert row == py_pack_history(tx_nums)
+    expected = py_unpack_history(row)
+    assert expected == tx_nums
+    assert _fastparse.unpack_history(row) == expected.tobytes()
+    with pytest.raises(ValueError):
+        _fastparse.pack_history(array.array('Q', [2, 1]))
+    with pytest.raises(ValueError):
+        _fastparse.unpack_history(row + b'\x80')
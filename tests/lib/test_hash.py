@@ -72,3 +72,10 @@ def test_Base58_encode_check_custom():
     with pytest.raises(TypeError):
         encode_check_sha256('foo')
     assert encode_check_sha256(b'foo') == '4t9WFhKfWr'
+
+def test_py_sha256_resumable():
+    data = bytes(range(256)) * 3
+    for split in (0, 1, 55, 64, 100, 768):
+        state = lib_hash.py_sha256_update(lib_hash.SHA256_INITIAL_STATE, data[:split])
+        assert lib_hash.py_sha256_finish(state, data[split:]) == lib_hash.sha256(data)
+    assert lib_hash.py_sha256_finish(lib_hash.SHA256_INITIAL_STATE) == lib_hash.sha256(b'')
@@ -191,6 +191,29 @@ async def test_merkle_cache_extension():
                 assert root == root2
 
 
+@pytest.mark.asyncio
+async def test_merkle_cache_from_level():
+    source = Source(64).hashes
+    for level_length in (1, 14, 17, 32, 33):
+        saved = MerkleCache(merkle, source)
+        await saved.initialize(level_length)
+        for length in (1, 13, 17, 33, 40, 64):
+            reads = []
+
+            async def counted_source(start, count):
+                reads.append(count)
+                return await source(start, count)
+
+            cache = MerkleCache(merkle, counted_source)
+            await cache.initialize_from_level(length, saved.length, saved.depth_higher,
+                                              saved.level)
+            assert sum(reads) <= max(length - level_length, 0) + 16
+            cp_hashes = await source(0, length)
+            for index in range(length):
+                assert (await cache.branch_and_root(length, index)
+                        == merkle.branch_and_root(cp_hashes, index))
+
+
 @pytest.mark.asyncio
 async def test_merkle_cache_truncation():
     max_length = 33
@@ -1,4 +1,8 @@
+import pytest
+
 import electrumx.lib.tx as tx_lib
+from electrumx.lib.hash import double_sha256
+from electrumx.lib.script import ScriptError
 
 tests = [
     "020000000192809f0b234cb850d71d020e678e93f074648ed0df5affd0c46d3bcb177f"
@@ -35,3 +39,83 @@ def test_tx_serialiazation():
         deser = tx_lib.Deserializer(test)
         tx = deser.read_tx()
         assert tx.serialize() == test
+
+
+def test_deserializer_view():
+    block_txs = b''.join(bytes.fromhex(test) for test in tests)
+    raw = bytes(3) + tx_lib.pack_varint(len(tests)) + block_txs
+    txs = tx_lib.Deserializer(raw, start=3).read_tx_block()
+    view_txs = tx_lib.DeserializerView(raw, start=3).read_tx_block()
+    assert len(view_txs) == len(txs)
+    for (tx, tx_hash), (view_tx, view_tx_hash) in zip(txs, view_txs):
+        assert view_tx_hash == tx_hash
+        assert view_tx.serialize() == tx.serialize()
+        for txin in view_tx.inputs:
+            assert isinstance(txin.prev_hash, memoryview)
+            assert isinstance(txin.script, memoryview)
+        for txout in view_tx.outputs:
+            assert isinstance(txout.pk_script, memoryview)
+            assert txout.pk_script.obj is raw
+
+
+def v3_txid(tx):
+    '''A direct implementation of the version 3 txid.'''
+    from electrumx.lib.script import Script
+    from electrumx.lib.util import pack_le_int32, pack_le_uint32, pack_le_uint64
+
+    def push_refs(pk_script):
+        refs = Script.get_push_input_refs(pk_script)
+        refs_hash = double_sha256(b''.join(sorted(refs))) if refs else bytes(32)
+        return pack_le_uint32(len(refs)) + refs_hash
+
+    prev_inputs = b''.join(txin.prev_hash + pack_le_uint32(txin.prev_idx)
+                           + double_sha256(txin.script) for txin in tx.inputs)
+    sequences = b''.join(pack_le_uint32(txin.sequence) for txin in tx.inputs)
+    output_hashes = b''.join(pack_le_uint64(txout.value) + double_sha256(txout.pk_script)
+                             + push_refs(txout.pk_script) for txout in tx.outputs)
+    return double_sha256(b''.join((
+        pack_le_uint32(tx.version),
+        pack_le_int32(len(tx.inputs)),
+        double_sha256(prev_inputs),
+        double_sha256(sequences),
+        pack_le_int32(len(tx.outputs)),
+        double_sha256(output_hashes),
+        pack_le_uint32(tx.locktime),
+    )))
+
+
+def v3_txs():
+    ref1, ref2 = bytes(range(36)), bytes(range(100, 136))
+    pk_scripts = [
+        b'',
+        bytes.fromhex('76a9144a519c63f985ba5ab8b71bb42f1ecb82a0a0d80788ac'),
+        # A data push containing the OP_PUSHINPUTREF byte
+        bytes([4, 0xd0, 0xd8, 0xd0, 0xd8, 0x75]),
+        b'\xd0' + ref2 + b'\x75\xd8' + ref1 + b'\x75\xd0' + ref2 + b'\x75',
+        b'\xd1' + ref1 + b'\xd2' + ref2 + b'\x51',
+    ]
+    for test in tests:
+        tx = tx_lib.Deserializer(bytes.fromhex(test)).read_tx()
+        outputs = [tx_lib.TxOutput(n * 1000, pk_script)
+                   for n, pk_script in enumerate(pk_scripts)]
+        yield tx._replace(version=3, outputs=outputs + tx.outputs)
+
+
+def test_v3_txid():
+    for tx in v3_txs():
+        raw_tx = tx.serialize()
+        for deserializer in (tx_lib.Deserializer, tx_lib.DeserializerView):
+            deser_tx, tx_hash = deserializer(raw_tx).read_tx_and_hash()
+            assert deser_tx.serialize() == raw_tx
+            assert tx_hash == v3_txid(tx)
+
+
+def test_push_refs_summary():
+    ref = bytes(range(36))
+    assert tx_lib.push_refs_summary(bytes([2, 0xd0, 0xd8])) == bytes(36)
+    summary = tx_lib.push_refs_summary(b'\xd8' + ref + b'\x75\xd0' + ref)
+    assert summary[:4] == bytes([2, 0, 0, 0])
+    assert summary[4:] == double_sha256(ref + ref)
+    # Malformed scripts are rejected even if they push no refs
+    with pytest.raises(ScriptError):
+        tx_lib.push_refs_summary(bytes([5, 1]))
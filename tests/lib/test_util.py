@@ -107,6 +107,46 @@ def test_LogicalFile(tmpdir):
     L.write(0, b'957' * 6)
     assert L.read(0, -1) == b'957' * 6
 
+
+def test_MappedLogicalFile(tmpdir):
+    prefix = os.path.join(tmpdir, 'log')
+    L = util.MappedLogicalFile(prefix, 2, 6)
+    assert L.read(0, -1) == b''
+    with L.open_file(0, create=True) as f:
+        pass
+    assert L.read(0, 5) == b''
+
+    L.write(0, b'987')
+    assert L.read(0, -1) == b'987'
+    assert L.read(0, 4) == b'987'
+    assert L.read(1, 1) == b'8'
+
+    # Appends and new files are visible immediately
+    L.write(3, b'654')
+    assert L.read(2, 3) == b'765'
+    L.write(6, b'3210')
+    assert L.read(0, -1) == b'9876543210'
+    assert L.read(4, 4) == b'5432'
+    assert L.read(8, 10) == b'10'
+    # As are overwrites
+    L.write(1, b'xy')
+    assert L.read(0, 4) == b'9xy6'
+    with util.open_file(prefix + '01') as f:
+        assert f.read(-1) == b'3210'
+
+    # Test file boundary and rollover
+    L.write(0, b'957' * 6)
+    assert L.read(0, -1) == b'957' * 6
+    assert L.read(5, 2) == b'79'
+
+    # Dropped maps are remapped
+    L = util.MappedLogicalFile(prefix, 2, 6)
+    L.MAX_MAPS = 1
+    assert L.read(0, -1) == b'957' * 6
+    assert L.read(6, 3) == b'957'
+    assert len(L.maps) == 1
+    assert util.LogicalFile(prefix, 2, 6).read(0, -1) == b'957' * 6
+
 def test_open_fns(tmpdir):
     tmpfile = os.path.join(tmpdir, 'file1')
     with pytest.raises(FileNotFoundError):
@@ -2,13 +2,16 @@
 
 import array
 import asyncio
+import os
 from os import environ, urandom
 import random
 
 from electrumx.lib.hash import HASHX_LEN
-from electrumx.lib.util import pack_be_uint16, pack_le_uint64
+from electrumx.lib.util import pack_be_uint16
 from electrumx.server.env import Env
 from electrumx.server.db import DB
+from electrumx.server.history import History, pack_history
+from electrumx.server.storage import db_class
 
 
 def create_histories(history, hashX_count=100):
@@ -17,15 +20,13 @@ def create_histories(history, hashX_count=100):
     hashXs = [urandom(HASHX_LEN) for n in range(hashX_count)]
     mk_array = lambda : array.array('Q')
     histories = {hashX : mk_array() for hashX in hashXs}
-    unflushed = history.unflushed
     tx_num = 0
     while hashXs:
-        tx_numb = pack_le_uint64(tx_num)[:5]
         hash_indexes = set(random.randrange(len(hashXs))
                            for n in range(1 + random.randrange(4)))
         for index in hash_indexes:
             histories[hashXs[index]].append(tx_num)
-            unflushed[hashXs[index]].extend(tx_numb)
+            history.unflushed[hashXs[index]].append(tx_num)
 
         tx_num += 1
         # Occasionally flush and drop a random hashX if non-empty
@@ -40,8 +41,8 @@ def create_histories(history, hashX_count=100):
 
 def check_hashX_compaction(history):
     history.max_hist_row_entries = 40
-    row_size = history.max_hist_row_entries * 5
-    full_hist = b''.join(pack_le_uint64(tx_num)[:5] for tx_num in range(100))
+    row_entries = history.max_hist_row_entries
+    full_hist = array.array('Q', range(100))
     hashX = urandom(HASHX_LEN)
     pairs = ((1, 20), (26, 50), (56, 30))
 
@@ -50,7 +51,7 @@ def check_hashX_compaction(history):
     hist_map = {}
     for flush_count, count in pairs:
         key = hashX + pack_be_uint16(flush_count)
-        hist = full_hist[cum * 5: (cum+count) * 5]
+        hist = pack_history(full_hist[cum: cum + count])
         hist_map[key] = hist
         hist_list.append(hist)
         cum += count
@@ -60,13 +61,13 @@ def check_hashX_compaction(history):
     write_size = history._compact_hashX(hashX, hist_map, hist_list,
                                         write_items, keys_to_delete)
     # Check results for sanity
-    assert write_size == len(full_hist)
+    assert write_size == sum(len(value) for key, value in write_items)
     assert len(write_items) == 3
     assert len(keys_to_delete) == 3
     assert len(hist_map) == len(pairs)
     for n, item in enumerate(write_items):
         assert item == (hashX + pack_be_uint16(n),
-                        full_hist[n * row_size: (n + 1) * row_size])
+                        pack_history(full_hist[n * row_entries: (n + 1) * row_entries]))
     for flush_count, count in pairs:
         assert hashX + pack_be_uint16(flush_count) in keys_to_delete
 
@@ -83,7 +84,7 @@ def check_hashX_compaction(history):
     assert len(hist_map) == len(pairs)
 
     # Check re-compaction adding a single tx writes the one row
-    hist_list[-1] += array.array('I', [100]).tobytes()
+    hist_list[-1] = pack_history(array.array('Q', range(80, 101)))
     write_size = history._compact_hashX(hashX, hist_map, hist_list,
                                         write_items, keys_to_delete)
     assert write_size == len(hist_list[-1])
@@ -132,3 +133,67 @@ def test_compaction(tmpdir):
     print('Temp dir: {}'.format(db_dir))
     loop = asyncio.get_event_loop()
     loop.run_until_complete(run_test(db_dir))
+
+
+def test_online_compaction(tmpdir):
+    cwd = os.getcwd()
+    os.chdir(str(tmpdir))
+    try:
+        history = History()
+        history.open_db(db_class('leveldb'), False, 0, 0, True)
+        history.max_hist_row_entries = 10
+        random.seed(7)
+        histories = create_histories(history)
+        tx_count = 1 + max(max(hist) for hist in histories.values() if hist)
+        utxo_flush_count = history.flush_count
+
+        # Steps of compaction interleaved with flushes of further history
+        history.COMPACTION_FLUSH_COUNT = history.flush_count
+        start_tx_count = tx_count
+        hashXs = sorted(histories)
+        while history.compact_prefixes(4096, 1000) is not None:
+            if history.comp_cursor == -1:
+                break
+            for hashX in random.sample(hashXs, 10):
+                histories[hashX].append(tx_count)
+                history.unflushed[hashX].append(tx_count)
+                tx_count += 1
+            history.flush()
+            utxo_flush_count = history.flush_count
+            check_written(history, histories)
+        assert history.comp_cursor == -1
+        assert history.flush_count < 65
+        check_written(history, histories)
+        # Later flushes must sort after every compacted row
+        assert all(key[-2:] <= pack_be_uint16(history.flush_count)
+                   for key, _hist in history.db.iterator(prefix=b'')
+                   if len(key) == HASHX_LEN + 2)
+        # As DB.compact_history() does on completion
+        utxo_flush_count = history.flush_count
+
+        # The journals list the rows compaction moved, so backing up, even
+        # into compacted history, does not scan the rows of each hashX
+        def no_scan(*args):
+            assert False, 'history rows were scanned'
+
+        history._backup_hashXs = no_scan
+        for tx_count in (tx_count - 15, start_tx_count - 30):
+            assert history.journal_tx_count <= tx_count
+            history.backup([hashX for hashX, hist in histories.items()
+                            if hist and hist[-1] >= tx_count], tx_count)
+            histories = {hashX: array.array('Q', (tx_num for tx_num in hist
+                                                  if tx_num < tx_count))
+                         for hashX, hist in histories.items()}
+            check_written(history, histories)
+        del history._backup_hashXs
+        utxo_flush_count = history.flush_count
+
+        # Excess history of flushes the UTXO DB does not have is removed
+        history.unflushed[hashXs[0]].append(tx_count)
+        history.flush()
+        history.close_db()
+        history.open_db(db_class('leveldb'), False, utxo_flush_count, tx_count, True)
+        check_written(history, histories)
+        history.close_db()
+    finally:
+        os.chdir(cwd)
@@ -0,0 +1,195 @@
+import array
+import asyncio
+import os
+import random
+import threading
+
+import pytest
+
+from electrumx.lib import util
+from electrumx.server import db as db_module
+from electrumx.server.db import DB, DBSnapshot
+from electrumx.server.history import SUMMARY_MARK, History
+from electrumx.server.storage import StorageExecutor, db_class
+
+
+@pytest.fixture(params=[False, True])
+def db(request, tmpdir, monkeypatch):
+    if request.param:
+        monkeypatch.setattr(db_module, 'numpy', None)
+    elif db_module.numpy is None:
+        pytest.skip('numpy not installed')
+    rng = random.Random(3)
+    # fs_tx_hash() and fs_tx_hashes() only need these
+    db = DB.__new__(DB)
+    # Vectorize every lookup when numpy is used
+    db.MIN_VECTORIZED_LOOKUPS = 1
+    db.tx_counts = array.array('Q', [1])
+    for _ in range(60):
+        db.tx_counts.append(db.tx_counts[-1] + rng.randrange(4))
+    db.db_height = 50
+    db.hashes_file = util.MappedLogicalFile(os.path.join(tmpdir, 'hashes'), 4, 1000)
+    db.hashes_file.write(0, bytes(rng.randrange(256)
+                                  for _ in range(db.tx_counts[db.db_height] * 32)))
+    return db
+
+
+def test_fs_tx_hashes(db):
+    tx_count = db.tx_counts[-1]
+    cases = [[], [0], list(range(tx_count)), list(range(tx_count - 1, -1, -1)),
+             [5, 6, 7, 20, 21, 3, 4, tx_count - 1, 0, 0, 1]]
+    for tx_nums in cases:
+        assert db.fs_tx_hashes(tx_nums) == [db.fs_tx_hash(tx_num) for tx_num in tx_nums]
+    pairs = db.fs_tx_hashes(list(range(tx_count)))
+    assert [pair[0] is None for pair in pairs] == [
+        tx_num >= db.tx_counts[db.db_height] for tx_num in range(tx_count)]
+
+
+def test_fs_tx_hashes_db_height(db):
+    tx_nums = list(range(db.tx_counts[-1]))
+    pairs = db.fs_tx_hashes(tx_nums, 40)
+    assert pairs[:db.tx_counts[40]] == db.fs_tx_hashes(tx_nums)[:db.tx_counts[40]]
+    assert all(tx_hash is None for tx_hash, _height in pairs[db.tx_counts[40]:])
+
+
+def test_fs_tx_hashes_few(db, monkeypatch):
+    class NoNumpy:
+        def __getattr__(self, name):
+            assert False, 'searched all tx counts for a few tx numbers'
+
+    tx_nums = [5, 6, 20]
+    expected = db.fs_tx_hashes(tx_nums)
+    monkeypatch.setattr(db_module, 'numpy', NoNumpy())
+    db.MIN_VECTORIZED_LOOKUPS = DB.MIN_VECTORIZED_LOOKUPS
+    assert db.fs_tx_hashes(tx_nums) == expected
+
+
+class Snapshot:
+
+    def __init__(self, rows, generation):
+        self.rows = rows
+        self.generation = generation
+        self.utxo_db = self
+        self.scans = 0
+
+    def multi_prefix_scan(self, prefixes):
+        self.scans += len(prefixes)
+        return [[row for row in self.rows if row[0].startswith(prefix)]
+                for prefix in prefixes]
+
+
+def test_utxo_read_cache():
+    hashX1, hashX2 = bytes(11), bytes(range(11))
+    rows = [(b'h' + bytes(8) + b'2', hashX1), (b'u' + hashX1 + b'1', b'v1'),
+            (b'u' + hashX1 + b'2', b'v2'), (b'u' + hashX2 + b'3', b'v3')]
+    cache = db_module.UTXOReadCache(1)
+    snapshot = Snapshot(rows, cache.generation)
+    prefixes = [b'u' + hashX1, b'h' + bytes(8), b'u' + hashX2, b'u' + hashX1]
+    expected = [tuple(rows[1:3]), tuple(rows[:1]), tuple(rows[3:]), tuple(rows[1:3])]
+    assert cache.multi_prefix_scan(snapshot, prefixes) == expected
+    assert snapshot.scans == 3
+    assert cache.multi_prefix_scan(snapshot, prefixes) == expected
+    assert snapshot.scans == 3
+    assert (cache.lookups, cache.hits, len(cache)) == (8, 4, 3)
+
+    # Only the entries holding the keys are invalidated
+    cache.invalidate([b'u' + hashX2 + b'3', b'h' + bytes(8) + b'2', b'U1234'])
+    assert len(cache) == 1
+    assert cache.get(b'u' + hashX1) == tuple(rows[1:3])
+    # Scans of a snapshot older than an invalidation are not cached
+    cache.multi_prefix_scan(snapshot, [b'u' + hashX2])
+    assert cache.get(b'u' + hashX2) is None
+    snapshot.generation = cache.generation
+    cache.multi_prefix_scan(snapshot, [b'u' + hashX2])
+    assert cache.get(b'u' + hashX2) == tuple(rows[3:])
+
+
+def test_utxo_read_cache_size():
+    cache = db_module.UTXOReadCache(1)
+    cache.max_rows = 20
+    snapshot = Snapshot([(b'u' + bytes([n]) + bytes(10), b'v') for n in range(256)], 0)
+    for n in range(256):
+        cache.multi_prefix_scan(snapshot, [b'u' + bytes([n])])
+    assert cache.rows == cache.max_rows
+    assert len(cache) == 10
+    # Scans too large for the cache are not cached
+    snapshot.rows *= 2
+    cache.multi_prefix_scan(snapshot, [b'u'])
+    assert cache.get(b'u') is None
+    # The least recently used were dropped
+    assert cache.get(b'u' + bytes([255])) is not None
+    assert cache.get(b'u' + bytes([0])) is None
+
+
+class UTXODB:
+
+    def __init__(self, rows):
+        self.rows = dict(rows)
+
+    def multi_prefix_scan(self, prefixes):
+        return [sorted((key, value) for key, value in self.rows.items()
+                       if key.startswith(prefix)) for prefix in prefixes]
+
+    def multi_get(self, keys):
+        return [self.rows.get(key) for key in keys]
+
+
+def test_lookup_spends_duplicate_tx_hash(db):
+    # Transactions 3 and 7 have the same hash; the output of the first is spent
+    tx_hash = db.fs_tx_hash(7)[0]
+    db.hashes_file.write(3 * 32, tx_hash)
+    hashX = bytes(range(11))
+    tx_idx = util.pack_le_uint32(1)
+    rows = {}
+    for tx_num in (3, 7):
+        suffix = tx_idx + util.pack_le_uint64(tx_num)[:5]
+        rows[b'h' + tx_hash[:4] + suffix] = hashX
+    rows[b'u' + hashX + suffix] = util.pack_le_uint64(500)
+    db.utxo_db = UTXODB(rows)
+
+    prevout = tx_hash + tx_idx
+    hdb_key, udb_key, cache_value = db.lookup_spends([prevout])[prevout]
+    assert hdb_key == b'h' + tx_hash[:4] + suffix
+    assert udb_key == b'u' + hashX + suffix
+    assert cache_value == hashX + suffix[4:] + util.pack_le_uint64(500)
+
+
+def test_history_status_during_backup(db, tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    history = History()
+    history.open_db(db_class('leveldb'), False, 0, 0, False)
+    hashX = bytes(range(11))
+    history.unflushed[hashX].extend([1, 4, 9])
+    history.flush()
+    db.history = history
+    db.summary_lock = threading.Lock()
+    db.backup_count = 0
+    db.executor = StorageExecutor(1)
+    db.snapshot = DBSnapshot(db.db_height, db.tx_counts[db.db_height], None,
+                             history.db.snapshot(), 0)
+
+    # A summary computed whilst a backup starts is discarded
+    fs_tx_hashes = db.fs_tx_hashes
+
+    def start_backup(*args):
+        with db.summary_lock:
+            db.backup_count += 1
+        return fs_tx_hashes(*args)
+
+    db.fs_tx_hashes = start_backup
+    count, state = asyncio.run(db.history_status(hashX, 100))
+    assert count == 3
+    assert history.get_summary(hashX) is None
+    del db.fs_tx_hashes
+    # Nor is one stored until the backup is done
+    assert asyncio.run(db.history_status(hashX, 100)) == (count, state)
+    assert history.get_summary(hashX) is None
+    db.backup_count += 1
+    assert asyncio.run(db.history_status(hashX, 100)) == (count, state)
+    assert history.get_summary(hashX) == (count, 9, state)
+    # Readers do not write to the DB; the next flush does
+    assert history.db.get(hashX + SUMMARY_MARK) is None
+    db.flush_history(history.take_unflushed(), 0)
+    assert history.db.get(hashX + SUMMARY_MARK) is not None
+    assert history.get_summary(hashX) == (count, 9, state)
+    history.close_db()
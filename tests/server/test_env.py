@@ -103,6 +103,10 @@ def test_CACHE_MB():
     assert_integer('CACHE_MB', 'cache_MB', 1200)
 
 
+def test_UTXO_CACHE():
+    assert_default('UTXO_CACHE', 'utxo_cache', 'dict')
+
+
 def test_SERVICES():
     setup_base_env()
     e = Env()
@@ -231,6 +235,14 @@ def test_REORG_LIMIT():
                    lib_coins.BitcoinSV.REORG_LIMIT)
 
 
+def test_DAEMON_REST():
+    assert_boolean('DAEMON_REST', 'daemon_rest', False)
+
+
+def test_BLOCK_WORKERS():
+    assert_integer('BLOCK_WORKERS', 'block_workers', 0)
+
+
 def test_COST_HARD_LIMIT():
     assert_integer('COST_HARD_LIMIT', 'cost_hard_limit', 10000)
 
@@ -259,6 +271,22 @@ def test_DB_ENGINE():
     assert_default('DB_ENGINE', 'db_engine', 'leveldb')
 
 
+def test_DB_CACHE_MB():
+    assert_integer('DB_CACHE_MB', 'db_cache_MB', 0)
+
+
+def test_UTXO_READ_CACHE_MB():
+    assert_integer('UTXO_READ_CACHE_MB', 'utxo_read_cache_MB', 20)
+
+
+def test_DB_WORKERS():
+    assert_integer('DB_WORKERS', 'db_workers', 4)
+
+
+def test_HISTORY_COMPACTION_MB():
+    assert_integer('HISTORY_COMPACTION_MB', 'history_compaction_MB', 4)
+
+
 def test_MAX_SEND():
     assert_integer('MAX_SEND', 'max_send', 1000000)
 
@@ -0,0 +1,209 @@
+# Tests of the history index in server/history.py
+
+import os
+import random
+
+import pytest
+
+from electrumx.lib.util import pack_le_uint64
+from electrumx.server.history import (
+    SUMMARY_MARK, History, HistorySummary, py_pack_history, py_unpack_history,
+    unpack_history,
+)
+from electrumx.server.storage import db_class
+
+
+@pytest.fixture
+def history(tmpdir):
+    cwd = os.getcwd()
+    os.chdir(str(tmpdir))
+    history = History()
+    history.open_db(db_class('leveldb'), False, 0, 0, False)
+    yield history
+    history.close_db()
+    os.chdir(cwd)
+
+
+def add_history(history, hashXs, tx_count, rng, start=0):
+    '''Flush a random history of tx_count txs from tx_num start touching
+    hashXs in many small flushes.  Return the history of each hashX.'''
+    histories = {hashX: [] for hashX in hashXs}
+    for tx_num in range(start, start + tx_count):
+        for hashX in rng.sample(hashXs, 2):
+            histories[hashX].append(tx_num)
+            history.unflushed[hashX].append(tx_num)
+        if rng.random() < 0.2:
+            history.flush()
+    history.flush()
+    return histories
+
+
+def check_pages(history, histories):
+    for hashX, hist in histories.items():
+        assert list(history.get_txnums(hashX, limit=None)) == hist
+        for start in (0, 1, hist[0], hist[len(hist) // 2], hist[-1], hist[-1] + 1):
+            expected = [tx_num for tx_num in hist if tx_num >= start]
+            assert list(history.get_txnums_from(hashX, start, limit=None)) == expected
+            assert list(history.get_txnums_from(hashX, start, limit=3)) == expected[:3]
+
+
+def test_get_txnums_from(history):
+    rng = random.Random(3)
+    hashXs = [bytes([n]) * 11 for n in range(5)]
+    histories = add_history(history, hashXs, 300, rng)
+    check_pages(history, histories)
+
+    # Compaction rewrites the rows and their index entries
+    history.max_hist_row_entries = 7
+    history.comp_cursor = 0
+    history.comp_flush_count = 1
+    while history.comp_cursor != -1:
+        history._compact_history(1000)
+    check_pages(history, histories)
+
+    # Backing up truncates and deletes rows and their index entries
+    history.backup(hashXs, 250)
+    histories = {hashX: [tx_num for tx_num in hist if tx_num < 250]
+                 for hashX, hist in histories.items()}
+    check_pages(history, histories)
+    index_count = sum(len(key) == 15 for key, _value in history.db.iterator())
+    row_count = sum(len(key) == 13 for key, _value in history.db.iterator())
+    assert index_count == row_count
+
+
+def test_pack_history():
+    rng = random.Random(6)
+    tx_num = 0
+    tx_nums = []
+    for _ in range(1000):
+        tx_num += rng.choice((0, 1, 2, 127, 128, 5000, 2**21, 2**35))
+        tx_nums.append(tx_num)
+    row = py_pack_history(tx_nums)
+    assert len(row) < len(tx_nums) * 5
+    assert list(py_unpack_history(row)) == tx_nums
+    assert list(unpack_history(row)) == tx_nums
+    assert py_pack_history([]) == b''
+    assert py_pack_history([0, 1, 300]) == bytes([0, 1, 0xab, 0x02])
+    with pytest.raises(ValueError):
+        py_pack_history([2, 1])
+    with pytest.raises(ValueError):
+        py_unpack_history(b'\x01\x80')
+
+
+@pytest.mark.parametrize('db_version', (1, 2))
+def test_upgrade(history, db_version):
+    rng = random.Random(4)
+    hashXs = [bytes([n]) * 11 for n in range(5)]
+    histories = add_history(history, hashXs, 100, rng)
+    # Rewrite the rows with 5-byte tx_nums.  A version 1 DB has no index.
+    history.db_version = db_version
+    with history.db.write_batch() as batch:
+        for key, value in history.db.iterator():
+            if len(key) == 13:
+                batch.put(key, b''.join(pack_le_uint64(tx_num)[:5]
+                                        for tx_num in unpack_history(value)))
+            elif len(key) == 15 and db_version == 1:
+                batch.delete(key)
+        history.write_state(batch)
+    history.close_db()
+
+    history.open_db(db_class('leveldb'), False, history.flush_count, 100, False)
+    assert history.db_version == max(History.DB_VERSIONS)
+    check_pages(history, histories)
+
+
+def test_summaries(history):
+    rng = random.Random(5)
+    hashXs = [bytes([n]) * 11 for n in range(5)]
+    histories = add_history(history, hashXs, 100, rng)
+    assert history.get_summary(hashXs[0]) is None
+    for n, hashX in enumerate(hashXs):
+        history.put_summary(hashX, HistorySummary(n, 2**40 - 1, bytes([n]) * 40))
+    assert history.get_summary(hashXs[3]) == HistorySummary(3, 2**40 - 1, bytes([3]) * 40)
+    # They are written by the next flush
+    assert history.db.get(hashXs[3] + SUMMARY_MARK) is None
+    history.flush()
+    assert not history.unflushed_summaries
+    assert history.get_summary(hashXs[3]) == HistorySummary(3, 2**40 - 1, bytes([3]) * 40)
+
+    # Summaries are not history
+    history.max_hist_row_entries = 7
+    history.comp_cursor = 0
+    history.comp_flush_count = 1
+    while history.comp_cursor != -1:
+        history._compact_history(1000)
+    check_pages(history, histories)
+    assert history.get_summary(hashXs[4]) == HistorySummary(4, 2**40 - 1, bytes([4]) * 40)
+
+    # Backing up discards unflushed summaries and deletes those of the touched hashXs
+    history.put_summary(bytes([9]) * 11, HistorySummary(1, 3, bytes(40)))
+    touched = [hashX for hashX in hashXs if histories[hashX][-1] >= 99]
+    history.backup(touched, 99)
+    for hashX in hashXs:
+        assert (history.get_summary(hashX) is None) == (hashX in touched)
+    assert history.get_summary(bytes([9]) * 11) is None
+
+
+def test_backup_journals(history, monkeypatch):
+    rng = random.Random(7)
+    hashXs = [bytes([n]) * 11 for n in range(5)]
+    histories = add_history(history, hashXs, 300, rng)
+    assert history.journal_tx_count == 0
+
+    def no_scan(*args):
+        assert False, 'history rows were scanned'
+
+    scan = history._backup_hashXs
+    monkeypatch.setattr(history, '_backup_hashXs', no_scan)
+    for tx_count in (290, 200, 199, 120):
+        history.backup(hashXs, tx_count)
+        histories = {hashX: [tx_num for tx_num in hist if tx_num < tx_count]
+                     for hashX, hist in histories.items()}
+        check_pages(history, histories)
+    assert all(first < 120 for first in history.journals)
+
+    # Flushes after a backup are journalled
+    more = add_history(history, hashXs, 60, rng, start=120)
+    for hashX, hist in more.items():
+        histories[hashX].extend(hist)
+    history.backup(hashXs, 150)
+    histories = {hashX: [tx_num for tx_num in hist if tx_num < 150]
+                 for hashX, hist in histories.items()}
+    check_pages(history, histories)
+
+    # Pruning keeps the journal of the flush holding tx_count
+    journals = list(history.journals)
+    history.flush(undo_tx_count=100)
+    first = max(first for first in journals if first <= 100)
+    assert history.journals[0] == first
+    assert history.journal_tx_count == first
+    history.backup(hashXs, 100)
+    histories = {hashX: [tx_num for tx_num in hist if tx_num < 100]
+                 for hashX, hist in histories.items()}
+    check_pages(history, histories)
+
+    # Backing up before the journals scans the rows of the hashXs
+    monkeypatch.setattr(history, '_backup_hashXs', scan)
+    history.backup(hashXs, 50)
+    assert history.journal_tx_count == -1 and not history.journals
+    histories = {hashX: [tx_num for tx_num in hist if tx_num < 50]
+                 for hashX, hist in histories.items()}
+    check_pages(history, histories)
+
+    # Compaction rewrites the journals listing the rows it moves
+    more = add_history(history, hashXs, 40, rng, start=50)
+    for hashX, hist in more.items():
+        histories[hashX].extend(hist)
+    journals = list(history.journals)
+    history.max_hist_row_entries = 7
+    history.comp_cursor = 0
+    history.comp_flush_count = 1
+    while history.comp_cursor != -1:
+        history._compact_history(1000)
+    assert history.journals == journals
+    monkeypatch.setattr(history, '_backup_hashXs', no_scan)
+    for tx_count in (85, 62):
+        history.backup(hashXs, tx_count)
+        histories = {hashX: [tx_num for tx_num in hist if tx_num < tx_count]
+                     for hashX, hist in histories.items()}
+        check_pages(history, histories)
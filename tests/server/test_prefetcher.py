@@ -0,0 +1,125 @@
+import asyncio
+
+import pytest
+
+from electrumx.lib.coins import Coin
+from electrumx.server.block_processor import Prefetcher
+from electrumx.server.daemon import DaemonError
+
+
+class Daemon:
+
+    def __init__(self, height, block_size=1000, delay=0.01):
+        self._height = height
+        self.block_size = block_size
+        self.delay = delay
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def height(self):
+        return self._height
+
+    async def block_hex_hashes(self, first, count):
+        return [f'{height:064x}' for height in range(first, first + count)]
+
+    async def raw_blocks(self, hex_hashes):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            # Later batches are quicker so they complete out of order
+            await asyncio.sleep(self.delay / (1 + int(hex_hashes[0], 16) % 3))
+        finally:
+            self.in_flight -= 1
+        return [int(hex_hash, 16).to_bytes(4, 'big') * (self.block_size // 4)
+                for hex_hash in hex_hashes]
+
+
+async def drain(prefetcher, blocks_event, upto):
+    blocks = []
+    while len(blocks) < upto:
+        await blocks_event.wait()
+        blocks_event.clear()
+        blocks.extend(prefetcher.get_prefetched_blocks())
+    return [int.from_bytes(block[:4], 'big') for block in blocks]
+
+
+def make_prefetcher(daemon):
+    blocks_event = asyncio.Event()
+    prefetcher = Prefetcher(daemon, Coin, blocks_event)
+    prefetcher.batch_size = 20_000
+    prefetcher.target_cache_size = 100_000
+    prefetcher.polling_delay = 0.01
+    return prefetcher, blocks_event
+
+
+@pytest.mark.asyncio
+async def test_prefetch_in_order():
+    daemon = Daemon(500)
+    prefetcher, blocks_event = make_prefetcher(daemon)
+    task = asyncio.ensure_future(prefetcher.main_loop(100))
+    try:
+        heights = await asyncio.wait_for(drain(prefetcher, blocks_event, 400), 10)
+    finally:
+        task.cancel()
+    assert heights == list(range(101, 501))
+    assert daemon.max_in_flight > 1
+    assert prefetcher.caught_up
+    info = prefetcher.info()
+    assert info['fetch']['blocks'] == 400
+    assert info['fetch']['MB'] == 0.4
+
+
+@pytest.mark.asyncio
+async def test_prefetch_bounded():
+    daemon = Daemon(5000)
+    prefetcher, blocks_event = make_prefetcher(daemon)
+    task = asyncio.ensure_future(prefetcher.main_loop(0))
+    try:
+        await asyncio.sleep(0.5)
+        assert 0 < prefetcher.cache_size <= prefetcher.target_cache_size
+        assert not prefetcher.refill_event.is_set()
+        heights = await asyncio.wait_for(drain(prefetcher, blocks_event, 1), 10)
+        assert heights[0] == 1
+    finally:
+        task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_prefetch_reset():
+    daemon = Daemon(500, delay=0.05)
+    prefetcher, blocks_event = make_prefetcher(daemon)
+    task = asyncio.ensure_future(prefetcher.main_loop(100))
+    try:
+        await asyncio.sleep(0.02)
+        await prefetcher.reset_height(300)
+        blocks_event.clear()
+        heights = await asyncio.wait_for(drain(prefetcher, blocks_event, 200), 10)
+    finally:
+        task.cancel()
+    assert heights == list(range(301, 501))
+
+
+class FlakyDaemon(Daemon):
+
+    def __init__(self, height, fail_at):
+        super().__init__(height)
+        self.fail_at = fail_at
+
+    async def raw_blocks(self, hex_hashes):
+        if self.fail_at is not None and int(hex_hashes[0], 16) >= self.fail_at:
+            self.fail_at = None
+            raise DaemonError('fetch failed')
+        return await super().raw_blocks(hex_hashes)
+
+
+@pytest.mark.asyncio
+async def test_prefetch_daemon_error():
+    daemon = FlakyDaemon(500, 200)
+    prefetcher, blocks_event = make_prefetcher(daemon)
+    task = asyncio.ensure_future(prefetcher.main_loop(100))
+    try:
+        heights = await asyncio.wait_for(drain(prefetcher, blocks_event, 400), 10)
+    finally:
+        task.cancel()
+    assert daemon.fail_at is None
+    assert heights == list(range(101, 501))
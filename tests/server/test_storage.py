@@ -1,7 +1,10 @@
+import asyncio
 import pytest
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from electrumx.server.storage import Storage, db_class
+from electrumx.server.storage import Storage, StorageExecutor, db_class
 from electrumx.lib.util import subclasses
 
 # Find out which db engines to test
@@ -41,6 +44,23 @@ def test_batch(db):
     assert db.get(b"a") == b"2"
 
 
+def test_batch_delete_and_abort(db):
+    db.put(b"a", b"1")
+    db.put(b"b", b"2")
+    with db.write_batch() as b:
+        b.delete(b"a")
+        b.put(b"c", b"3")
+    assert db.get(b"a") is None
+    assert db.get(b"c") == b"3"
+    with pytest.raises(ValueError):
+        with db.write_batch() as b:
+            b.delete(b"b")
+            b.put(b"d", b"4")
+            raise ValueError
+    assert db.get(b"b") == b"2"
+    assert db.get(b"d") is None
+
+
 def test_iterator(db):
     """
     The iterator should contain all key/value pairs starting with prefix
@@ -68,8 +88,193 @@ def test_iterator_reverse(db):
         ]
 
 
+def test_iterator_all(db):
+    items = [(bytes([n]) + b"key", bytes([n])) for n in range(0, 256, 5)]
+    for key, value in reversed(items):
+        db.put(key, value)
+    assert list(db.iterator()) == items
+    assert list(db.iterator(reverse=True)) == list(reversed(items))
+    assert list(db.iterator(prefix=b"\xff")) == [(b"\xffkey", b"\xff")]
+    assert list(db.iterator(prefix=b"\xff", reverse=True)) == [(b"\xffkey", b"\xff")]
+    assert list(db.iterator(prefix=b"\x01")) == []
+    assert list(db.iterator(prefix=b"\x01", reverse=True)) == []
+
+
+def test_concurrent_reads(db):
+    for n in range(100):
+        db.put(b"k%03d" % n, b"v%03d" % n)
+
+    def read(n):
+        assert db.get(b"k%03d" % n) == b"v%03d" % n
+        return len(list(db.iterator(prefix=b"k0")))
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        assert list(executor.map(read, range(100))) == [100] * 100
+
+
+def test_multi_get(db):
+    db.put(b"a", b"1")
+    db.put(b"c", b"3")
+    assert db.multi_get([]) == []
+    assert db.multi_get([b"c", b"b", b"a", b"c"]) == [b"3", None, b"1", b"3"]
+
+
+def test_multi_prefix_scan(db):
+    for key in (b"a1", b"a2", b"ab", b"b1", b"c"):
+        db.put(key, key + b"!")
+    assert db.multi_prefix_scan([]) == []
+    assert db.multi_prefix_scan([b"b", b"a", b"x", b"a1", b"b"]) == [
+        [(b"b1", b"b1!")],
+        [(b"a1", b"a1!"), (b"a2", b"a2!"), (b"ab", b"ab!")],
+        [],
+        [(b"a1", b"a1!")],
+        [(b"b1", b"b1!")],
+    ]
+
+
+
+def test_snapshot(db):
+    db.put(b"a1", b"1")
+    db.put(b"a2", b"2")
+    snapshot = db.snapshot()
+    with db.write_batch() as b:
+        b.put(b"a1", b"3")
+        b.put(b"a3", b"4")
+        b.delete(b"a2")
+    assert snapshot.get(b"a1") == b"1"
+    assert snapshot.get(b"a3") is None
+    assert snapshot.multi_get([b"a3", b"a2"]) == [None, b"2"]
+    assert list(snapshot.iterator(prefix=b"a")) == [(b"a1", b"1"), (b"a2", b"2")]
+    assert list(snapshot.iterator(prefix=b"a", reverse=True)) == [(b"a2", b"2"), (b"a1", b"1")]
+    assert snapshot.multi_prefix_scan([b"a2", b"a"]) == [
+        [(b"a2", b"2")], [(b"a1", b"1"), (b"a2", b"2")]]
+    snapshot.close()
+    assert list(db.iterator(prefix=b"a")) == [(b"a1", b"3"), (b"a3", b"4")]
+    assert db.snapshot().get(b"a3") == b"4"
+
+
+@pytest.fixture(params=db_engines)
+def tables_db(tmpdir, request):
+    cwd = os.getcwd()
+    os.chdir(str(tmpdir))
+    if request.param == 'skip':
+        raise pytest.skip()
+    db = db_class(request.param)("db", False, tables={b"h": 3, b"u": 0})
+    yield db
+    os.chdir(cwd)
+    db.close()
+
+
+def test_tables(tables_db):
+    db = tables_db
+    items = [(b"h123", b"1"), (b"h124", b"2"), (b"state", b"3"), (b"u9", b"4"),
+             (b"U1", b"5")]
+    with db.write_batch() as b:
+        for key, value in items:
+            b.put(key, value)
+        b.put(b"u8", b"6")
+        b.delete(b"u8")
+    db.put(b"h2", b"7")
+    items.append((b"h2", b"7"))
+    assert db.get(b"h123") == b"1"
+    assert db.get(b"u8") is None
+    assert db.multi_get([b"u9", b"state", b"h2", b"x"]) == [b"4", b"3", b"7", None]
+    assert list(db.iterator(prefix=b"h12")) == [(b"h123", b"1"), (b"h124", b"2")]
+    assert db.multi_prefix_scan([b"u", b"h12", b"s"]) == [
+        [(b"u9", b"4")], [(b"h123", b"1"), (b"h124", b"2")], [(b"state", b"3")]]
+    assert list(db.iterator(prefix=b"u", reverse=True)) == [(b"u9", b"4")]
+    assert list(db.iterator()) == sorted(items)
+    assert list(db.iterator(reverse=True)) == sorted(items, reverse=True)
+    # Tables persist
+    db.close()
+    db = db_class(db.__class__.__name__)("db", False, tables={b"h": 3, b"u": 0})
+    assert list(db.iterator()) == sorted(items)
+    db.close()
+
+
+def test_tables_short_prefix(tables_db):
+    # Scans of fewer bytes than a table's search prefix see all its keys
+    db = tables_db
+    items = sorted((b"h%d" % n, b"%d" % n) for n in range(100, 400, 7))
+    with db.write_batch() as b:
+        for key, value in items:
+            b.put(key, value)
+    assert list(db.iterator(prefix=b"h")) == items
+    assert list(db.iterator(prefix=b"h2")) == [item for item in items
+                                               if item[0].startswith(b"h2")]
+    assert list(db.iterator(prefix=b"h", reverse=True)) == items[::-1]
+    assert list(db.iterator(prefix=b"h12", reverse=True)) == [(b"h128", b"128"),
+                                                              (b"h121", b"121")]
+    assert db.multi_prefix_scan([b"h135", b"h1", b"h"]) == [
+        [(b"h135", b"135")], [item for item in items if item[0].startswith(b"h1")], items]
+    snapshot = db.snapshot()
+    assert list(snapshot.iterator(prefix=b"h")) == items
+    assert list(snapshot.iterator()) == items
+    snapshot.close()
+
+
+def test_durability(db):
+    assert db.durability == db.SYNCED
+    with pytest.raises(ValueError):
+        db.set_durability('none')
+    db.set_durability(db.FAST)
+    with db.write_batch() as b:
+        b.put(b"a", b"1")
+    db.barrier()
+    db.set_durability(db.SYNCED)
+    with db.write_batch() as b:
+        b.put(b"b", b"2")
+    db.barrier()
+    db.close()
+    db = db_class(db.__class__.__name__)("db", False)
+    assert db.multi_get([b"a", b"b"]) == [b"1", b"2"]
+    db.close()
+
+
 def test_close(db):
     db.put(b"a", b"b")
     db.close()
     db = db_class(db.__class__.__name__)("db", False)
     assert db.get(b"a") == b"b"
+
+
+@pytest.mark.asyncio
+async def test_executor_run():
+    executor = StorageExecutor(3)
+    assert await executor.run(executor.CLIENT, pow, 2, 10) == 1024
+    with pytest.raises(ZeroDivisionError):
+        await executor.run(executor.SYNC, divmod, 1, 0)
+    assert await executor.run_batch(executor.SYNC, []) == []
+    # A batch runs concurrently
+    barrier = threading.Barrier(3, timeout=5)
+    assert await executor.run_batch(executor.SYNC, [(barrier.wait,)] * 3) != []
+    stats = executor.stats()
+    assert stats['workers'] == 3
+    assert sum(stats['sync']['latency ms'].values()) == 4
+    assert sum(stats['client']['latency ms'].values()) == 1
+    assert stats['sync']['queued'] == 0
+    assert stats['sync']['max queued'] == 3
+
+
+@pytest.mark.asyncio
+async def test_executor_priorities():
+    executor = StorageExecutor(1)
+    order = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def block():
+        started.set()
+        release.wait(5)
+
+    blocked = asyncio.ensure_future(executor.run(executor.CLIENT, block))
+    await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+    client = asyncio.ensure_future(executor.run_batch(executor.CLIENT, [(order.append, 'c')] * 6))
+    sync = asyncio.ensure_future(executor.run_batch(executor.SYNC, [(order.append, 's')] * 6))
+    # Let both queue their jobs
+    await asyncio.sleep(0)
+    assert executor.stats()['sync']['queued'] == 6
+    release.set()
+    await asyncio.gather(blocked, client, sync)
+    # Sync jobs come first, but clients get a turn
+    assert ''.join(order) == 'sssc' 'sssc' 'cccc'
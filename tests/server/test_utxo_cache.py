@@ -0,0 +1,117 @@
+import os
+
+import pytest
+
+from electrumx.server.utxo_cache import (CompactUTXOCache, DictUTXOCache,
+                                         H_RECORD_LEN, U_RECORD_LEN,
+                                         py_utxo_records, utxo_cache_class)
+
+
+def key(n):
+    return n.to_bytes(32, 'little') + (n % 7).to_bytes(4, 'little')
+
+
+def value(n):
+    return n.to_bytes(24, 'big')
+
+
+@pytest.fixture(params=['dict', 'compact'])
+def cache(request):
+    return utxo_cache_class(request.param)(0)
+
+
+def test_utxo_cache_class():
+    assert utxo_cache_class('dict') is DictUTXOCache
+    assert utxo_cache_class('Compact') is CompactUTXOCache
+    with pytest.raises(RuntimeError):
+        utxo_cache_class('zippy')
+
+
+def test_put_get_pop(cache):
+    assert len(cache) == 0
+    assert cache.get(key(1)) is None
+    assert cache.pop(key(1), None) is None
+    cache[key(1)] = value(1)
+    cache[key(2)] = value(2)
+    assert len(cache) == 2
+    assert key(1) in cache
+    assert key(3) not in cache
+    assert cache.get(key(1)) == value(1)
+    cache[key(1)] = value(5)
+    assert len(cache) == 2
+    assert cache.pop(key(1), None) == value(5)
+    assert cache.pop(key(1), None) is None
+    assert key(1) not in cache
+    assert len(cache) == 1
+    cache[key(1)] = value(6)
+    assert cache.get(key(1)) == value(6)
+    assert len(cache) == 2
+
+
+def test_many(cache):
+    count = 20000
+    for n in range(count):
+        cache[key(n)] = value(n)
+    for n in range(0, count, 2):
+        assert cache.pop(key(n), None) == value(n)
+    # Churn through deleted slots
+    for n in range(count, count * 2):
+        cache[key(n)] = value(n)
+        assert cache.pop(key(n), None) == value(n)
+    assert len(cache) == count // 2
+    assert dict(cache.items()) == {key(n): value(n)
+                                   for n in range(1, count, 2)}
+    cache.clear()
+    assert len(cache) == 0
+    assert not list(cache.items())
+    assert cache.get(key(1)) is None
+
+
+def test_memsize(cache):
+    empty = cache.entries_size()
+    for n in range(1000):
+        cache[key(n)] = value(n)
+    used = cache.entries_size() - empty
+    assert 60 * 1000 < used < 250 * 1000
+    assert cache.memsize() >= cache.entries_size()
+
+
+def test_compact_sizing():
+    cache = CompactUTXOCache(10 * 1000 * 1000)
+    capacity, max_used = cache.capacity, cache.max_used
+    assert capacity == 10 * 1000 * 1000 // CompactUTXOCache.SLOT_SIZE
+    for n in range(max_used - 1):
+        cache[os.urandom(36)] = value(n)
+    assert cache.capacity == capacity
+    assert cache.memsize() == capacity * CompactUTXOCache.SLOT_SIZE
+    assert cache.entries_size() <= 10 * 1000 * 1000
+    for n in range(10):
+        cache[os.urandom(36)] = value(n)
+    assert cache.capacity == capacity * 2
+    assert cache.memsize() == capacity * 2 * CompactUTXOCache.SLOT_SIZE
+    assert len(cache) == cache.count == max_used + 9
+
+
+def test_db_records(cache):
+    utxos = {key(n): value(n * 7919) for n in range(300)}
+    for k, v in utxos.items():
+        cache[k] = v
+    cache.pop(key(5))
+    del utxos[key(5)]
+    h_records, u_records = cache.db_records()
+    assert len(h_records) == len(utxos) * H_RECORD_LEN
+    assert len(u_records) == len(utxos) * U_RECORD_LEN
+    h_records = [h_records[n: n + H_RECORD_LEN]
+                 for n in range(0, len(h_records), H_RECORD_LEN)]
+    u_records = [u_records[n: n + U_RECORD_LEN]
+                 for n in range(0, len(u_records), U_RECORD_LEN)]
+    assert h_records == sorted(h_records)
+    assert u_records == sorted(u_records)
+    expected_h, expected_u = set(), set()
+    for k, v in utxos.items():
+        hashX, tx_num, utxo_value = v[:11], v[11:16], v[16:]
+        expected_h.add(b'h' + k[:4] + k[32:] + tx_num + hashX)
+        expected_u.add(b'u' + hashX + k[32:] + tx_num + utxo_value)
+    assert set(h_records) == expected_h
+    assert set(u_records) == expected_u
+    assert py_utxo_records(cache.items()) == cache.db_records()